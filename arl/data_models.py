@@ -112,67 +112,129 @@ class SkyModel:
 
 
 class Visibility:
-    """ Visibility table class
+    """ Visibility class
 
-    Visibility with uvw, time, a1, a2, vis, weight Columns in
-    an astropy Table along with an attribute to hold the frequencies
+    Visibility with uvw, time, a1, a2, vis, weight columns held as
+    numpy arrays along with an attribute to hold the frequencies
     and an attribute to hold the direction.
 
     Visibility is defined to hold an observation with one set of frequencies and one
     direction.
 
-    The data column has vis:[row,nchan,npol], uvw:[row,3]
+    The columns are vis:[row,nchan,npol], weight:[row,nchan,npol],
+    uvw:[row,3], time:[row], antenna1:[row], antenna2:[row]. `data`
+    presents them as an astropy Table without copying, for I/O.
+
+    `imaging_weight`:[row,nchan] holds the weights used for imaging,
+    as set by `weight_visibility`. It is dropped when `uvw`, `weight`
+    or `frequency` get replaced.
     """
-    
+
+    columns = ('uvw', 'time', 'antenna1', 'antenna2', 'vis', 'weight')
+    __slots__ = columns + ('frequency', 'phasecentre', 'configuration', 'meta', 'imaging_weight',
+                           '_uvw_lambdas')
+
     def __init__(self, data=None, frequency=None, phasecentre=None, configuration=None,
-                 uvw=None, time=None, antenna1=None, antenna2=None, vis=None, weight=None):
-        if data is None and not vis is None:
-            data = Table({'uvw': uvw, 'time': time,
-                          'antenna1': antenna1, 'antenna2': antenna2,
-                          'vis': vis, 'weight': weight
-                          })
-        
-        self.data = data  # Astropy.table with columns uvw, time, a1, a2, vis, weight
+                 uvw=None, time=None, antenna1=None, antenna2=None, vis=None, weight=None,
+                 meta=None, imaging_weight=None):
+        self.uvw = uvw  # numpy.array [row,3]
+        self.time = time  # numpy.array [row]
+        self.antenna1 = antenna1  # numpy.array [row]
+        self.antenna2 = antenna2  # numpy.array [row]
+        self.vis = vis  # numpy.array [row,nchan,npol]
+        self.weight = weight  # numpy.array [row,nchan,npol]
+        self.meta = meta  # dict
+        if data is not None:
+            self.data = data
         self.frequency = frequency  # numpy.array [nchan]
         self.phasecentre = phasecentre  # Phase centre of observation
         self.configuration = configuration  # Antenna/station configuration
-    
-    @property
-    def nchan(self): return self.data['vis'].shape[1]
-    
-    @property
-    def npol(self): return self.data['vis'].shape[2]
-    
-    @property
-    def uvw(self): return self.data['uvw']
-    
-    @property
-    def u(self):   return self.data['uvw'][:, 0]
-    
-    @property
-    def v(self):   return self.data['uvw'][:, 1]
-    
+        self.imaging_weight = imaging_weight  # numpy.array [row,nchan]
+
+    def __setattr__(self, name, value):
+        # Columns are always plain numpy arrays, so access never goes through Table machinery
+        if name in Visibility.columns and value is not None:
+            value = numpy.asarray(value)
+        if name in ('uvw', 'frequency'):
+            object.__setattr__(self, '_uvw_lambdas', None)
+        if name in ('uvw', 'weight', 'frequency'):
+            object.__setattr__(self, 'imaging_weight', None)
+        object.__setattr__(self, name, value)
+
+    def __len__(self):
+        return 0 if self.vis is None else self.vis.shape[0]
+
     @property
-    def w(self):   return self.data['uvw'][:, 2]
-    
+    def data(self):
+        """ Columns as an astropy Table sharing memory with the Visibility """
+        if self.vis is None:
+            return None
+        return Table([getattr(self, name) for name in Visibility.columns],
+                     names=Visibility.columns, meta=self.meta, copy=False)
+
+    @data.setter
+    def data(self, table):
+        for name in Visibility.columns:
+            setattr(self, name, None if table is None else table[name])
+        self.meta = None if table is None else dict(table.meta)
+
+    def select(self, rows):
+        """ Visibility holding a subset of rows
+
+        Slices give views sharing memory with this Visibility, index arrays give copies.
+
+        :param rows: slice, index array or boolean mask
+        :returns: Visibility
+        """
+        vis = Visibility(frequency=self.frequency, phasecentre=self.phasecentre,
+                         configuration=self.configuration, meta=self.meta)
+        for name in Visibility.columns:
+            setattr(vis, name, getattr(self, name)[rows])
+        if self.imaging_weight is not None:
+            vis.imaging_weight = self.imaging_weight[rows]
+        return vis
+
+    def copy(self):
+        """ Visibility with copies of all columns """
+        vis = self.select(slice(None))
+        for name in Visibility.columns:
+            setattr(vis, name, getattr(vis, name).copy())
+        if self.imaging_weight is not None:
+            vis.imaging_weight = self.imaging_weight.copy()
+        return vis
+
     @property
-    def time(self): return self.data['time']
+    def nchan(self): return self.vis.shape[1]
     
     @property
-    def antenna1(self): return self.data['antenna1']
+    def npol(self): return self.vis.shape[2]
     
     @property
-    def antenna2(self): return self.data['antenna2']
+    def u(self):   return self.uvw[:, 0]
     
     @property
-    def vis(self): return self.data['vis']
+    def v(self):   return self.uvw[:, 1]
     
     @property
-    def weight(self): return self.data['weight']
+    def w(self):   return self.uvw[:, 2]
     
     def uvw_lambda(self, channel=0):
         """ Calculates baseline coordinates in wavelengths. """
-        return self.data['uvw'] * self.frequency[channel] / const.c.value
+        return self.uvw * self.frequency[channel] / const.c.value
+
+    @property
+    def uvw_lambdas(self):
+        """ Baseline coordinates in wavelengths for all channels, [nchan,row,3]
+
+        Calculated once and kept until `uvw` or `frequency` get replaced.
+        The array is read-only; writing into `uvw` in place does not
+        update it.
+        """
+        if self._uvw_lambdas is None:
+            uvw = numpy.multiply.outer(numpy.asarray(self.frequency) / const.c.value, self.uvw)
+            uvw.flags.writeable = False
+            object.__setattr__(self, '_uvw_lambdas', uvw)
+        return self._uvw_lambdas
 
 
 class QA:
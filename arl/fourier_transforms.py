@@ -4,13 +4,17 @@
 #
 
 import functools
-import pylru
+import itertools
 import copy
 from astropy import units as units
 from astropy import wcs
 
 from crocodile.simulate import simulate_point, skycoord_to_lmn
-from arl.synthesis_support import w_cache_imaging, w_cache_predict, w_kernel, w_conj_kernel_fn, do_imaging, do_predict
+from crocodile.synthesis import facet_imaging, facet_predict, w_facet_kernel
+from arl.synthesis_support import w_cache_imaging, w_cache_predict, w_kernel, w_conj_kernel_fn, do_imaging, do_predict, \
+    process_imaging, process_predict, ProcessKernelCache, w_stack_imaging, w_stack_predict, \
+    idg_imaging, idg_predict, KernelBank, process_pool, truncated_w_kernel, cached_tile_order, TILE_SIZE, \
+    grid_density, density_weight, hermitian_image, do_mfs_imaging, do_mfs_predict, shared_kernel_cache
 
 from arl.data_models import *
 from arl.image_operations import create_image_from_array
@@ -45,7 +49,7 @@ def create_wcs_from_visibility(vis: Visibility, params={}):
           % (imagecentre, reffrequency, channelwidth))
 
     npixel = get_parameter(params, "npixel", 512)
-    uvmax = (numpy.abs(vis.data['uvw']).max() * reffrequency / const.c).value
+    uvmax = (numpy.abs(vis.uvw).max() * reffrequency / const.c).value
     log.debug("create_wcs_from_visibility: uvmax = %f lambda" % uvmax)
     criticalcellsize = 1.0 / (uvmax * 2.0)
     log.debug("create_wcs_from_visibility: Critical cellsize = %f radians, %f degrees" % (
@@ -87,9 +91,187 @@ def w_cache_size(vis:Visibility, wstep, frequency=None):
     return int(numpy.ceil(wmax / wstep))
 
 
+def kernel_cache_bytes(params={}):
+    """Apply 'kernel_cache_bytes' to the process-wide w-kernel cache
+
+    The cache is shared by all imaging and prediction in this process,
+    so the budget stays in effect for later calls as well.
+
+    :param params: 'kernel_cache_bytes' (default: keep current)
+    :returns: Memory budget of the cache
+    """
+    max_bytes = get_parameter(params, "kernel_cache_bytes", None)
+    if max_bytes is not None:
+        shared_kernel_cache.resize(int(max_bytes))
+    log.debug("kernel_cache_bytes: w-kernel cache holds up to %d bytes" % shared_kernel_cache.max_bytes)
+    return shared_kernel_cache.max_bytes
+
+
+def visibility_order(vis: Visibility, theta, lam, params={}):
+    """Order in which to (de)grid the visibilities of an observation
+
+    Uses `cached_tile_order` on the coordinates of the first channel, so
+    the permutation gets computed once per observation and reused by
+    `invert_visibility` and `predict_visibility`.
+
+    :param vis: Visibility to be processed
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param params: 'wstep', 'tile_size' (grid cells)
+    :returns: Permutation of visibilities
+    """
+    wstep = get_parameter(params, "wstep", 10000.0)
+    tile = get_parameter(params, "tile_size", TILE_SIZE)
+    scale = vis.frequency[0] / const.c.value
+    return cached_tile_order(vis.uvw, theta, lam, vis.uvw, wstep, Qpx=4, tile=tile, scale=scale)
+
+
+def facet_parameters(params, cdtype):
+    """Keyword parameters of `facet_imaging` and `facet_predict` as selected by params
+
+    The image size must be divisible by 'facets' (default 4). Every
+    facet gets imaged 'facet_overlap' pixels larger on each side, and
+    its w-kernels are tapered to a support of 'facet_support' cells.
+
+    :param params: Facet parameters
+    :param cdtype: Complex type of the kernels
+    :returns: Dictionary of keyword parameters
+    """
+    facets = get_parameter(params, "facets", 4)
+    overlap = get_parameter(params, "facet_overlap", 8)
+    support = get_parameter(params, "facet_support", 6)
+    nworkers = get_parameter(params, "nworkers", 1)
+    log.debug("facet_parameters: Using %d x %d facets overlapping by %d pixels, taper support %d" %
+              (facets, facets, overlap, support))
+    return dict(facets=facets, overlap=overlap, support=support, nworkers=nworkers,
+                kernel_fn=functools.partial(w_facet_kernel, dtype=cdtype),
+                NpixFF=32, NpixKern=11, Qpx=8)
+
+
+def imaging_function(vis: Visibility, theta, params={}):
+    """Imaging function for `do_imaging` as selected by params
+
+    :param vis: Visibility to be processed, used to size the w-kernel cache
+    :param theta: Field of view (directional cosines)
+    :param params: 'gridding_algorithm' and the parameters of the algorithm
+    :returns: imaging function
+    """
+    cdtype, fdtype = get_precision(params)
+    log.debug("imaging_function: Gridding with %s visibilities" % numpy.dtype(cdtype).name)
+
+    # Set up the gridding kernel. We try to use a cached version
+    gridding_algorithm = get_parameter(params, 'gridding_algorithm', 'wprojection')
+
+    if gridding_algorithm == 'wprojection':
+        log.debug("imaging_function: Gridding by w projection")
+
+        wstep = get_parameter(params, "wstep", 10000.0)
+        kernel_cache_bytes(params)
+
+        nworkers = get_parameter(params, "nworkers", 1)
+        nprocs = get_parameter(params, "nprocs", 1)
+        log.debug("imaging_function: Gridding with %d processes of %d threads" % (nprocs, nworkers))
+
+        kernel_tolerance = get_parameter(params, "kernel_tolerance", None)
+        if kernel_tolerance is None:
+            kernel_fn = functools.partial(w_kernel, dtype=cdtype)
+        else:
+            log.debug("imaging_function: Truncating w-kernels at energy tolerance %g" % kernel_tolerance)
+            kernel_fn = functools.partial(truncated_w_kernel, tolerance=kernel_tolerance, dtype=cdtype)
+
+        kernel_bank = get_parameter(params, "kernel_bank", None)
+        if kernel_bank is not None:
+            log.debug("imaging_function: Using w-kernel bank in %s" % kernel_bank)
+            cache_fn = KernelBank(kernel_bank, theta, wstep, 256, 15, 4, nbins=w_cache_size(vis, wstep),
+                                  tolerance=kernel_tolerance, dtype=cdtype)
+
+        if nprocs > 1:
+            # Kernel caches cannot be shared between processes. Use the
+            # long-lived pool so that every worker process only fills its
+            # own cache once.
+            if kernel_bank is None:
+                cache_fn = ProcessKernelCache(kernel_fn)
+            imgfn = functools.partial(process_imaging, imgfn=w_cache_imaging,
+                                      nprocs=nprocs, executor=process_pool(nprocs),
+                                      wstep=wstep, kernel_cache=cache_fn,
+                                      nworkers=nworkers, NpixFF=256, NpixKern=15, Qpx=4)
+        else:
+            if kernel_bank is None:
+                cache_fn = w_conj_kernel_fn(shared_kernel_cache.function(kernel_fn))
+            imgfn = functools.partial(w_cache_imaging,
+                                      wstep=wstep, kernel_cache=cache_fn, nworkers=nworkers,
+                                      NpixFF=256, NpixKern=15, Qpx=4)
+    elif gridding_algorithm == 'wstack':
+        log.debug("imaging_function: Gridding by w stacking")
+
+        wstep = get_parameter(params, "wstep", 10000.0)
+        log.debug("imaging_function: Using w-planes every %f wavelengths" % wstep)
+
+        imgfn = functools.partial(w_stack_imaging, wstep=wstep, NpixFF=256, NpixKern=15, Qpx=4)
+    elif gridding_algorithm == 'facets':
+        log.debug("imaging_function: Gridding by facets")
+
+        wstep = get_parameter(params, "wstep", 10000.0)
+        kernel_cache_bytes(params)
+        imgfn = functools.partial(facet_imaging, imgfn=w_cache_imaging, wstep=wstep,
+                                  **facet_parameters(params, cdtype))
+    elif gridding_algorithm == 'idg':
+        log.debug("imaging_function: Gridding by image domain gridding")
+
+        Nsub = get_parameter(params, "idg_subgrid", 32)
+        support = get_parameter(params, "idg_support", 8)
+        log.debug("imaging_function: Using subgrids of %d pixels, taper support %d" % (Nsub, support))
+
+        imgfn = functools.partial(idg_imaging, Nsub=Nsub, support=support)
+    else:
+        raise NotImplementedError("gridding algorithm %s not supported" % gridding_algorithm)
+
+    return imgfn
+
+
+def mfs_coordinates(vis: Visibility, reffrequency):
+    """Coordinates of all channels for multi-frequency synthesis
+
+    :param vis: Visibility to be processed
+    :param reffrequency: Reference frequency of the Taylor terms (Hz)
+    :returns: UVWs of all channels (wavelengths), fractional frequency offset `(f - f0) / f0`, both channel-major
+    """
+    frequency = numpy.asarray(vis.frequency, dtype=float)
+    uvw = vis.uvw_lambdas.reshape(-1, 3)
+    x = numpy.repeat((frequency - reffrequency) / reffrequency, len(vis))
+    return uvw, x
+
+
+def mfs_wcs(w, shape, nplanes):
+    """World coordinate system of an image of Taylor terms
+
+    The spectral axis has one plane per Taylor term. Its reference value
+    `crval[3]` stays the reference frequency of the Taylor terms, which
+    `predict_visibility` reads back.
+
+    :param w: WCS of the channel image, as from `create_wcs_from_visibility`
+    :param shape: Shape of the channel image
+    :param nplanes: Number of Taylor terms
+    :returns: WCS
+    """
+    wt = w.deepcopy()
+    wt.pixel_shape = (shape[3], shape[2], shape[1], nplanes)
+    return wt
+
+
 def invert_visibility(vis: Visibility, params={}):
     """Invert to make dirty Image and PSF
 
+    With 'spectral_mode' 'channel' every channel is imaged separately.
+    With 'mfs' all channels are gridded into one grid per Taylor term
+    ('mfs_nterms', default 1) around the reference frequency. The image
+    planes are then the Taylor terms, and the PSF has `2*nterms-1` of them.
+
+    Visibilities are imaged with their `imaging_weight` as set by
+    `weight_visibility`, so repeated inversions skip weighting. Without
+    it they are weighted for this call only, as `weight_visibility`
+    would with the same params.
+
     :param vis:
     :type Visibility: Visibility to be processed
     :returns: (dirty image, psf)
@@ -104,57 +286,227 @@ def invert_visibility(vis: Visibility, params={}):
     log.debug("invert_visibility: Specified npixel=%d, cellsize = %f rad, FOV = %f rad" %
           (npixel, cellsize, theta))
 
-    # Set up the gridding kernel. We try to use a cached version
-    gridding_algorithm = get_parameter(params, 'gridding_algorithm', 'wprojection')
-
-    if gridding_algorithm == 'wprojection':
-        log.debug("invert_visibility: Gridding by w projection")
-
-        wstep = get_parameter(params, "wstep", 10000.0)
-        wcachesize = w_cache_size(vis, wstep)
-        log.debug("invert_visibility: Making w-kernel cache of %d kernels" % wcachesize)
-
-        cache_fn = w_conj_kernel_fn(pylru.FunctionCacheManager(w_kernel, wcachesize))
-        imgfn = functools.partial(w_cache_imaging,
-                                  wstep=wstep, kernel_cache=cache_fn,
-                                  NpixFF=256, NpixKern=15, Qpx=4)
-    else:
-        raise NotImplementedError("gridding algorithm %s not supported" % gridding_algorithm)
+    cdtype, fdtype = get_precision(params)
+    imaging_weight = vis.imaging_weight
+    if imaging_weight is None:
+        imaging_weight = weight_visibility(copy.copy(vis), None, params).imaging_weight
+    imgfn = imaging_function(vis, theta, params)
 
     # Apply a phase rotation from the visibility phase centre to the image phase centre
     #    visphaserotate = phaserotate(vis, imagecentre)
 
-    d = numpy.zeros(shape)
-    p = numpy.zeros(shape)
-
     spectral_mode = get_parameter(params, 'spectral_mode', 'channel')
     log.debug('invert_visibility: spectral mode is %s' % spectral_mode)
 
     if spectral_mode == 'channel':
+        d = numpy.zeros(shape, dtype=fdtype)
+        p = numpy.zeros(shape, dtype=fdtype)
         pmax = 0.0
         nchan = shape[0]
-        npol = shape[1]
+        npol = vis.npol
+        assert npol <= shape[1], "Visibility has more polarisations than the image"
+        # Coordinates stay in metres, every channel scales them while gridding
+        order = visibility_order(vis, theta, 1.0 / cellsize, params)
+        uvw = vis.uvw[order]
         for channel in range(nchan):
-            for pol in range(npol):
-                log.debug('invert_visibility: Inverting channel %d, polarisation %d' % (channel, pol))
-                d[channel, pol, :, :], p[channel, 0, :, :], pmax = \
-                    do_imaging(theta, 1.0 / cellsize, vis.uvw_lambda(channel),
-                               vis.vis[:, channel, pol], imgfn=imgfn)
+            scale = vis.frequency[channel] / const.c.value
+            # All polarisations share uvw, weights and kernels, so grid them together
+            log.debug('invert_visibility: Inverting channel %d, polarisations 0-%d' % (channel, npol - 1))
+            d[channel, :npol, :, :], p[channel, 0, :, :], pmax = \
+                do_imaging(theta, 1.0 / cellsize, uvw,
+                           vis.vis[order, channel, :].astype(cdtype), imgfn=imgfn, scale=scale,
+                           wt=imaging_weight[order, channel])
             assert pmax > 0.0, ("No data gridded for channel %d" % channel)
+        wd = wp = w
+    elif spectral_mode == 'mfs':
+        # Grid all channels into one grid per Taylor term
+        nterms = get_parameter(params, 'mfs_nterms', 1)
+        log.debug('invert_visibility: Inverting %d channels into %d Taylor terms' % (vis.nchan, nterms))
+        uvw, x = mfs_coordinates(vis, reffrequency.value)
+        vs = numpy.transpose(vis.vis, (1, 0, 2)).reshape(-1, vis.npol).astype(cdtype)
+        wt = imaging_weight.T.reshape(-1)
+        dt, pt, pmax = do_mfs_imaging(theta, 1.0 / cellsize, uvw, vs, x, nterms, imgfn=imgfn, wt=wt)
+        d = numpy.zeros((nterms,) + tuple(shape[1:]), dtype=fdtype)
+        p = numpy.zeros((2 * nterms - 1,) + tuple(shape[1:]), dtype=fdtype)
+        d[:, :vis.npol] = dt
+        p[:, 0] = pt
+        wd, wp = mfs_wcs(w, shape, nterms), mfs_wcs(w, shape, 2 * nterms - 1)
     else:
         raise NotImplementedError("mode %s not supported" % spectral_mode)
 
 
+    dirty = create_image_from_array(d, wd)
+    psf = create_image_from_array(p, wp)
+    log.debug("invert_visibility: Finished making dirty and psf, w-kernel cache %s" % shared_kernel_cache.stats())
+
+
+    return dirty, psf, pmax
+
+def invert_visibility_stream(chunks, params={}):
+    """Invert a stream of Visibility chunks to make dirty Image and PSF
+
+    Chunks are gridded one at a time into `uv` grids of all polarisations
+    and the PSF, so memory is bounded by one chunk plus the grids. The
+    grids are only transformed at the end.
+
+    Weighting is done as in `weight_visibility`. Uniform (the default)
+    and robust weighting need the density of all samples on the grid
+    before gridding. The chunks are then read twice, the first time for
+    their uvw and weights only, so `chunks` must be re-iterable, e.g. a
+    list from `visibility_chunks`. With 'weighting' 'natural' any
+    iterator will do.
+
+    All chunks must share frequencies and phase centre. The image
+    geometry is taken from the first chunk, so 'cellsize' should be given.
+
+    :param chunks: Iterable of Visibility, e.g. `visibility_chunks` of a
+      store opened with `import_visibility_from_npy`
+    :param params: As `invert_visibility`, and 'weighting', 'robustness' as `weight_visibility`
+    :returns: (dirty image, psf, sum of weights)
+    """
+    log_parameters(params)
+    weighting = get_parameter(params, 'weighting', 'uniform')
+    if weighting not in ['natural', 'uniform', 'robust']:
+        raise ValueError("Unknown weighting %s" % weighting)
+    robustness = get_parameter(params, 'robustness', 0.0) if weighting == 'robust' else None
+    spectral_mode = get_parameter(params, 'spectral_mode', 'channel')
+    if spectral_mode != 'channel':
+        raise NotImplementedError("mode %s not supported" % spectral_mode)
+    if weighting != 'natural' and iter(chunks) is chunks:
+        raise ValueError("invert_visibility_stream: %s weighting needs to read the chunks twice, "
+                         "pass a sequence instead of an iterator" % weighting)
+
+    log.debug("invert_visibility_stream: Inverting Visibility chunks to make dirty and psf")
+    chunk_iter = iter(chunks)
+    first = next(chunk_iter)
+    shape, reffrequency, cellsize, w, imagecentre = create_wcs_from_visibility(first, params=params)
+    nchan = shape[0]
+    npixel = shape[3]
+    theta = npixel * cellsize
+    lam = 1.0 / cellsize
+    cdtype, fdtype = get_precision(params)
+
+    density = None
+    if weighting != 'natural':
+        # Counting the conjugate points as well, as in do_imaging
+        density = numpy.zeros((nchan, npixel, npixel))
+        for vis in chunks:
+            wt = numpy.mean(vis.weight, axis=2)
+            for channel in range(nchan):
+                scale = vis.frequency[channel] / const.c.value
+                density[channel] += grid_density(theta, lam, vis.uvw, scale, wt[:, channel])
+                density[channel] += grid_density(theta, lam, vis.uvw, -scale, wt[:, channel])
+        chunk_iter = iter(chunks)
+    else:
+        chunk_iter = itertools.chain([first], chunk_iter)
+
+    imgfn = imaging_function(first, theta, params)
+    grids = None
+    nrows = 0
+    for vis in chunk_iter:
+        nrows += len(vis)
+        log.debug('invert_visibility_stream: Gridding %d rows' % len(vis))
+        order = visibility_order(vis, theta, lam, params)
+        uvw = vis.uvw[order]
+        nv = len(uvw)
+        natural = numpy.mean(vis.weight[order], axis=2)
+        for channel in range(nchan):
+            scale = vis.frequency[channel] / const.c.value
+            if density is None:
+                wt = natural[:, channel]
+            else:
+                wt = density_weight(theta, lam, uvw, natural[:, channel], density[channel], robustness, scale)
+            wt = wt.astype(fdtype)
+            # Image all polarisations and the PSF in one pass
+            v = numpy.empty((nv, vis.npol + 1), dtype=cdtype)
+            v[:, :-1] = wt[:, None] * vis.vis[order, channel, :]
+            v[:, -1] = wt
+            c = imgfn(theta, lam, uvw, v, scale=scale)
+            if grids is None:
+                grids = numpy.zeros((nchan,) + c.shape, dtype=c.dtype)
+            grids[channel] += c
+    assert grids is not None, "No visibilities to invert"
+
+    d = numpy.zeros(shape, dtype=fdtype)
+    p = numpy.zeros(shape, dtype=fdtype)
+    for channel in range(nchan):
+        img = hermitian_image(imgfn, grids[channel])
+        pmax = img[-1].max()
+        assert pmax > 0.0, ("No data gridded for channel %d" % channel)
+        d[channel, :len(img) - 1] = img[:-1] / pmax
+        p[channel, 0] = img[-1] / pmax
+
     dirty = create_image_from_array(d, w)
     psf = create_image_from_array(p, w)
-    log.debug("invert_visibility: Finished making dirty and psf")
-
+    log.debug("invert_visibility_stream: Finished making dirty and psf from %d rows, w-kernel cache %s" %
+              (nrows, shared_kernel_cache.stats()))
 
     return dirty, psf, pmax
 
+
+def prediction_function(vis: Visibility, theta, params={}):
+    """Prediction function for `do_predict` as selected by params
+
+    :param vis: Visibility to be predicted, used to size the w-kernel cache
+    :param theta: Field of view (directional cosines)
+    :param params: 'gridding_algorithm' and the parameters of the algorithm
+    :returns: prediction function
+    """
+    wstep = get_parameter(params, "wstep", 10000.0)
+    kernel_cache_bytes(params)
+
+    gridding_algorithm = get_parameter(params, 'gridding_algorithm', 'wprojection')
+    nprocs = get_parameter(params, "nprocs", 1)
+    cdtype, fdtype = get_precision(params)
+    log.debug("prediction_function: Degridding with %s visibilities" % numpy.dtype(cdtype).name)
+    kernel_tolerance = get_parameter(params, "kernel_tolerance", None)
+    if kernel_tolerance is None:
+        kernel_fn = functools.partial(w_kernel, dtype=cdtype)
+    else:
+        kernel_fn = functools.partial(truncated_w_kernel, tolerance=kernel_tolerance, dtype=cdtype)
+    kernel_bank = get_parameter(params, "kernel_bank", None)
+    if kernel_bank is not None:
+        log.debug("prediction_function: Using w-kernel bank in %s" % kernel_bank)
+        cache_fn = KernelBank(kernel_bank, theta, wstep, 256, 15, 4, nbins=w_cache_size(vis, wstep),
+                              tolerance=kernel_tolerance, dtype=cdtype)
+    if gridding_algorithm == 'wstack':
+        log.debug("prediction_function: Degridding by w stacking")
+        predfn = functools.partial(w_stack_predict, wstep=wstep, NpixFF=256, NpixKern=15, Qpx=4)
+    elif gridding_algorithm == 'facets':
+        log.debug("prediction_function: Degridding by facets")
+        predfn = functools.partial(facet_predict, predfn=w_cache_predict, wstep=wstep,
+                                   **facet_parameters(params, cdtype))
+    elif gridding_algorithm == 'idg':
+        log.debug("prediction_function: Degridding by image domain gridding")
+        predfn = functools.partial(idg_predict,
+                                   Nsub=get_parameter(params, "idg_subgrid", 32),
+                                   support=get_parameter(params, "idg_support", 8))
+    elif gridding_algorithm != 'wprojection':
+        raise NotImplementedError("gridding algorithm %s not supported" % gridding_algorithm)
+    elif nprocs > 1:
+        log.debug("prediction_function: Degridding with %d processes" % nprocs)
+        if kernel_bank is None:
+            cache_fn = ProcessKernelCache(kernel_fn)
+        predfn = functools.partial(process_predict, predfn=w_cache_predict,
+                                   nprocs=nprocs, executor=process_pool(nprocs),
+                                   wstep=wstep, kernel_cache=cache_fn,
+                                   NpixFF=256, NpixKern=15, Qpx=4)
+    else:
+        if kernel_bank is None:
+            cache_fn = w_conj_kernel_fn(shared_kernel_cache.function(kernel_fn))
+        predfn = functools.partial(w_cache_predict,
+                                   wstep=wstep, kernel_cache=cache_fn,
+                                   NpixFF=256, NpixKern=15, Qpx=4)
+
+    return predfn
+
+
 def predict_visibility(vis: Visibility, sm: SkyModel, params={}) -> Visibility:
     """Predict the visibility from a SkyModel including both components and images
 
+    With 'spectral_mode' 'mfs' the planes of the images are Taylor terms
+    around their reference frequency, as made by `invert_visibility`.
+
     :param vis:
     :type Visibility: Visibility to be processed
     :param sm:
@@ -165,8 +517,7 @@ def predict_visibility(vis: Visibility, sm: SkyModel, params={}) -> Visibility:
 
     # Create copy of visibilities
     vis = copy.copy(vis)
-    vis.data = copy.copy(vis.data)
-    vis.data['vis'] = numpy.zeros(vis.vis.shape)
+    vis.vis = numpy.zeros(vis.vis.shape, dtype='complex')
 
     spectral_mode = get_parameter(params, 'spectral_mode', 'channel')
     log.debug('predict_visibility: spectral mode is %s' % spectral_mode)
@@ -175,7 +526,11 @@ def predict_visibility(vis: Visibility, sm: SkyModel, params={}) -> Visibility:
         log.debug("predict_visibility: Predicting Visibility from sky model images")
 
         for im in sm.images:
-            assert_same_chan_pol(vis, im)
+            if spectral_mode == 'mfs':
+                # Image planes are Taylor terms
+                assert vis.npol == im.npol, "Visibility and Image have different number of polarisations"
+            else:
+                assert_same_chan_pol(vis, im)
 
             # Determine image size
             cellsize = abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
@@ -184,32 +539,35 @@ def predict_visibility(vis: Visibility, sm: SkyModel, params={}) -> Visibility:
             log.debug("predict_visibility: Field of view %f radians" % theta)
             assert (theta / numpy.sqrt(2) < 1.0), "Field of view larger than celestial sphere"
 
-            # Parameterise imaging
-            wstep = get_parameter(params, "wstep", 10000.0)
-            wcachesize = w_cache_size(vis, wstep)
-            log.debug("predict_visibility: Making w-kernel cache of %d kernels" % wcachesize)
-
-            cache_fn = w_conj_kernel_fn(pylru.FunctionCacheManager(w_kernel, wcachesize))
-            predfn = functools.partial(w_cache_predict,
-                                       wstep=wstep, kernel_cache=cache_fn,
-                                       NpixFF=256, NpixKern=15, Qpx=4)
-
-            spectral_mode = get_parameter(params, 'spectral_mode', 'channel')
-            log.debug('predict_visibility: spectral mode is %s' % spectral_mode)
+            cdtype, fdtype = get_precision(params)
+            predfn = prediction_function(vis, theta, params)
 
             if spectral_mode == 'channel':
+                order = visibility_order(vis, theta, 1.0 / cellsize, params)
+                uvw = vis.uvw[order]
                 for channel in range(im.nchan):
-                    uvw = vis.uvw_lambda(channel)
+                    scale = vis.frequency[channel] / const.c.value
                     for pol in range(im.npol):
                         log.debug('predict_visibility: Predicting from image channel %d, polarisation %d' % (
                         channel, pol))
-                        img = sm.images[0].data[channel, pol, :, :]
-                        dv = do_predict(theta, 1.0 / cellsize, numpy.array(uvw), img, predfn)
-                        vis.vis[:, channel, pol] += dv
+                        img = sm.images[0].data[channel, pol, :, :].astype(fdtype)
+                        dv = do_predict(theta, 1.0 / cellsize, uvw, img, predfn, scale=scale)
+                        # Scatter back to the original visibility order
+                        vis.vis[order, channel, pol] += dv
+            elif spectral_mode == 'mfs':
+                # Degrid every Taylor term once for all channels
+                uvw, x = mfs_coordinates(vis, im.wcs.wcs.crval[3])
+                for pol in range(im.npol):
+                    log.debug('predict_visibility: Predicting from %d Taylor terms, polarisation %d' % (
+                        im.nchan, pol))
+                    img = sm.images[0].data[:, pol, :, :].astype(fdtype)
+                    dv = do_mfs_predict(theta, 1.0 / cellsize, uvw, x, img, predfn)
+                    vis.vis[:, :, pol] += dv.reshape(vis.nchan, -1).T
             else:
                 raise NotImplementedError("mode %s not supported" % spectral_mode)
 
-            log.debug("predict_visibility: Finished predicting Visibility from sky model images")
+            log.debug("predict_visibility: Finished predicting Visibility from sky model images, w-kernel cache %s" %
+                      shared_kernel_cache.stats())
 
     if len(sm.components):
         log.debug("predict_visibility: Predicting Visibility from sky model components")
@@ -223,10 +581,10 @@ def predict_visibility(vis: Visibility, sm: SkyModel, params={}) -> Visibility:
             log.debug('fourier_transforms.predict_visibility: Cartesian representation of component %d = (%f, %f, %f)'
                   % (icomp, l,m,n))
 
-            if spectral_mode =='channel':
+            # Components have a flux per channel, so mfs makes no difference
+            if spectral_mode in ['channel', 'mfs']:
                 for channel in range(comp.nchan):
-                    uvw = vis.uvw_lambda(channel)
-                    phasor = simulate_point(uvw, l, m)
+                    phasor = simulate_point(vis.uvw, l, m, vis.frequency[channel] / const.c.value)
                     for pol in range(comp.npol):
                         log.debug(
                             'predict_visibility: Predicting from component %d channel %d, polarisation %d' % (
@@ -241,19 +599,59 @@ def predict_visibility(vis: Visibility, sm: SkyModel, params={}) -> Visibility:
     return vis
 
 
-def weight_visibility(vis, im, params={}):
+def weight_visibility(vis, im=None, params={}):
     """ Reweight the visibility data in place a selected algorithm
-    
+
+    Sets `vis.imaging_weight`, which `invert_visibility` uses from then on.
+    'weighting' is 'natural' (the data weights), 'uniform' (the default)
+    or 'robust' (Briggs weighting with 'robustness', default 0.0). The
+    weight density is gridded once per channel, or once for all channels
+    with 'spectral_mode' 'mfs'.
+
     :param vis:
     :type Visibility: Visibility to be processed
-    :param im:
+    :param im: Image defining the grid. Default: the image `invert_visibility` makes for params
     :type Image:
     :param params: Dictionary containing parameters
-    :returns: Configuration
+    :returns: Visibility
     """
-    # TODO: implement
-
     log_parameters(params)
-    log.error("visibility_operations.weight_visibility: not yet implemented")
+    weighting = get_parameter(params, 'weighting', 'uniform')
+    if weighting not in ['natural', 'uniform', 'robust']:
+        raise ValueError("Unknown weighting %s" % weighting)
+    spectral_mode = get_parameter(params, 'spectral_mode', 'channel')
+    if spectral_mode not in ['channel', 'mfs']:
+        raise NotImplementedError("mode %s not supported" % spectral_mode)
+    robustness = get_parameter(params, 'robustness', 0.0) if weighting == 'robust' else None
+    if im is None:
+        shape, reffrequency, cellsize, w, imagecentre = create_wcs_from_visibility(vis, params=params)
+        npixel = shape[3]
+    else:
+        cellsize = abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+        npixel = im.npixel
+    theta = npixel * cellsize
+    lam = 1.0 / cellsize
+    log.debug("weight_visibility: %s weighting, cellsize %f rad" % (weighting, cellsize))
+
+    # Natural weights, shared by all polarisations
+    wt = numpy.mean(vis.weight, axis=2)
+    if weighting == 'natural':
+        vis.imaging_weight = wt
+        return vis
+
+    # Densities count the conjugate points as well, as in do_imaging
+    scales = numpy.asarray(vis.frequency) / const.c.value
+
+    def density(channel):
+        return grid_density(theta, lam, vis.uvw, scales[channel], wt[:, channel]) + \
+               grid_density(theta, lam, vis.uvw, -scales[channel], wt[:, channel])
+
+    if spectral_mode == 'mfs':
+        mfs_density = sum(density(channel) for channel in range(len(scales)))
+    imaging_weight = numpy.empty_like(wt)
+    for channel, scale in enumerate(scales):
+        d = mfs_density if spectral_mode == 'mfs' else density(channel)
+        imaging_weight[:, channel] = density_weight(theta, lam, vis.uvw, wt[:, channel], d, robustness, scale)
+    vis.imaging_weight = imaging_weight
     return vis
 
@@ -6,6 +6,8 @@
 
 import numpy as numpy
 
+from crocodile.fft_backend import rfft2, irfft2, rfft_shift_phases
+
 from arl.image_operations import create_image_from_array
 from arl.data_models import *
 from arl.parameters import *
@@ -27,11 +29,13 @@ def deconvolve_cube(dirty: Image, psf: Image, params={}):
     :type Image:
     :param psf: Image Point Spread Function
     :type Image:
-    :param params: 'algorithm': 'msclean'|'hogbom', 'gain': loop gain (float)
+    :param params: 'algorithm': 'msclean'|'hogbom', 'gain': loop gain (float),
+      'precision': 'double'|'single'
     :returns: componentimage, residual
     """
     log_parameters(params)
     algorithm = get_parameter(params, 'algorithm', 'msclean')
+    cdtype, fdtype = get_precision(params)
     if algorithm == 'msclean':
 
         window = get_parameter(params, 'window', None)
@@ -45,14 +49,15 @@ def deconvolve_cube(dirty: Image, psf: Image, params={}):
         fracthresh = get_parameter(params, 'fracthresh', 0.01)
         assert 0.0 < fracthresh < 1.0
 
-        comp_array = numpy.zeros(dirty.data.shape)
-        residual_array = numpy.zeros(dirty.data.shape)
+        comp_array = numpy.zeros(dirty.data.shape, dtype=fdtype)
+        residual_array = numpy.zeros(dirty.data.shape, dtype=fdtype)
         for channel in range(dirty.data.shape[0]):
             for pol in range(dirty.data.shape[1]):
                 if psf.data[channel, pol, :, :].max():
                     log.debug("deconvolve_cube: Processing pol %d, channel %d" % (pol, channel))
                     comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
-                       msclean(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
+                       msclean(dirty.data[channel, pol, :, :].astype(fdtype),
+                               psf.data[channel, pol, :, :].astype(fdtype),
                                 window, gain, thresh, niter, scales, fracthresh)
                 else:
                     log.debug("deconvolve_cube: Skipping pol %d, channel %d" % (pol, channel))
@@ -68,14 +73,15 @@ def deconvolve_cube(dirty: Image, psf: Image, params={}):
         fracthresh = get_parameter(params, 'fracthresh', 0.01)
         assert 0.0 < fracthresh < 1.0
 
-        comp_array = numpy.zeros(dirty.data.shape)
-        residual_array = numpy.zeros(dirty.data.shape)
+        comp_array = numpy.zeros(dirty.data.shape, dtype=fdtype)
+        residual_array = numpy.zeros(dirty.data.shape, dtype=fdtype)
         for channel in range(dirty.data.shape[0]):
             for pol in range(dirty.data.shape[1]):
                 if psf.data[channel, pol, :, :].max():
                     log.debug("deconvolve_cube: Processing pol %d, channel %d" % (pol, channel))
                     comp_array[channel, pol, :, :], residual_array[channel, pol, :, :] = \
-                        hogbom(dirty.data[channel, pol, :, :], psf.data[channel, pol, :, :],
+                        hogbom(dirty.data[channel, pol, :, :].astype(fdtype),
+                               psf.data[channel, pol, :, :].astype(fdtype),
                                window, gain, thresh, niter)
                 else:
                     log.debug("deconvolve_cube: Skipping pol %d, channel %d" % (pol, channel))
@@ -207,7 +213,7 @@ def hogbom(dirty,
     assert 0.0 < gain < 2.0
     assert niter > 0
 
-    comps = numpy.zeros(dirty.shape)
+    comps = numpy.zeros(dirty.shape, dtype=dirty.dtype)
     res = numpy.array(dirty)
     pmax = psf.max()
     assert pmax > 0.0
@@ -260,7 +266,7 @@ def msclean(dirty,
     assert niter > 0
     assert len(scales) > 0
     
-    comps = numpy.zeros(dirty.shape)
+    comps = numpy.zeros(dirty.shape, dtype=dirty.dtype)
     
     pmax = psf.max()
     assert pmax > 0.0
@@ -280,13 +286,13 @@ def msclean(dirty,
     
     scaleshape = [ldirty.shape[0], ldirty.shape[1], len(scales)]
     scalescaleshape = [ldirty.shape[0], ldirty.shape[1], len(scales), len(scales)]
-    scalestack = createscalestack(scaleshape, scales, norm=True)
+    scalestack = createscalestack(scaleshape, scales, norm=True, dtype=dirty.dtype)
     
     couplingMatrix = numpy.zeros([len(scales), len(scales)])
     psfscalestack = convolvescalestack(scalestack, numpy.array(lpsf))
     resscalestack = convolvescalestack(scalestack, numpy.array(ldirty))
     # Evaluate the coupling matrix between the various scale sizes.
-    psfscalescalestack = numpy.zeros(scalescaleshape)
+    psfscalescalestack = numpy.zeros(scalescaleshape, dtype=dirty.dtype)
     for iscale in numpy.arange(len(scales)):
         psfscalescalestack[:, :, :, iscale] = convolvescalestack(scalestack, psfscalestack[:, :, iscale])
         psfscalescalestack[:, :, iscale, :] = psfscalescalestack[:, :, :, iscale]
@@ -344,17 +350,18 @@ def msclean(dirty,
     return comps, pmax * resscalestack[:, :, 0]
 
 
-def createscalestack(scaleshape, scales, norm=True):
+def createscalestack(scaleshape, scales, norm=True, dtype=float):
     """ Create a cube consisting of the scales
 
     :param scaleshape: desired shape of stack
     :param scales: scales (in pixels)
     :param norm: Normalise each plane to unity?
+    :param dtype: Type of the stack
     :returns: stack
     """
     assert scaleshape[2] == len(scales)
     
-    basis = numpy.zeros(scaleshape)
+    basis = numpy.zeros(scaleshape, dtype=dtype)
     nx = scaleshape[0]
     ny = scaleshape[1]
     xcen = int(numpy.ceil(float(nx) / 2.0))
@@ -389,14 +396,15 @@ def convolvescalestack(scalestack, img):
     :returns: stack
     """
     
-    convolved = numpy.zeros(scalestack.shape)
-    ximg = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(img)))
+    convolved = numpy.zeros(scalestack.shape, dtype=scalestack.dtype)
+    # Circular convolution with the scale moved to the origin, which is
+    # a phase ramp on the transform, applied once to the image
+    ximg = rfft2(img) * numpy.conj(rfft_shift_phases(img.shape))
     
     nscales = scalestack.shape[2]
     for iscale in range(nscales):
-        xscale = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(scalestack[:, :, iscale])))
-        xmult = ximg * xscale
-        convolved[:, :, iscale] = numpy.real(numpy.fft.ifftshift(numpy.fft.ifft2(numpy.fft.ifftshift(xmult))))
+        xscale = rfft2(scalestack[:, :, iscale])
+        convolved[:, :, iscale] = irfft2(ximg * xscale, img.shape)
     return convolved
 
 
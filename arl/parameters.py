@@ -6,6 +6,8 @@
 import sys
 import os
 
+import numpy
+
 import logging
 log = logging.getLogger( "arl.parameters" )
 
@@ -34,6 +36,22 @@ def get_parameter(params, key, default=None):
         value = params[key]
     return value
 
+def get_precision(params):
+    """ Get the numeric types for the 'precision' parameter
+
+    'double' (default) gives 128 bit complex and 64 bit real values,
+    'single' gives 64 bit complex and 32 bit real values.
+
+    :param params: Parameter dictionary
+    :return: (complex type, real type)
+    """
+    precision = get_parameter(params, 'precision', 'double')
+    if precision == 'double':
+        return numpy.complex128, numpy.float64
+    elif precision == 'single':
+        return numpy.complex64, numpy.float32
+    raise ValueError("Unknown precision %s" % precision)
+
 def import_parameters(paramsfile):
     """Import parameters from a text file
     
@@ -4,6 +4,8 @@
 # subclasses of astropy classes.
 #
 
+import copy
+
 import numpy
 
 from astropy.coordinates import SkyCoord
@@ -11,7 +13,8 @@ from astropy.wcs.utils import skycoord_to_pixel, pixel_to_skycoord
 
 from arl.image_operations import import_image_from_fits
 from arl.visibility_operations import combine_visibility
-from arl.fourier_transforms import predict_visibility, invert_visibility
+from arl.fourier_transforms import predict_visibility, invert_visibility, weight_visibility
+from arl.synthesis_support import shared_kernel_cache
 from arl.data_models import *
 from arl.parameters import *
 
@@ -177,6 +180,10 @@ def solve_skymodel(vis: Visibility, sm: SkyModel, deconvolver, params={}):
     nmajor = get_parameter(params, 'nmajor', 5)
     log.debug("solve_combinations.solve_skymodel: Performing %d major cycles" % nmajor)
     
+    # Weight once, the residuals of all major cycles keep these imaging weights
+    if vis.imaging_weight is None:
+        vis = weight_visibility(copy.copy(vis), None, params=params)
+
     # The model is added to each major cycle and then the visibilities are
     # calculated from the full model
     vispred = predict_visibility(vis, sm, params={})
@@ -196,7 +203,7 @@ def solve_skymodel(vis: Visibility, sm: SkyModel, deconvolver, params={}):
             log.debug("Reached stopping threshold %.6f Jy" % thresh)
             break
         log.debug("solve_skymodel: End of major cycle")
-    log.debug("solve_skymodel: End of major cycles")
+    log.debug("solve_skymodel: End of major cycles, w-kernel cache %s" % shared_kernel_cache.stats())
     return visres, sm
 
 def solve_skymodel_gains(vis: Visibility, sm: SkyModel, deconvolver, params={}):
@@ -29,10 +29,33 @@ This is implemented for reference in
 
 from __future__ import division
 
+import collections
+import functools
+import hashlib
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy
 import pylru
 import scipy.special
 
+from crocodile.fft_backend import centred_fft2, centred_ifft2, irfft2, rfft_shift_phases
+from crocodile.synthesis import prolate_taper, returns_image
+
+# Memory budget (in bytes) for the temporary arrays of a single batch of
+# visibilities in the vectorised (de)gridding functions
+GRID_BATCH_BYTES = 64 * 1024 * 1024
+
+# Size (in grid cells) of the grid tiles used for ordering visibilities
+TILE_SIZE = 32
+
+# Default memory budget (in bytes) of the process-wide w-kernel cache
+KERNEL_CACHE_BYTES = 256 * 1024 * 1024
+
 
 def ceil2(x):
     """Find next greater power of 2
@@ -83,7 +106,7 @@ def fft(a):
     :param a: image in `lm` coordinate space
     :returns: `uv` grid
     """
-    return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a)))
+    return centred_fft2(a)
 
 
 def ifft(a):
@@ -92,7 +115,42 @@ def ifft(a):
     :param a: `uv` grid to transform
     :returns: an image in `lm` coordinate space
     """
-    return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a)))
+    return centred_ifft2(a)
+
+
+def hermitian_ifft(a):
+    """ Real image of a `uv` grid made Hermitian
+
+    Treats the grid as if every visibility had also been gridded at
+    its conjugate position, i.e. transforms `a(u) + conj(a(-u))`. Only
+    the half-plane needed by a complex-to-real FFT is formed, so this
+    is the same as `2 * numpy.real(ifft(a))` at half the FFT cost.
+
+    :param a: `uv` grid to transform
+    :returns: a real image in `lm` coordinate space
+    """
+    Ny, Nx = a.shape[-2:]
+    # Frequency k is at index (k + N//2) % N, which saves the ifftshift
+    ky = numpy.arange(Ny)
+    kx = numpy.arange(Nx // 2 + 1)
+    rows, cols = (ky + Ny // 2) % Ny, (kx + Nx // 2) % Nx
+    mrows, mcols = (Ny // 2 - ky) % Ny, (Nx // 2 - kx) % Nx
+    half = a[..., rows[:, None], cols] + numpy.conj(a[..., mrows[:, None], mcols])
+    # The fftshift of the image is a phase ramp in uv, for even sizes a checkerboard
+    half *= rfft_shift_phases((Ny, Nx), numpy.finfo(half.dtype).dtype)
+    return irfft2(half, (Ny, Nx))
+
+
+def hermitian_image(imgfn, c):
+    """Real image of the result of an imaging function
+
+    :param imgfn: Imaging function that produced `c`
+    :param c: `uv` grid, or image if `returns_image(imgfn)`
+    :returns: `hermitian_ifft(c)`, or the same for an image
+    """
+    if returns_image(imgfn):
+        return 2 * numpy.real(c)
+    return hermitian_ifft(c)
 
 
 def pad_mid(ff, N):
@@ -103,16 +161,17 @@ def pad_mid(ff, N):
     original field's size, which is equivalent to a convolution with a
     sinc pattern in the uv-grid.
 
-    :param ff: The input far field. Should be smaller than NxN.
+    :param ff: The input far field. Should be smaller than NxN. Leading
+      dimensions are treated as a stack of far fields.
     :param N:  The desired far field size
 
     """
 
-    N0, N0w = ff.shape
+    N0, N0w = ff.shape[-2:]
     if N == N0: return ff
     assert N > N0 and N0 == N0w
     return numpy.pad(ff,
-                     pad_width=2*[(N//2-N0//2, (N+1)//2-(N0+1)//2)],
+                     pad_width=(ff.ndim-2)*[(0, 0)] + 2*[(N//2-N0//2, (N+1)//2-(N0+1)//2)],
                      mode='constant',
                      constant_values=0.0)
 
@@ -189,14 +248,15 @@ def w_kernel_function(N, theta, w):
 
     :param N: Size of the grid in pixels
     :param theta: Field of view
-    :param w: Baseline distance to the projection plane
+    :param w: Baseline distance to the projection plane. If an array
+      is passed, one far field is returned per w value.
     :returns: N x N array with the far field
     """
 
     m, l = coordinates2(N) * theta
     r2 = l**2 + m**2
     assert numpy.all(r2 < 1.0), "Error in image coordinate system: theta %f, N %f,l %s, m %s" % (theta, N, l, m)
-    ph = w * (1 - numpy.sqrt(1.0 - r2))
+    ph = numpy.multiply.outer(w, 1 - numpy.sqrt(1.0 - r2))
     cp = numpy.exp(2j * numpy.pi * ph)
     return cp
 
@@ -208,11 +268,12 @@ def kernel_oversample(ff, N, Qpx, s):
     If the far field size is smaller than N*Qpx, we will pad it. This
     essentially means we apply a sinc anti-aliasing kernel by default.
 
-    :param ff: Far field pattern
+    :param ff: Far field pattern. Leading dimensions are treated as a
+      stack of far fields, transformed together.
     :param N:  Image size without oversampling
     :param Qpx: Factor to oversample by -- there will be Qpx x Qpx convolution arl
     :param s: Size of convolution function to extract
-    :returns: Numpy array of shape [ov, ou, v, u], e.g. with sub-pixel
+    :returns: Numpy array of shape [..., ov, ou, v, u], e.g. with sub-pixel
       offsets as the outer coordinates.
     """
 
@@ -222,12 +283,20 @@ def kernel_oversample(ff, N, Qpx, s):
     # Obtain oversampled uv-grid
     af = ifft(padff)
 
-    # Extract kernels
-    res = [[extract_oversampled(af, x, y, Qpx, s) for x in range(Qpx)] for y in range(Qpx)]
-    return numpy.array(res)
+    # Extract kernels. This does the same as extract_oversampled
+    # for all offsets at once: Pixel (Qpx*i + Qpx-1-yf) of the block
+    # below belongs to kernel row i at offset yf.
+    Na = af.shape[-1]
+    m0 = Na//2 - Qpx*(s//2) - (Qpx-1)
+    assert m0 >= 0
+    mid = af[..., m0:m0+Qpx*s, m0:m0+Qpx*s]
+    mid = mid.reshape(af.shape[:-2] + (s, Qpx, s, Qpx))[..., ::-1, :, ::-1]
+    nd = af.ndim - 2
+    axes = tuple(range(nd)) + (nd+1, nd+3, nd, nd+2)
+    return Qpx * Qpx * numpy.transpose(mid, axes)
 
 
-def w_kernel(theta, w, NpixFF, NpixKern, Qpx):
+def w_kernel(theta, w, NpixFF, NpixKern, Qpx, dtype=complex):
     """
     The middle s pixels of W convolution kernel. (W-KERNel-Aperture-Function)
 
@@ -237,41 +306,122 @@ def w_kernel(theta, w, NpixFF, NpixKern, Qpx):
     :param NpixKern: Size of convolution function to extract
     :param Qpx: Oversampling, pixels will be Qpx smaller in aperture
       plane than required to minimially sample theta.
+    :param dtype: Type of the returned kernels, e.g. `numpy.complex64`
 
     :returns: [Qpx,Qpx,s,s] shaped oversampled convolution kernels
     """
     assert NpixFF > NpixKern or (NpixFF == NpixKern and Qpx == 1)
-    return kernel_oversample(w_kernel_function(NpixFF, theta, w), NpixFF, Qpx, NpixKern)
+    kern = kernel_oversample(w_kernel_function(NpixFF, theta, w), NpixFF, Qpx, NpixKern)
+    return kern.astype(dtype, copy=False)
+
+
+def w_kernels(theta, ws, NpixFF, NpixKern, Qpx, dtype=complex, max_batch_bytes=GRID_BATCH_BYTES):
+    """W convolution kernels for many w values at once
+
+    Same as calling `w_kernel` for every w, but the far fields of a
+    batch of w values get transformed using one FFT call.
+
+    :param theta: Field of view (directional cosines)
+    :param ws: Baseline distances to the projection plane
+    :param NpixFF: Far field size. Must be at least NpixKern+1 if Qpx > 1, otherwise NpixKern.
+    :param NpixKern: Size of convolution function to extract
+    :param Qpx: Oversampling, pixels will be Qpx smaller in aperture
+      plane than required to minimially sample theta.
+    :param dtype: Type of the returned kernels, e.g. `numpy.complex64`
+    :param max_batch_bytes: Memory budget for the padded far fields of a batch
+    :returns: [len(ws),Qpx,Qpx,s,s] shaped oversampled convolution kernels
+    """
+    assert NpixFF > NpixKern or (NpixFF == NpixKern and Qpx == 1)
+    ws = numpy.asarray(ws, dtype=float)
+    nbatch = max(1, max_batch_bytes // (16 * (NpixFF * Qpx) ** 2))
+    kernels = numpy.empty((len(ws), Qpx, Qpx, NpixKern, NpixKern), dtype=dtype)
+    for b in range(0, len(ws), nbatch):
+        ff = w_kernel_function(NpixFF, theta, ws[b:b+nbatch])
+        kernels[b:b+nbatch] = kernel_oversample(ff, NpixFF, Qpx, NpixKern)
+    return kernels
+
+
+def kernel_support(kern, tolerance):
+    """Smallest support holding all but a fraction of a kernel's energy
+
+    Supports have the same parity as the kernel size, so truncated
+    kernels stay centred on the same pixel.
+
+    :param kern: [...,Qpx,Qpx,s,s] oversampled convolution kernels
+    :param tolerance: Fraction of the energy that may get lost
+    :returns: Support for every kernel, shape [...]
+    """
+    s = kern.shape[-1]
+    energy = numpy.sum(numpy.abs(kern)**2, axis=(-4, -3))
+    total = numpy.sum(energy, axis=(-2, -1))
+    support = numpy.full(total.shape, s)
+    for t in range(s - 2, 0, -2):
+        inner = numpy.sum(energy[..., s//2-t//2:s//2-t//2+t, s//2-t//2:s//2-t//2+t], axis=(-2, -1))
+        support[inner >= (1 - tolerance) * total] = t
+    return support
+
+
+def truncate_kernel(kern, support):
+    """Extract the middle `support` pixels of oversampled kernels
+
+    :param kern: [...,Qpx,Qpx,s,s] oversampled convolution kernels
+    :param support: New kernel size, same parity as s
+    :returns: [...,Qpx,Qpx,support,support] oversampled convolution kernels
+    """
+    s = kern.shape[-1]
+    assert support <= s and (s - support) % 2 == 0
+    m0 = s//2 - support//2
+    return kern[..., m0:m0+support, m0:m0+support]
+
+
+def truncated_w_kernel(theta, w, NpixFF, NpixKern, Qpx, tolerance=1e-3, dtype=complex):
+    """W convolution kernel with support depending on w
+
+    The kernel gets generated with size `NpixKern`, then truncated to
+    the smallest support keeping all but `tolerance` of its energy
+    (see `kernel_support`). Kernels near w=0 end up much smaller than
+    `NpixKern`, which saves (de)gridding work.
+
+    :param theta: Field of view (directional cosines)
+    :param w: Baseline distance to the projection plane
+    :param NpixFF: Far field size. Must be at least NpixKern+1 if Qpx > 1, otherwise NpixKern.
+    :param NpixKern: Maximum size of convolution function
+    :param Qpx: Oversampling
+    :param tolerance: Fraction of the kernel energy that may get lost
+    :param dtype: Type of the returned kernels, e.g. `numpy.complex64`
+    :returns: [Qpx,Qpx,s,s] shaped oversampled convolution kernels, s <= NpixKern
+    """
+    kern = w_kernel(theta, w, NpixFF, NpixKern, Qpx, dtype)
+    return truncate_kernel(kern, kernel_support(kern, tolerance))
 
 
-def nearest_neighbour_grid(a, p, v):
+def nearest_neighbour_grid(a, p, v, scale=1.0):
     """Grid visibilities (v) at positions (p) into (a) without convolution
 
-    :param a:   The uv plane to grid to (updated in-place!)
+    :param a:   The uv plane to grid to (updated in-place!), or a stack
+      of uv planes, see `grid_shape`
     :param p:   The coordinates to grid to (in fraction [-.5,.5[ of grid)
     :param v:   Visibilities to grid
+    :param scale: Factor to apply to `p` first
     """
-    assert numpy.max(p) < 0.5
-
-    N = a.shape[0]
-    xy = N//2 + numpy.floor(0.5 + N * p[:,0:2]).astype(int)
-    for (x, y), v in zip(xy, v):
-        a[y, x] += v
+    N = a.shape[-2]
+    xy = N//2 + numpy.floor(0.5 + (N * scale) * p[:,0:2]).astype(int)
+    assert (xy < N).all()
+    scatter_add(a, xy[:,1] * a.shape[-1] + xy[:,0], numpy.asarray(v))
 
 
-def nearest_neighbour_degrid(a, p):
+def nearest_neighbour_degrid(a, p, scale=1.0):
     """DeGrid visibilities (v) at positions (p) from (a) without convolution
 
     :param a:   The uv plane to de-grid from
     :param p:   The coordinates to degrid at (in fraction of grid)
+    :param scale: Factor to apply to `p` first
     :returns: Array of visibilities.
     """
-    assert numpy.max(p) < 0.5
-
     N = a.shape[0]
-    xy = N//2 + numpy.floor(0.5 + p[:,0:2] * N).astype(int)
-    v = [ a[y,x] for x,y in xy ]
-    return numpy.array(v)
+    xy = N//2 + numpy.floor(0.5 + p[:,0:2] * (N * scale)).astype(int)
+    assert (xy < N).all()
+    return a[xy[:,1], xy[:,0]]
 
 
 def frac_coord(N, Qpx, p):
@@ -294,89 +444,481 @@ def frac_coord(N, Qpx, p):
     return flx.astype(int), fracx.astype(int)
 
 
-def frac_coords(shape, Qpx, p):
+def frac_coords(shape, Qpx, p, scale=1.0):
     """Compute grid coordinates and fractional values for convolutional
     gridding
 
+    The scale factor gets applied per coordinate, so that for example
+    uvw in metres can be passed with a scale of frequency over speed of
+    light times grid size, without making a scaled copy of `p`.
+
     :param shape: (height,width) grid shape
     :param Qpx: Oversampling factor
-    :param p: array of (x,y) coordinates in range [-.5,.5[
+    :param p: array of (x,y) coordinates, after scaling in range [-.5,.5[
+    :param scale: Factor to apply to `p` first
     """
     h, w = shape # NB order (height,width) to match numpy!
-    x, xf = frac_coord(w, Qpx, p[:,0])
-    y, yf = frac_coord(h, Qpx, p[:,1])
+    x, xf = frac_coord(w, Qpx, p[:,0] * scale)
+    y, yf = frac_coord(h, Qpx, p[:,1] * scale)
     return x,xf, y,yf
 
 
-def convolutional_grid(gcf, a, p, v):
+def footprint_indices(shape, gh, gw, x, y):
+    """Flat grid indices of convolution kernel footprints
+
+    The footprint of a (gh, gw) kernel centred at (x, y) covers the
+    grid cells `[y-gh//2 : y+(gh+1)//2, x-gw//2 : x+(gw+1)//2]`, the
+    same cells `convgrid` updated using slices.
+
+    :param shape: (height,width) grid shape
+    :param gh: Kernel height
+    :param gw: Kernel width
+    :param x: Horizontal grid coordinates of kernel centres
+    :param y: Vertical grid coordinates of kernel centres
+    :returns: [len(x), gh, gw] array of indices into the flattened grid
+    """
+    h, w = shape
+    assert len(x) == 0 or (numpy.min(x) >= gw//2 and numpy.max(x) + (gw+1)//2 <= w and
+                           numpy.min(y) >= gh//2 and numpy.max(y) + (gh+1)//2 <= h), \
+        "Kernel footprint outside of grid"
+    dy = numpy.arange(gh) - gh//2
+    dx = numpy.arange(gw) - gw//2
+    return (y[:, None, None] + dy[None, :, None]) * w + (x[:, None, None] + dx[None, None, :])
+
+
+def offset_groups(Qpx, xf, yf):
+    """Group visibilities by oversampling offset
+
+    :param Qpx: Oversampling factor
+    :param xf: Horizontal fractional offsets (see `frac_coords`)
+    :param yf: Vertical fractional offsets (see `frac_coords`)
+    :returns: List of (xf, yf, indices) triples, one per offset in use
+    """
+    key = yf * Qpx + xf
+    order = numpy.argsort(key, kind='stable')
+    skey = key[order]
+    bounds = numpy.hstack([[0], numpy.flatnonzero(numpy.diff(skey)) + 1, [len(skey)]])
+    return [ (skey[i0] % Qpx, skey[i0] // Qpx, order[i0:i1])
+             for i0, i1 in zip(bounds[:-1], bounds[1:]) if i1 > i0 ]
+
+
+def batch_size(gh, gw, max_batch_bytes, itemsize=32):
+    """Number of visibilities that can be processed in one batch
+
+    :param gh: Kernel height
+    :param gw: Kernel width
+    :param max_batch_bytes: Memory budget for temporary arrays
+    :param itemsize: Bytes of temporaries needed per footprint pixel
+    """
+    return max(1, int(max_batch_bytes // (gh * gw * itemsize)))
+
+
+def grid_shape(N, v):
+    """Shape of the grid for visibilities
+
+    Visibility values can be passed as a `[nvis, nrhs]` array, for
+    example to grid an image and its point spread function in one
+    go. Coordinates, kernels and grid indices are then computed once
+    for all value vectors, and the result is a stack of `nrhs` grids.
+
+    :param N: Grid size
+    :param v: Visibility values, `[nvis]` or `[nvis, nrhs]`
+    :returns: `(N, N)` or `(nrhs, N, N)`
+    """
+    return tuple(numpy.shape(v)[1:]) + (N, N)
+
+
+def grid_dtype(*arrays):
+    """Complex type for grids and visibilities computed from arrays
+
+    Single precision is used only if all inputs are single precision.
+
+    :param arrays: Input arrays, e.g. visibilities and kernels
+    :returns: `numpy.complex64` or `numpy.complex128`
+    """
+    return numpy.result_type(numpy.complex64, *arrays)
+
+
+def scatter_add(a, idx, vals):
+    """Accumulate values at flat grid indices
+
+    Duplicate indices are summed. Uses `bincount` over the range of
+    grid cells actually touched, separately for real and imaginary
+    parts. `bincount` sums in double precision, so single precision
+    grids only get rounded once per batch.
+
+    :param a: Grid to add to (updated in-place!)
+    :param idx: Indices into the flattened grid
+    :param vals: Values to add, same shape as `idx`. For a stack of
+      grids, an extra last axis selects the grid to add to.
+    """
+    if numpy.ndim(vals) > numpy.ndim(idx):
+        for i in range(vals.shape[-1]):
+            scatter_add(a[i], idx, vals[..., i])
+        return
+    idx = idx.ravel()
+    vals = vals.ravel()
+    if len(idx) == 0:
+        return
+    if not a.flags.c_contiguous:
+        numpy.add.at(a, numpy.unravel_index(idx, a.shape), vals)
+        return
+    lo = numpy.min(idx)
+    n = numpy.max(idx) + 1 - lo
+    flat = a.reshape(-1)[lo:lo+n]
+    idx = idx - lo
+    if numpy.iscomplexobj(flat):
+        flat.real += numpy.bincount(idx, numpy.real(vals), n)
+        flat.imag += numpy.bincount(idx, numpy.imag(vals), n)
+    else:
+        flat += numpy.bincount(idx, vals, n)
+
+
+def convolutional_grid(gcf, a, p, v, max_batch_bytes=GRID_BATCH_BYTES, scale=1.0):
     """Grid after convolving with gcf
 
     Takes into account fractional `uv` coordinate values where the GCF
-    is oversampled
+    is oversampled. Visibilities are grouped by oversampling offset,
+    so all visibilities of a group share the same kernel, and whole
+    groups are added to the grid at once using `scatter_add`.
 
-    :param a: Grid to add to
+    :param a: Grid to add to, or a stack of grids (see `grid_shape`)
     :param p: UVW positions
-    :param v: Visibility values
+    :param v: Visibility values, `[nvis]` or `[nvis, nrhs]`
     :param gcf: Oversampled convolution kernel
+    :param max_batch_bytes: Memory budget for the temporary arrays of
+      one batch of visibilities
+    :param scale: Factor to apply to `p` first, see `frac_coords`
     """
 
     Qpx, _, gh, gw = gcf.shape
-    coords = frac_coords(a.shape, Qpx, p)
-    for v, x,xf, y,yf in zip(v, *coords):
-        a[y-gh//2 : y+(gh+1)//2,
-          x-gw//2 : x+(gw+1)//2] += gcf[yf,xf] * v
+    x, xf, y, yf = frac_coords(a.shape[-2:], Qpx, p, scale)
+    v = numpy.asarray(v)
+    nrhs = v.shape[1] if v.ndim > 1 else 1
+    step = batch_size(gh, gw, max_batch_bytes, 32 * nrhs)
+    for gxf, gyf, ixs in offset_groups(Qpx, xf, yf):
+        kern = gcf[gyf, gxf].reshape((1, gh, gw) + (v.ndim - 1) * (1,))
+        for i in range(0, len(ixs), step):
+            bixs = ixs[i:i+step]
+            idx = footprint_indices(a.shape[-2:], gh, gw, x[bixs], y[bixs])
+            scatter_add(a, idx, v[bixs, None, None] * kern)
+
+
+def gather(a, idx):
+    """Read grid values at flat grid indices
+
+    :param a: Grid to read from
+    :param idx: Indices into the flattened grid
+    :returns: Array of grid values, same shape as `idx`
+    """
+    if a.flags.c_contiguous:
+        return a.reshape(-1)[idx]
+    return a[numpy.unravel_index(idx, a.shape)]
 
 
-def convolutional_degrid(gcf, a, p):
+def convolutional_degrid(gcf, a, p, max_batch_bytes=GRID_BATCH_BYTES, scale=1.0):
     """Convolutional degridding
 
     Takes into account fractional `uv` coordinate values where the GCF
-    is oversampled
+    is oversampled. Visibilities are processed in blocks: the kernel
+    footprints of a block are gathered from the grid in one indexing
+    operation and reduced against the matching kernels using `einsum`.
 
     :param gcf: Oversampled convolution kernel
     :param a:   The uv plane to de-grid from
     :param p:   The coordinates to degrid at.
+    :param max_batch_bytes: Memory budget for the temporary arrays of
+      one block of visibilities
+    :param scale: Factor to apply to `p` first, see `frac_coords`
     :returns: Array of visibilities.
     """
     Qpx, _, gh, gw = gcf.shape
-    coords = frac_coords(a.shape, Qpx, p)
-    vis = [
-        numpy.sum(a[y-gh//2 : y+(gh+1)//2,
-                    x-gw//2 : x+(gw+1)//2] * gcf[yf,xf])
-        for x,xf, y,yf in zip(*coords)
-    ]
-    return numpy.array(vis)
+    x, xf, y, yf = frac_coords(a.shape, Qpx, p, scale)
+    vis = numpy.empty(len(x), dtype=numpy.result_type(a, gcf))
+    step = batch_size(gh, gw, max_batch_bytes, itemsize=40)
+    for i in range(0, len(x), step):
+        b = slice(i, i+step)
+        idx = footprint_indices(a.shape, gh, gw, x[b], y[b])
+        vis[b] = numpy.einsum('ijk,ijk->i', gather(a, idx), gcf[yf[b], xf[b]])
+    return vis
+
+
+def sort_vis_w(p, v=None):
+    """Sort visibilities on the w value.
+    :param p: uvw coordinates
+    :param v: Visibility values (optional)
+    """
+    zs = numpy.argsort(p[:, 2])
+    if v is not None:
+        return p[zs], v[zs]
+    else:
+        return p[zs]
+
+
+def slice_vis(step, p, v=None):
+    """ Slice visibilities into a number of chunks.
+
+    :param step: Maximum chunk size
+    :param p: uvw coordinates
+    :param v: Visibility values (optional)
+    :returns: List of visibility chunk (pairs)
+    """
+    nv = len(p)
+    ii = range(0, nv, step)
+    if v is None:
+        return [ p[i:i+step] for i in ii ]
+    else:
+        return [ (p[i:i+step], v[i:i+step]) for i in ii ]
+
+
+def bin_vis_w(wstep, p, v=None, scale=1.0):
+    """ Bin visibilities by w value.
+
+    Visibilities are split into bins of width `wstep` centred on
+    multiples of `wstep`, so that every visibility of a bin is
+    (de)gridded with the same w-kernel. Within a bin visibilities keep
+    their order, see `tile_order`.
+
+    :param wstep: Size of w-bins
+    :param p: uvw coordinates
+    :param v: Visibility values (optional)
+    :param scale: Factor to apply to `p` first. Bin centres are scaled, the returned uvw are not.
+    :returns: List of (w-bin centre, uvw) or (w-bin centre, uvw, visibility) triples
+    """
+    wbins = numpy.round(p[:, 2] * (scale / wstep))
+    zs = numpy.argsort(wbins, kind='stable')
+    wbins = wbins[zs]
+    bounds = numpy.hstack([[0], numpy.flatnonzero(numpy.diff(wbins)) + 1, [len(zs)]])
+    res = []
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        if i1 == i0:
+            continue
+        ixs = zs[i0:i1]
+        if v is None:
+            res.append((wstep * wbins[i0], p[ixs]))
+        else:
+            res.append((wstep * wbins[i0], p[ixs], v[ixs]))
+    return res
+
+
+def tile_order(theta, lam, p, wstep, Qpx=1, tile=TILE_SIZE, scale=1.0):
+    """Permutation sorting visibilities by w-bin, grid tile and oversampling offset
+
+    Visibilities gridded one after another then update nearby grid
+    cells, which makes much better use of the CPU caches than
+    visibilities in random order. As (de)gridding functions keep the
+    order of visibilities within w-bins and oversampling groups, it is
+    enough to pass them visibilities in this order.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param wstep: Size of w-bins
+    :param Qpx: Oversampling factor of the kernels
+    :param tile: Width of grid tiles (cells)
+    :param scale: Factor to apply to `p` first
+    :returns: Permutation of visibilities
+    """
+    N = int(round(theta * lam))
+    x, xf, y, yf = frac_coords((N, N), Qpx, p, scale / lam)
+    ntiles = (N + tile - 1) // tile
+    return numpy.lexsort((yf * Qpx + xf, (y // tile) * ntiles + x // tile,
+                          numpy.round(p[:, 2] * (scale / wstep))))
+
 
+tile_orders = pylru.lrucache(16)
+tile_orders_lock = threading.Lock()
 
-def doweight(theta, lam, p, v):
+
+def cached_tile_order(key, theta, lam, p, wstep, Qpx=1, tile=TILE_SIZE, scale=1.0):
+    """Cached `tile_order` for an observation
+
+    The permutation is computed once and then reused, for example for
+    all channels, polarisations and major cycles. For other channels
+    than the first it is not exact, but then only the ordering and not
+    the result of gridding is affected.
+
+    :param key: Array identifying the observation, e.g. its uvw
+      coordinates in metres. Must not be modified in-place.
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param wstep: Size of w-bins
+    :param Qpx: Oversampling factor of the kernels
+    :param tile: Width of grid tiles (cells)
+    :param scale: Factor to apply to `p` first
+    :returns: Permutation of visibilities
+    """
+    key = numpy.asarray(key)
+    # Grids derived from different parameters can differ by rounding,
+    # which would only affect the ordering
+    ckey = (key.__array_interface__['data'][0], key.shape, key.strides,
+            int(round(theta * lam)), '%.6g' % lam, float(wstep), Qpx, tile)
+    with tile_orders_lock:
+        if ckey in tile_orders:
+            # Holding on to the key array means its memory cannot get reused
+            return tile_orders[ckey][1]
+    order = tile_order(theta, lam, p, wstep, Qpx, tile, scale)
+    with tile_orders_lock:
+        tile_orders[ckey] = (key, order)
+    return order
+
+
+def grid_density(theta, lam, p, scale=1.0, weights=None):
+    """Number of visibilities falling into every grid cell
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param scale: Factor to apply to `p` first. Use a negative
+      scale to count the conjugate visibilities.
+    :param weights: Sum these per cell instead of counting visibilities
+    :returns: Density grid, as used by `doweight`
+    """
+    N = int(round(theta * lam))
+    assert N > 1
+    x, xf, y, yf = frac_coords((N, N), 1, p, scale / lam)
+    return numpy.bincount(y * N + x, weights=weights, minlength=N*N).reshape(N, N).astype(float)
+
+
+def density_weight(theta, lam, p, wt, density, robustness=None, scale=1.0):
+    """Uniform or robust (Briggs) weights from a gridded weight density
+
+    Uniform weighting divides every weight by the density `D` of its
+    grid cell. Robust weighting divides by `1 + f**2 D` instead, with
+    `f**2 = (5 * 10**-robustness)**2 / (sum(D**2) / sum(D))`, which
+    goes towards natural weighting for large and towards uniform
+    weighting for small robustness.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param wt: Natural weights of the visibilities
+    :param density: Gridded weights from `grid_density`, including conjugates
+    :param robustness: Briggs robustness, `None` for uniform weighting
+    :param scale: Factor to apply to `p` first
+    :returns: Imaging weights
+    """
+    N = int(round(theta * lam))
+    assert density.shape == (N, N)
+    x, xf, y, yf = frac_coords((N, N), 1, p, scale / lam)
+    d = density.reshape(-1)[y * N + x]
+    wt = numpy.asarray(wt, dtype=float)
+    if robustness is None:
+        return numpy.divide(wt, d, out=numpy.zeros_like(wt), where=d > 0)
+    f2 = (5.0 * 10.0 ** -robustness) ** 2 / (numpy.sum(density ** 2) / numpy.sum(density))
+    return wt / (1.0 + f2 * d)
+
+
+def doweight(theta, lam, p, v, density=None, return_density=False, scale=1.0):
     """Re-weight visibilities
 
+    Divides every visibility by the number of visibilities falling
+    into the same grid cell (uniform weighting).
+
     Note that as is usual, convolution kernels are not taken into account
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param v: Visibility values
+    :param density: Gridded visibility density from an earlier call
+      with the same `p`. Computed if not passed.
+    :param return_density: Also return the density grid?
+    :param scale: Factor to apply to `p` first
+    :returns: Re-weighted visibilities, or pair of visibilities and
+      density grid if `return_density` is set
     """
     N = int(round(theta * lam))
     assert N > 1
-    gw = numpy.zeros([N, N])
-    x, xf, y, yf = frac_coords(gw.shape, 1, p / lam)
-    for i in range(len(x)):
-        gw[x[i], y[i]] += 1
-    v = v.copy()
-    for i in range(len(x)):
-        v[i] /= gw[x[i], y[i]]
+    x, xf, y, yf = frac_coords((N, N), 1, p, scale / lam)
+    idx = y * N + x
+    if density is None:
+        density = grid_density(theta, lam, p, scale)
+    assert density.shape == (N, N)
+    v = v / density.reshape(-1)[idx]
+    if return_density:
+        return v, density
     return v
 
 
-def simple_imaging(theta, lam, p, v):
+def split_chunks(items, nchunks, sizes):
+    """Split a list into contiguous chunks of roughly equal total size
+
+    :param items: List to split
+    :param nchunks: Maximum number of chunks
+    :param sizes: Size of every item, e.g. number of visibilities
+    :returns: List of non-empty lists
+    """
+    cum = numpy.cumsum(sizes)
+    bounds = numpy.searchsorted(cum, cum[-1] * numpy.arange(1, nchunks) / nchunks, side='right')
+    bounds = numpy.unique(numpy.hstack([[0], bounds, [len(items)]]))
+    return [ items[i0:i1] for i0, i1 in zip(bounds[:-1], bounds[1:]) if i1 > i0 ]
+
+
+def tree_reduce(grids, executor=None):
+    """Sum grids by pairwise reduction
+
+    The first grid of every pair is updated in-place.
+
+    :param grids: List of equally shaped grids
+    :param executor: Executor to run the additions of every round on (optional)
+    :returns: Sum of all grids
+    """
+    grids = list(grids)
+    def add(pair):
+        return numpy.add(pair[0], pair[1], out=pair[0])
+    while len(grids) > 1:
+        pairs = list(zip(grids[0::2], grids[1::2]))
+        if executor is None:
+            summed = [ add(pair) for pair in pairs ]
+        else:
+            summed = list(executor.map(add, pairs))
+        grids = summed + grids[2*len(pairs):]
+    return grids[0]
+
+
+def parallel_grid(shape, items, grid_item, nworkers=1, dtype=complex):
+    """Grid a sequence of work items, optionally using a thread pool
+
+    Items are split into `nworkers` contiguous chunks holding roughly
+    the same number of visibilities. Every chunk is gridded into its
+    own thread-private grid, and the grids are then combined using
+    `tree_reduce`. This needs `nworkers` grids worth of memory.
+
+    :param shape: Grid shape, see `grid_shape`
+    :param items: List of work items, the visibility values of an
+      item must be its last element
+    :param grid_item: Function `(guv, item)` adding an item to a grid
+    :param nworkers: Number of threads to use
+    :param dtype: Type of the grid
+    :returns: UV grid
+    """
+    def grid_chunk(chunk):
+        guv = numpy.zeros(shape, dtype=dtype)
+        for item in chunk:
+            grid_item(guv, item)
+        return guv
+    if nworkers <= 1 or len(items) <= 1:
+        return grid_chunk(items)
+    chunks = split_chunks(items, nworkers, [ len(item[-1]) for item in items ])
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        grids = list(executor.map(grid_chunk, chunks))
+        return tree_reduce(grids, executor)
+
+
+def simple_imaging(theta, lam, p, v, scale=1.0):
     """Trivial function for imaging
 
     Does no convolution but simply puts the visibilities into a grid cell i.e. nearest neighbour gridding"""
     N = int(round(theta * lam))
     assert N > 1
-    guv = numpy.zeros([N, N], dtype=complex)
-    nearest_neighbour_grid(guv, p / lam, v)
+    guv = numpy.zeros(grid_shape(N, v), dtype=grid_dtype(v))
+    nearest_neighbour_grid(guv, p, v, scale / lam)
     return guv
 
 
-def simple_predict(guv, theta, lam, p):
+def simple_predict(guv, theta, lam, p, scale=1.0):
     """Trivial function for degridding
 
     Does no convolution but simply extracts the visibilities from a grid cell i.e. nearest neighbour degridding
@@ -386,15 +928,16 @@ def simple_predict(guv, theta, lam, p):
     :param p: UVWs of visibilities
     :param v: Visibility values
     :param kv: gridding kernel
+    :param scale: Factor to apply to `p` first
     :returns: p, v
     """
     N = int(round(theta * lam))
     assert N > 1
-    v = nearest_neighbour_degrid(guv, p / lam)
+    v = nearest_neighbour_degrid(guv, p, scale / lam)
     return p, v
 
 
-def convolutional_imaging(theta, lam, p, v, kv):
+def convolutional_imaging(theta, lam, p, v, kv, scale=1.0):
     """Convolve and grid with user-supplied kernels
 
     :param theta: Field of view (directional cosines))
@@ -402,18 +945,21 @@ def convolutional_imaging(theta, lam, p, v, kv):
     :param p: UVWs of visibilities
     :param v: Visibility values
     :param kv: Gridding kernel
+    :param scale: Factor to apply to `p` first
     :returns: UV grid
     """
     N = int(round(theta * lam))
     assert N > 1
-    guv = numpy.zeros([N, N], dtype=complex)
-    convolutional_grid(kv, guv, p / lam, v)
+    guv = numpy.zeros(grid_shape(N, v), dtype=grid_dtype(v))
+    convolutional_grid(kv, guv, p, v, scale=scale / lam)
     return guv
 
 
 def w_slice_imaging(theta, lam, p, v,
                     wstep=2000,
                     kernel_fn=w_kernel,
+                    nworkers=1,
+                    scale=1.0,
                     **kwargs):
     """Basic w-projection imaging using slices
 
@@ -428,22 +974,28 @@ def w_slice_imaging(theta, lam, p, v,
     :param wstep: Size of w-slices
     :param kernel_fn: Function for generating the kernels. Parameters
       `(theta, w, **kwargs)`. Default `w_kernel`.
+    :param nworkers: Number of threads to grid with (see `parallel_grid`)
+    :param scale: Factor to apply to `p` first, e.g. frequency over
+      speed of light for uvw in metres
     :returns: UV grid
     """
-N = int(round(theta * lam))
-assert N > 1
-slices = slice_vis(wstep, *sort_vis_w(p, v))
-guv = numpy.zeros([N, N], dtype=complex)
-for ps, vs in slices:
-    w = numpy.mean(ps[:, 2])
-    wg = numpy.conj(kernel_fn(theta, w, **kwargs))
-    convolutional_grid(wg, guv, ps / lam, vs)
-return guv
+    N = int(round(theta * lam))
+    assert N > 1
+    slices = slice_vis(wstep, *sort_vis_w(p, v))
+    if nworkers > 1:
+        kernel_fn = synchronized_kernel_fn(kernel_fn)
+    def grid_slice(guv, item):
+        ps, vs = item
+        w = numpy.mean(ps[:, 2]) * scale
+        wg = numpy.conj(kernel_fn(theta, w, **kwargs))
+        convolutional_grid(wg, guv, ps, vs, scale=scale / lam)
+    return parallel_grid(grid_shape(N, v), slices, grid_slice, nworkers, grid_dtype(v))
 
 
 def w_slice_predict(theta, lam, p, guv,
                     wstep=2000,
                     kernel_fn=w_kernel,
+                    scale=1.0,
                     **kwargs):
     """Basic w-projection predict using w-slices
 
@@ -458,6 +1010,7 @@ def w_slice_predict(theta, lam, p, guv,
     :param wstep: Size of w-slices
     :param kernel_fn: Function for generating the kernels. Parameters
       `(theta, w, **kwargs)`. Default `w_kernel`.
+    :param scale: Factor to apply to `p` first
     :returns: Visibilities, same order as p
     """
     # Calculate number of pixels in the Image
@@ -467,11 +1020,11 @@ def w_slice_predict(theta, lam, p, guv,
     # visibility indices so we can easily undo the sort later.
     nv = len(p)
     slices = slice_vis(wstep, *sort_vis_w(p, numpy.arange(nv)))
-    v = numpy.ndarray(nv, dtype=complex)
+    v = numpy.ndarray(nv, dtype=grid_dtype(guv))
     for ps, ixs in slices:
-        w = numpy.mean(ps[:, 2])
+        w = numpy.mean(ps[:, 2]) * scale
         wg = kernel_fn(theta, w, **kwargs)
-        v[ixs] = convolutional_degrid(wg, guv, ps / lam)
+        v[ixs] = convolutional_degrid(wg, guv, ps, scale=scale / lam)
     return v
 
 
@@ -495,14 +1048,36 @@ def w_conj_kernel_fn(kernel_fn):
     return fn
 
 
+def synchronized_kernel_fn(kernel_fn):
+    """Wrap a kernel function such that it can be called from multiple
+    threads at once.
+
+    Calls are serialised using a lock. This is required for kernel
+    caches such as `pylru.FunctionCacheManager`, which are not
+    thread-safe.
+
+    :param kernel_fn: Kernel function to wrap
+    :returns: Wrapped kernel function
+    """
+
+    lock = threading.Lock()
+    def fn(theta, w, **kw):
+        with lock:
+            return kernel_fn(theta, w, **kw)
+    return fn
+
+
 def w_cache_imaging(theta, lam, p, v,
                     wstep=2000,
                     kernel_cache=None,
                     kernel_fn=w_kernel,
+                    nworkers=1,
+                    scale=1.0,
                     **kwargs):
     """Basic w-projection by caching convolution arl in w
 
-    A simple cache can be constructed externally and passed in:
+    By default kernels are taken from `shared_kernel_cache`. Other
+    caches can be constructed externally and passed in:
 
       kernel_cache = pylru.FunctionCacheManager(w_kernel, cachesize)
 
@@ -512,39 +1087,40 @@ def w_cache_imaging(theta, lam, p, v,
     :param theta: Field of view (directional cosines)
     :param lam: UV grid range (wavelenghts)
     :param p: UVWs of visibilities (wavelengths)
-    :param v: Visibilities to be imaged
+    :param v: Visibilities to be imaged, `[nvis]` or `[nvis, nrhs]` (see `grid_shape`)
     :param wstep: Size of w-bins (wavelengths)
-    :param kernel_cache: Kernel cache. If not passed, we fall back
-       to `kernel_fn`.
+    :param kernel_cache: Kernel cache. If not passed, `kernel_fn` gets
+       cached in `shared_kernel_cache`.
     :param kernel_fn: Function for generating the kernels. Parameters
        `(theta, w, **kwargs)`. Default `w_kernel`.
+    :param nworkers: Number of threads to grid with. Every thread
+       grids a contiguous range of w-bins (see `parallel_grid`).
+    :param scale: Factor to apply to `p` first, e.g. frequency over
+       speed of light for uvw in metres
     :returns: UV grid
 
     """
 
-    # Construct default cache, if needed. As visibilities are
-    # traversed in w-order it only needs to hold the last w-kernel.
+    # The shared cache is thread-safe, others might not be
     if kernel_cache is None:
-        kernel_cache = pylru.FunctionCacheManager(kernel_fn, 1000)
-    # Bin w values, then run slice imager with slice size of 1
-    def kernel_binner(theta, w, **kw):
-        wbin = wstep * numpy.round(w / wstep)
-        return kernel_cache(theta, wbin, **kw)
-
+        kernel_cache = shared_kernel_cache.function(kernel_fn)
+    elif nworkers > 1:
+        kernel_cache = synchronized_kernel_fn(kernel_cache)
+    # Bin w values, then grid every bin in one go with its kernel
     N = int(round(theta * lam))
     assert N > 1
-    guv = numpy.zeros([N, N], dtype=complex)
-    for ps, vs in slices:
-        w = numpy.mean(ps[:, 2])
-        wg = numpy.conj(kernel_fn(theta, w, **kwargs))
-        convolutional_grid(wg, guv, ps / lam, vs)
-    return guv
+    def grid_bin(guv, item):
+        wbin, ps, vs = item
+        wg = numpy.conj(kernel_cache(theta, wbin, **kwargs))
+        convolutional_grid(wg, guv, ps, vs, scale=scale / lam)
+    return parallel_grid(grid_shape(N, v), bin_vis_w(wstep, p, v, scale), grid_bin, nworkers, grid_dtype(v))
 
 
 def w_cache_predict(theta, lam, p, guv,
                     wstep=2000,
                     kernel_cache=None,
                     kernel_fn=w_kernel,
+                    scale=1.0,
                     **kwargs):
     """Predict visibilities using w-kernel cache
 
@@ -553,51 +1129,850 @@ def w_cache_predict(theta, lam, p, guv,
     :param p: UVWs of visibilities  (wavelengths)
     :param guv: Input uv grid to de-grid from
     :param wstep: Size of w-bins (wavelengths)
-    :param kernel_cache: Kernel cache. If not passed, we fall back
-       to `kernel_fn`. See `w_cache_imaging` for details.
+    :param kernel_cache: Kernel cache. If not passed, `kernel_fn` gets
+       cached in `shared_kernel_cache`. See `w_cache_imaging` for details.
     :param kernel_fn: Function for generating the kernels. Parameters
        `(theta, w, **kwargs)`. Default `w_kernel`.
+    :param scale: Factor to apply to `p` first
     :returns: degridded visibilities
     """
 
     if kernel_cache is None:
-        kernel_cache = pylru.FunctionCacheManager(kernel_fn, 1000)
-    def kernel_binner(theta, w, **kw):
-        wbin = wstep * numpy.round(w / wstep)
-        return kernel_cache(theta, wbin, **kw)
-    return w_slice_predict(theta, lam, p, guv, 1, kernel_binner, **kwargs)
+        kernel_cache = shared_kernel_cache.function(kernel_fn)
+    # Bin w values, keeping visibility indices to undo the sort
+    nv = len(p)
+    v = numpy.ndarray(nv, dtype=grid_dtype(guv))
+    for wbin, ps, ixs in bin_vis_w(wstep, p, numpy.arange(nv), scale):
+        wg = kernel_cache(theta, wbin, **kwargs)
+        v[ixs] = convolutional_degrid(wg, guv, ps, scale=scale / lam)
+    return v
+
+
+def w_stack_imaging(theta, lam, p, v,
+                    wstep=2000,
+                    kernel_fn=w_kernel,
+                    scale=1.0,
+                    **kwargs):
+    """W-stacking imaging
+
+    Bins visibilities into w-planes of width `wstep`. Every plane is
+    gridded with the same w=0 kernel, transformed to image space and
+    multiplied with the conjugate w-screen `w_kernel_function` for the
+    plane's w before being added to the image. This trades w-kernel
+    generation for one FFT per w-plane.
+
+    Unlike the other imaging functions this returns the accumulated
+    image, i.e. what `ifft` would make of their uv grids, as
+    transforming it back to a uv grid would only be undone by the
+    caller. Use `hermitian_image` to make the real image from either.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param v: Visibilities to be imaged, `[nvis]` or `[nvis, nrhs]` (see `grid_shape`)
+    :param wstep: Distance between w-planes (wavelengths)
+    :param kernel_fn: Function for generating the kernels. Parameters
+      `(theta, w, **kwargs)`. Only evaluated for w=0.
+    :param scale: Factor to apply to `p` first
+    :returns: Complex image
+    """
+    N = int(round(theta * lam))
+    assert N > 1
+    gcf = numpy.conj(kernel_fn(theta, 0.0, **kwargs))
+    dtype = grid_dtype(v)
+    img = numpy.zeros(grid_shape(N, v), dtype=dtype)
+    for wplane, ps, vs in bin_vis_w(wstep, p, v, scale):
+        guv = numpy.zeros(grid_shape(N, v), dtype=dtype)
+        convolutional_grid(gcf, guv, ps, vs, scale=scale / lam)
+        img += ifft(guv) * numpy.conj(w_kernel_function(N, theta, wplane)).astype(dtype)
+    return img
+
+
+w_stack_imaging.image_plane = True
+
+
+def w_stack_predict(theta, lam, p, guv,
+                    wstep=2000,
+                    kernel_fn=w_kernel,
+                    scale=1.0,
+                    **kwargs):
+    """Predict visibilities using w-stacking
+
+    Counterpart to `w_stack_imaging`: for every w-plane the model image
+    is multiplied with the w-screen of the plane, transformed to a uv
+    grid and degridded using the w=0 kernel.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param guv: Input uv grid to de-grid from
+    :param wstep: Distance between w-planes (wavelengths)
+    :param kernel_fn: Function for generating the kernels. Parameters
+      `(theta, w, **kwargs)`. Only evaluated for w=0.
+    :param scale: Factor to apply to `p` first
+    :returns: Visibilities, same order as p
+    """
+    N = int(round(theta * lam))
+    assert N > 1
+    gcf = kernel_fn(theta, 0.0, **kwargs)
+    img = ifft(guv)
+    nv = len(p)
+    v = numpy.ndarray(nv, dtype=grid_dtype(guv))
+    for wplane, ps, ixs in bin_vis_w(wstep, p, numpy.arange(nv), scale):
+        wguv = fft(img * w_kernel_function(N, theta, wplane).astype(img.dtype))
+        v[ixs] = convolutional_degrid(gcf, wguv, ps, scale=scale / lam)
+    return v
+
 
+def idg_subgrids(theta, p, Nsub, support):
+    """Group visibilities by the subgrid they fall into
+
+    The uv-plane is split into tiles of `Nsub - support` cells, so
+    that the footprint of every visibility of a tile fits into a
+    subgrid of `Nsub` cells centred on the tile.
+
+    :param theta: Field of view (directional cosines)
+    :param p: UVWs of visibilities (wavelengths)
+    :param Nsub: Subgrid size (cells)
+    :param support: Width of the visibility footprint (cells)
+    :returns: List of `(cu, cv, ixs)`, with `cu, cv` the subgrid centre
+      relative to the grid centre (cells) and `ixs` the indices of the
+      visibilities in the subgrid
+    """
+    step = Nsub - support
+    assert step > 0, "Subgrid size %d too small for support %d" % (Nsub, support)
+    tu = numpy.floor(p[:, 0] * theta / step + 0.5).astype(int)
+    tv = numpy.floor(p[:, 1] * theta / step + 0.5).astype(int)
+    tiles, inverse = numpy.unique(numpy.transpose([tv, tu]), axis=0, return_inverse=True)
+    ixs = numpy.argsort(inverse.ravel(), kind='stable')
+    bounds = numpy.searchsorted(inverse.ravel()[ixs], numpy.arange(len(tiles) + 1))
+    return [(tiles[i, 1] * step, tiles[i, 0] * step, ixs[bounds[i]:bounds[i + 1]])
+            for i in range(len(tiles))]
+
+
+def idg_phasor(theta, Nsub, cu, cv, p, dtype=complex, scale=1.0):
+    """Image-domain phasors of visibilities relative to a subgrid centre
+
+    Includes the w-term, so no w-kernels are needed.
+
+    :param theta: Field of view (directional cosines)
+    :param Nsub: Subgrid size (cells)
+    :param cu: Horizontal subgrid centre (cells)
+    :param cv: Vertical subgrid centre (cells)
+    :param p: UVWs of visibilities (wavelengths)
+    :param dtype: Type of the phasors. Phases are always calculated
+      in double precision.
+    :param scale: Factor to apply to `p` first
+    :returns: [nvis, Nsub, Nsub] phasors
+    """
+    cm, cl = coordinates2(Nsub)
+    n = numpy.sqrt(1.0 - (cl**2 + cm**2) * theta**2)
+    du = p[:, 0] * (theta * scale) - cu
+    dv = p[:, 1] * (theta * scale) - cv
+    ph = (du[:, None, None] * cl + dv[:, None, None] * cm +
+          (p[:, 2] * scale)[:, None, None] * (n - 1))
+    ph = ph.astype(numpy.finfo(dtype).dtype, copy=False)
+    return numpy.exp((2j * numpy.pi) * ph).astype(dtype, copy=False)
+
+
+def idg_window(N, Nsub, cu, cv):
+    """Slices of the grid and of a subgrid where they overlap
+
+    :param N: Grid size (cells)
+    :param Nsub: Subgrid size (cells)
+    :param cu: Horizontal subgrid centre (cells)
+    :param cv: Vertical subgrid centre (cells)
+    :returns: Pair of (grid slices, subgrid slices)
+    """
+    def axis(c):
+        lo = N // 2 + c - Nsub // 2
+        return (slice(max(lo, 0), min(lo + Nsub, N)),
+                slice(max(-lo, 0), min(N - lo, Nsub)))
+    (gy, sy), (gx, sx) = axis(cv), axis(cu)
+    return (gy, gx), (sy, sx)
+
+
+def idg_imaging(theta, lam, p, v,
+                Nsub=32,
+                support=8,
+                max_batch_bytes=GRID_BATCH_BYTES,
+                scale=1.0,
+                **kwargs):
+    """Image-domain gridding
+
+    Visibilities are grouped into subgrids (see `idg_subgrids`). The
+    image of every subgrid is computed directly as a sum of
+    visibility phasors (including the w-term) multiplied with the
+    taper. This is transformed into a small uv subgrid and added to
+    the grid. In the end the taper is divided out of the image.
+
+    All work is dense arithmetic on visibility batches, there are no
+    convolution kernels to generate or cache. The subgrid must be
+    large enough to hold the w-term footprint of its visibilities.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param v: Visibilities to be imaged, `[nvis]` or `[nvis, nrhs]` (see `grid_shape`)
+    :param Nsub: Subgrid size (cells)
+    :param support: Width of the taper footprint (cells)
+    :param max_batch_bytes: Memory budget for the phasors of a batch
+    :param scale: Factor to apply to `p` first
+    :returns: UV grid
+    """
+    N = int(round(theta * lam))
+    assert N > 1
+    taper = prolate_taper(Nsub, support)
+    nbatch = max(1, max_batch_bytes // (16 * Nsub * Nsub))
+    dtype = grid_dtype(v)
+    guv = numpy.zeros(grid_shape(N, v), dtype=dtype)
+    for cu, cv, ixs in idg_subgrids(theta * scale, p, Nsub, support):
+        img = numpy.zeros(grid_shape(Nsub, v), dtype=dtype)
+        for b in range(0, len(ixs), nbatch):
+            bixs = ixs[b:b + nbatch]
+            img += numpy.einsum('i...,ijk->...jk', v[bixs],
+                                idg_phasor(theta, Nsub, cu, cv, p[bixs], dtype, scale))
+        sub = fft(img * taper.astype(numpy.finfo(dtype).dtype)) / (Nsub * Nsub)
+        gw, sw = idg_window(N, Nsub, cu, cv)
+        guv[(Ellipsis,) + gw] += sub[(Ellipsis,) + sw]
+    return fft(ifft(guv) / prolate_taper(N, support)).astype(dtype, copy=False)
+
+
+def idg_predict(theta, lam, p, guv,
+                Nsub=32,
+                support=8,
+                max_batch_bytes=GRID_BATCH_BYTES,
+                scale=1.0,
+                **kwargs):
+    """Predict visibilities using image-domain degridding
+
+    Counterpart to `idg_imaging`: the grid gets divided by the taper
+    in image space, then for every subgrid the image of its uv-window
+    is tapered and the visibilities obtained as phasor sums.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param guv: Input uv grid to de-grid from
+    :param Nsub: Subgrid size (cells)
+    :param support: Width of the taper footprint (cells)
+    :param max_batch_bytes: Memory budget for the phasors of a batch
+    :param scale: Factor to apply to `p` first
+    :returns: Visibilities, same order as p
+    """
+    N = guv.shape[0]
+    taper = prolate_taper(Nsub, support)
+    nbatch = max(1, max_batch_bytes // (16 * Nsub * Nsub))
+    dtype = grid_dtype(guv)
+    guv = fft(ifft(guv) / prolate_taper(N, support)).astype(dtype, copy=False)
+    v = numpy.zeros(len(p), dtype=dtype)
+    for cu, cv, ixs in idg_subgrids(theta * scale, p, Nsub, support):
+        sub = numpy.zeros([Nsub, Nsub], dtype=dtype)
+        gw, sw = idg_window(N, Nsub, cu, cv)
+        sub[sw] = guv[gw]
+        img = numpy.conj(ifft(sub) * taper).astype(dtype, copy=False)
+        for b in range(0, len(ixs), nbatch):
+            bixs = ixs[b:b + nbatch]
+            v[bixs] = numpy.conj(numpy.einsum('jk,ijk->i', img,
+                                              idg_phasor(theta, Nsub, cu, cv, p[bixs], dtype, scale)))
+    return v
+
+
+def create_shared_array(shape, dtype):
+    """Allocate an array in shared memory
+
+    The caller owns the shared memory block, and must `close` and
+    `unlink` it once done.
+
+    :param shape: Array shape
+    :param dtype: Array data type
+    :returns: Pair of shared memory block and array using it
+    """
+    nbytes = max(1, int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    return shm, numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def attach_shared_array(desc):
+    """Attach to an array in shared memory created by another process
+
+    :param desc: Tuple (name, shape, dtype) describing the array
+    :returns: Pair of shared memory block and array using it
+    """
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
 
-def do_imaging(theta, lam, p, v, imgfn, **kwargs):
+
+def shared_array_desc(shm, a):
+    """Picklable description of a shared array, see `attach_shared_array`"""
+    return shm.name, a.shape, a.dtype.str
+
+
+def process_imaging_worker(theta, lam, imgfn, p_desc, v_desc, grids_desc, i0, i1, iworker, kwargs):
+    """Grid visibilities i0..i1 from shared memory into shared grid number `iworker`
+
+    Worker for `process_imaging`.
+    """
+    shms = []
+    try:
+        for desc in [p_desc, v_desc, grids_desc]:
+            shms.append(attach_shared_array(desc))
+        (_, p), (_, v), (_, grids) = shms
+        grids[iworker] = imgfn(theta, lam, p[i0:i1], v[i0:i1], **kwargs)
+    finally:
+        for shm, _ in shms:
+            shm.close()
+
+
+def process_predict_worker(theta, lam, predfn, p_desc, guv_desc, v_desc, i0, i1, kwargs):
+    """Degrid visibilities i0..i1 using shared memory
+
+    Worker for `process_predict`.
+    """
+    shms = []
+    try:
+        for desc in [p_desc, guv_desc, v_desc]:
+            shms.append(attach_shared_array(desc))
+        (_, p), (_, guv), (_, v) = shms
+        v[i0:i1] = predfn(theta, lam, p[i0:i1], guv, **kwargs)
+    finally:
+        for shm, _ in shms:
+            shm.close()
+
+
+def kernel_fn_key(kernel_fn):
+    """Hashable key identifying a kernel function
+
+    Partials are keyed on their function, positional and keyword
+    arguments, so that equal partials give equal keys. Other functions
+    are their own key, which keeps them alive as long as the key.
+
+    :param kernel_fn: Kernel function
+    :returns: Key
+    """
+    if isinstance(kernel_fn, functools.partial):
+        key = (kernel_fn_key(kernel_fn.func), kernel_fn.args, tuple(sorted(kernel_fn.keywords.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable arguments, e.g. arrays: only the same partial matches
+            return kernel_fn
+        return key
+    return kernel_fn
+
+
+class KernelCache:
+    """Thread-safe cache of kernels, bounded by memory
+
+    Kernels are keyed on the kernel function and all of its parameters,
+    so one cache can serve all imaging and prediction calls of a
+    process. When the kernels held exceed `max_bytes`, the least
+    recently used ones get evicted. Cached kernels are read-only.
+
+    Keys hold on to the kernel function, so a function cannot get
+    garbage-collected and replaced by another one with the same identity
+    while its kernels are cached. Partials are keyed on their function
+    and arguments, so equal partials created by separate calls share
+    kernels.
+
+    :param max_bytes: Memory budget of the cache
+    """
+
+    def __init__(self, max_bytes=KERNEL_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.kernels = collections.OrderedDict()
+        self.nbytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Set hit, miss and eviction counters and generation time to zero"""
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.generation_time = 0.0
+
+    def stats(self):
+        """Cache statistics
+
+        :returns: dict with 'hits', 'misses', 'evictions', 'generation_time'
+          (seconds spent generating kernels), 'nkernels', 'nbytes' and 'max_bytes'
+        """
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        generation_time=self.generation_time, nkernels=len(self.kernels),
+                        nbytes=self.nbytes, max_bytes=self.max_bytes)
+
+    def _evict(self):
+        # Called with the lock held
+        while self.nbytes > self.max_bytes and self.kernels:
+            key, kern = self.kernels.popitem(last=False)
+            self.nbytes -= kern.nbytes
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """Change the memory budget, evicting kernels if necessary"""
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Drop all kernels"""
+        with self.lock:
+            self.kernels.clear()
+            self.nbytes = 0
+
+    def get(self, kernel_fn, theta, w, **kwargs):
+        """Kernel `kernel_fn(theta, w, **kwargs)`, generated if not cached"""
+        return self.get_keyed(kernel_fn_key(kernel_fn), kernel_fn, theta, w, **kwargs)
+
+    def get_keyed(self, fn_key, kernel_fn, theta, w, **kwargs):
+        """As `get`, with the kernel function identified by `fn_key`
+
+        :param fn_key: Hashable key standing for `kernel_fn`, see `kernel_fn_key`
+        """
+        # Fields of view reconstructed from image coordinates differ in
+        # the last bits, which makes no difference for the kernels
+        key = (fn_key, '%.12g' % theta, '%.12g' % w, repr(sorted(kwargs.items())))
+        with self.lock:
+            kern = self.kernels.get(key)
+            if kern is not None:
+                self.kernels.move_to_end(key)
+                self.hits += 1
+                return kern
+            self.misses += 1
+        # Generate without holding the lock, so other threads can
+        # carry on. Concurrent misses for the same key may both
+        # generate the kernel.
+        start = time.perf_counter()
+        kern = numpy.asarray(kernel_fn(theta, w, **kwargs))
+        elapsed = time.perf_counter() - start
+        kern.flags.writeable = False
+        with self.lock:
+            self.generation_time += elapsed
+            if kern.nbytes <= self.max_bytes and key not in self.kernels:
+                self.kernels[key] = kern
+                self.nbytes += kern.nbytes
+                self._evict()
+        return kern
+
+    def function(self, kernel_fn):
+        """Cached kernel function, to pass as `kernel_cache`
+
+        :param kernel_fn: Function for generating the kernels. Parameters
+          `(theta, w, **kwargs)`.
+        :returns: Function with the same parameters
+        """
+        return functools.partial(self.get, kernel_fn)
+
+
+# Kernel cache shared by everything running in this process
+shared_kernel_cache = KernelCache()
+
+
+class ProcessKernelCache:
+    """Picklable kernel cache for worker processes
+
+    Every process calling the cache uses its own `shared_kernel_cache`,
+    which persists for the lifetime of the process. Used with a
+    long-lived process pool, kernels are therefore only generated once
+    per worker process. Statistics are kept by the worker processes.
+
+    :param kernel_fn: Function for generating the kernels. Must be
+      picklable, e.g. a module-level function such as `w_kernel`.
+    """
+
+    def __init__(self, kernel_fn=w_kernel):
+        self.kernel_fn = kernel_fn
+        # The kernel function arrives in the workers as a new object with
+        # every task. Its pickled form names it by module and qualified
+        # name plus arguments, which stays the same.
+        self.key = ('pickle', pickle.dumps(kernel_fn))
+
+    def __call__(self, theta, w, **kw):
+        if w < 0:
+            return numpy.conj(shared_kernel_cache.get_keyed(self.key, self.kernel_fn, theta, -w, **kw))
+        return shared_kernel_cache.get_keyed(self.key, self.kernel_fn, theta, w, **kw)
+
+
+class KernelBank:
+    """Persistent bank of w-kernels on disk
+
+    Holds the kernels for all w-bins `-nbins..nbins` of width `wstep`
+    as a `[2*nbins+1, Qpx, Qpx, s, s]` stack in a `.npy` file. The
+    file name is derived from `(theta, wstep, NpixFF, NpixKern, Qpx,
+    dl, dm, T)`, so repeated imaging of the same field finds all
+    kernels already generated. Like in `KernelCache`, theta is rounded
+    to 12 significant digits, so that a theta recomputed from an image
+    WCS finds the same bank.
+
+    The bank gets built the first time a kernel is requested, or
+    rebuilt (reusing existing kernels) when a w outside of its range
+    is requested. Afterwards it is memory-mapped read-only, so all
+    processes using the same directory share the same pages. Objects
+    are picklable and can be passed to worker processes like
+    `ProcessKernelCache`.
+
+    Can be used as `kernel_cache` for `w_cache_imaging` and
+    `w_cache_predict`. Requested w values get rounded to the nearest
+    bin centre. If a `tolerance` is given, kernels get returned
+    truncated to a per-bin support, see `kernel_support`.
+
+    :param directory: Directory holding the kernel files
+    :param theta: Field of view (directional cosines)
+    :param wstep: Size of w-bins (wavelengths)
+    :param NpixFF: Far field size
+    :param NpixKern: Size of convolution function to extract
+    :param Qpx: Oversampling
+    :param dl: Kernel horizontal shift, passed to `kernel_fn` if set
+    :param dm: Kernel vertical shift, passed to `kernel_fn` if set
+    :param T: Kernel transformation matrix, passed to `kernel_fn` if set.
+      `dl`, `dm` and `T` need a `kernel_fn` supporting them, such as
+      `crocodile.synthesis.w_kernel`.
+    :param nbins: Number of w-bins to generate at least on each side of w=0
+    :param kernel_fn: Function for generating the kernels. Parameters
+      `(theta, w, NpixFF, NpixKern, Qpx, **kwargs)`. If not passed, all
+      missing kernels get generated in one go using `w_kernels`.
+    :param tolerance: Fraction of the kernel energy that may get lost
+      by truncating kernels. Default: no truncation.
+    :param dtype: Type of the stored kernels, e.g. `numpy.complex64`
+    """
+
+    banks = {}
+    support_tables = {}
+    lock = threading.Lock()
+
+    def __init__(self, directory, theta, wstep, NpixFF, NpixKern, Qpx,
+                 dl=0, dm=0, T=None, nbins=0, kernel_fn=None, tolerance=None, dtype=complex):
+        self.tolerance = tolerance
+        self.dtype = numpy.dtype(dtype)
+        self.theta = theta
+        self.wstep = wstep
+        self.NpixFF = NpixFF
+        self.NpixKern = NpixKern
+        self.Qpx = Qpx
+        self.nbins = nbins
+        self.kernel_fn = kernel_fn
+        self.transform = {}
+        if dl != 0 or dm != 0:
+            self.transform.update(dl=dl, dm=dm)
+        if T is not None:
+            self.transform.update(T=T)
+        if self.transform and kernel_fn is None:
+            raise ValueError("KernelBank: w_kernels cannot shift or transform kernels, "
+                             "pass a kernel_fn supporting dl, dm and T")
+        Tkey = None if T is None else tuple(numpy.ravel(T).tolist())
+        # Round theta like `KernelCache`, it often gets recomputed from a WCS
+        key = ('%.12g' % theta, float(wstep), NpixFF, NpixKern, Qpx, float(dl), float(dm), Tkey)
+        if self.dtype != numpy.complex128:
+            key += (self.dtype.str,)
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        self.path = os.path.join(directory, 'wkernels_%s.npy' % digest)
+
+    def build(self, nbins, old=None):
+        """Generate kernels for w-bins `-nbins..nbins` and write them to disk
+
+        :param nbins: Number of w-bins on each side of w=0
+        :param old: Existing (smaller) bank to take kernels from
+        :returns: The new bank, memory-mapped read-only
+        """
+        tmp = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.get_ident())
+        shape = (2 * nbins + 1, self.Qpx, self.Qpx, self.NpixKern, self.NpixKern)
+        bank = numpy.lib.format.open_memmap(tmp, mode='w+', dtype=self.dtype, shape=shape)
+        nold = -1 if old is None else old.shape[0] // 2
+        if nold >= 0:
+            bank[nbins - nold:nbins + nold + 1] = old
+        ks = [k for k in range(-nbins, nbins + 1) if abs(k) > nold]
+        if self.kernel_fn is None:
+            bank[nbins + numpy.array(ks)] = w_kernels(self.theta, self.wstep * numpy.array(ks, dtype=float),
+                                                     self.NpixFF, self.NpixKern, self.Qpx, self.dtype,
+                                                     **self.transform)
+        else:
+            for k in ks:
+                bank[nbins + k] = self.kernel_fn(self.theta, k * self.wstep, self.NpixFF,
+                                                 self.NpixKern, self.Qpx, **self.transform)
+        bank.flush()
+        del bank
+        # Atomically replace, concurrent builders produce the same data
+        os.replace(tmp, self.path)
+        return numpy.load(self.path, mmap_mode='r')
+
+    def kernels(self, nbins=0):
+        """Kernel stack covering at least w-bins `-nbins..nbins`
+
+        :param nbins: Number of w-bins required on each side of w=0
+        :returns: Read-only memory-mapped `[2*n+1, Qpx, Qpx, s, s]` array
+        """
+        with self.lock:
+            bank = self.banks.get(self.path)
+            if bank is None and os.path.exists(self.path):
+                bank = numpy.load(self.path, mmap_mode='r')
+            if bank is None or bank.shape[0] < 2 * nbins + 1:
+                bank = self.build(max(nbins, self.nbins), bank)
+            self.banks[self.path] = bank
+            return bank
+
+    def supports(self, nbins=0):
+        """Kernel supports for all w-bins of the bank at its tolerance
+
+        :param nbins: Number of w-bins required on each side of w=0
+        :returns: Array of supports, same length as the kernel stack
+        """
+        bank = self.kernels(nbins)
+        key = (self.path, self.tolerance)
+        with self.lock:
+            support = self.support_tables.get(key)
+            if support is None or len(support) != bank.shape[0]:
+                support = kernel_support(bank, self.tolerance)
+                self.support_tables[key] = support
+            return support
+
+    def __call__(self, theta, w, NpixFF=None, NpixKern=None, Qpx=None, dtype=None):
+        assert '%.12g' % theta == '%.12g' % self.theta, "Kernel bank is for theta=%f, not %f" % (self.theta, theta)
+        assert (NpixFF, NpixKern, Qpx) == (self.NpixFF, self.NpixKern, self.Qpx)
+        assert dtype is None or numpy.dtype(dtype) == self.dtype, "Kernel bank holds %s kernels" % self.dtype
+        k = int(numpy.round(w / self.wstep))
+        bank = self.kernels(abs(k))
+        i = bank.shape[0] // 2 + k
+        if self.tolerance is None:
+            return bank[i]
+        return truncate_kernel(bank[i], self.supports(abs(k))[i])
+
+
+def run_in_processes(executor, nprocs, fn, argss):
+    """Call a function for a list of arguments on a process pool
+
+    :param executor: Process pool to use. If `None`, a pool of
+      `nprocs` processes is created for the duration of the call.
+    :param nprocs: Number of processes
+    :param fn: Function to call, must be picklable
+    :param argss: List of argument tuples
+    :returns: List of results
+    """
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=nprocs) as executor:
+            return run_in_processes(executor, nprocs, fn, argss)
+    futures = [ executor.submit(fn, *args) for args in argss ]
+    return [ future.result() for future in futures ]
+
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def process_pool(nprocs):
+    """Process pool of `nprocs` processes shared by all callers
+
+    The pool is created on first use and kept until the interpreter
+    exits, so worker processes and their `ProcessKernelCache` kernels
+    survive from one imaging or prediction call to the next.
+
+    :param nprocs: Number of processes
+    :returns: `ProcessPoolExecutor`
+    """
+    with _process_pools_lock:
+        executor = _process_pools.get(nprocs)
+        if executor is None:
+            executor = _process_pools[nprocs] = ProcessPoolExecutor(max_workers=nprocs)
+        return executor
+
+
+def process_ranges(p, nprocs, wstep=None, scale=1.0):
+    """Sort visibilities by w and split them into contiguous w-ranges
+
+    :param p: UVWs of visibilities
+    :param nprocs: Number of ranges
+    :param wstep: Size of w-bins. If given, visibilities are only
+      sorted by w-bin, keeping their order within bins.
+    :param scale: Factor to apply to `p` first
+    :returns: Sort permutation and list of (start, end) index pairs
+    """
+    if wstep is None:
+        zs = numpy.argsort(p[:, 2], kind='stable')
+    else:
+        zs = numpy.argsort(numpy.round(p[:, 2] * (scale / wstep)), kind='stable')
+    bounds = numpy.unique(numpy.linspace(0, len(zs), nprocs + 1).astype(int))
+    return zs, list(zip(bounds[:-1], bounds[1:]))
+
+
+def process_imaging(theta, lam, p, v, imgfn=w_cache_imaging, nprocs=1, executor=None, **kwargs):
+    """Grid using a pool of processes
+
+    Visibilities are sorted by w and split into one contiguous w-range
+    per process. The visibilities and the per-process output grids live
+    in shared memory, so only their descriptions are passed to the
+    workers. Every worker grids its w-range into its own grid using
+    `imgfn`, and the grids are summed in the parent.
+
+    `imgfn` and all keyword parameters are sent to the workers, so they
+    must be picklable. Kernel caches can therefore not be shared
+    between processes, use `ProcessKernelCache` to give every worker
+    its own.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param v: Visibilities to be imaged, `[nvis]` or `[nvis, nrhs]` (see `grid_shape`)
+    :param imgfn: Imaging function to run in the workers, e.g.
+      `w_cache_imaging`.
+    :param nprocs: Number of processes
+    :param executor: Process pool to use, see `run_in_processes`.
+      Keep it alive between calls to make use of worker kernel caches.
+    :returns: UV grid, or image if `imgfn` returns images
+    """
+    if nprocs <= 1:
+        return imgfn(theta, lam, p, v, **kwargs)
+    N = int(round(theta * lam))
+    assert N > 1
+    zs, ranges = process_ranges(p, nprocs, kwargs.get('wstep'), kwargs.get('scale', 1.0))
+    shms = []
+    try:
+        shms.append(create_shared_array(p.shape, p.dtype))
+        shms.append(create_shared_array(v.shape, v.dtype))
+        shms.append(create_shared_array((len(ranges),) + grid_shape(N, v), grid_dtype(v)))
+        (_, sp), (_, sv), (_, grids) = shms
+        sp[...] = p[zs]
+        sv[...] = v[zs]
+        p_desc, v_desc, grids_desc = [ shared_array_desc(shm, a) for shm, a in shms ]
+        run_in_processes(executor, nprocs, process_imaging_worker,
+                         [ (theta, lam, imgfn, p_desc, v_desc, grids_desc, i0, i1, iworker, kwargs)
+                           for iworker, (i0, i1) in enumerate(ranges) ])
+        return tree_reduce(list(grids)).copy()
+    finally:
+        for shm, _ in shms:
+            shm.close()
+            shm.unlink()
+
+
+def process_predict(theta, lam, p, guv, predfn=w_cache_predict, nprocs=1, executor=None, **kwargs):
+    """Degrid using a pool of processes
+
+    Counterpart to `process_imaging`: the uv grid, the visibility
+    coordinates and the output visibilities live in shared memory, and
+    every worker degrids one contiguous w-range using `predfn`.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param guv: Input uv grid to de-grid from
+    :param predfn: Prediction function to run in the workers, e.g.
+      `w_cache_predict`.
+    :param nprocs: Number of processes
+    :param executor: Process pool to use, see `run_in_processes`
+    :returns: Visibilities, same order as p
+    """
+    if nprocs <= 1:
+        return predfn(theta, lam, p, guv, **kwargs)
+    zs, ranges = process_ranges(p, nprocs, kwargs.get('wstep'), kwargs.get('scale', 1.0))
+    shms = []
+    try:
+        shms.append(create_shared_array(p.shape, p.dtype))
+        shms.append(create_shared_array(guv.shape, guv.dtype))
+        shms.append(create_shared_array((len(p),), grid_dtype(guv)))
+        (_, sp), (_, sguv), (_, sv) = shms
+        sp[...] = p[zs]
+        sguv[...] = guv
+        p_desc, guv_desc, v_desc = [ shared_array_desc(shm, a) for shm, a in shms ]
+        run_in_processes(executor, nprocs, process_predict_worker,
+                         [ (theta, lam, predfn, p_desc, guv_desc, v_desc, i0, i1, kwargs)
+                           for i0, i1 in ranges ])
+        v = numpy.empty(len(p), dtype=sv.dtype)
+        v[zs] = sv
+        return v
+    finally:
+        for shm, _ in shms:
+            shm.close()
+            shm.unlink()
+
+
+def do_imaging(theta, lam, p, v, imgfn, scale=1.0, wt=None, **kwargs):
     """Do imaging with imaging function (imgfn)
 
     :param theta: Field of view (directional cosines)
     :param lam: UV grid range (wavelenghts)
     :param p: UVWs of visibilities (wavelengths)
-    :param v: Visibilities to be imaged
+    :param v: Visibilities to be imaged, `[nvis]` or `[nvis, npol]` to
+      image all polarisations at once
     :param imgfn: imaging function e.g. `simple_imaging`, `conv_imaging`,
       `w_slice_imaging` or `w_cache_imaging`. All keyword parameters
       are passed on to the imaging function.
-    :returns: dirty Image, psf
-    """
-    # Add the conjugate points
-    p = numpy.vstack([p, p * -1])
-    v = numpy.hstack([v, numpy.conj(v)])
-    # Determine weights
-    wt = doweight(theta, lam, p, numpy.ones(len(p)))
-    # Make image
-    cdrt = imgfn(theta, lam, p, wt * v, **kwargs)
-    drt = numpy.real(ifft(cdrt))
-    # Make point spread function
-    c = imgfn(theta, lam, p, wt, **kwargs)
-    psf = numpy.real(ifft(c))
+    :param scale: Factor to apply to `p` first, so `uvw` in metres
+      can be imaged without making a scaled copy per channel
+    :param wt: Imaging weights of the visibilities. Default: uniform
+      weighting
+    :returns: dirty Image (`[npol, N, N]` for `[nvis, npol]` visibilities), psf
+    """
+    p = numpy.asarray(p)
+    v = numpy.asarray(v)
+    nv = len(p)
+    if wt is None:
+        # Determine weights, counting the conjugate points as well
+        density = grid_density(theta, lam, p, scale) + grid_density(theta, lam, p, -scale)
+        wt = doweight(theta, lam, p, numpy.ones(nv), density=density, scale=scale)
+    wt = numpy.asarray(wt).astype(v.real.dtype)
+    # Make images and point spread function in one pass. Every
+    # visibility gets gridded once, the conjugate points are added by
+    # making the grids Hermitian.
+    vals = numpy.empty((nv, v[0].size + 1), dtype=v.dtype)
+    vals[:, :-1] = wt[:, None] * v.reshape(nv, -1)
+    vals[:, -1] = wt
+    c = imgfn(theta, lam, p, vals, scale=scale, **kwargs)
+    img = hermitian_image(imgfn, c)
+    drt, psf = img[:-1].reshape(v.shape[1:] + img.shape[1:]), img[-1]
     # Normalise
     pmax = psf.max()
     assert pmax > 0.0
     return drt / pmax, psf / pmax, pmax
 
 
-def do_predict(theta, lam, p, modelimage, predfn, **kwargs):
+def do_mfs_imaging(theta, lam, p, v, x, nterms, imgfn, wt=None, **kwargs):
+    """Multi-frequency synthesis imaging into Taylor term images
+
+    Visibilities of all channels are gridded together, their `uvw`
+    already scaled by their frequency. For Taylor terms every visibility
+    gets gridded with an additional weight `x**t`, where `x` is its
+    fractional frequency offset `(f - f0) / f0`. All terms and the PSFs
+    `0..2*nterms-2` needed to deconvolve them are made in one gridding
+    pass and one FFT per term.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities of all channels (wavelengths)
+    :param v: Visibilities to be imaged, `[nvis]` or `[nvis, npol]`
+    :param x: Fractional frequency offset of every visibility
+    :param nterms: Number of Taylor terms
+    :param imgfn: imaging function, see `do_imaging`
+    :param wt: Imaging weights of the visibilities. Default: uniform
+      weighting over all channels
+    :returns: dirty Taylor term images `[nterms, ...]`, psfs `[2*nterms-1, N, N]`
+    """
+    p = numpy.asarray(p)
+    v = numpy.asarray(v)
+    nv = len(p)
+    if wt is None:
+        density = grid_density(theta, lam, p) + grid_density(theta, lam, p, -1.0)
+        wt = doweight(theta, lam, p, numpy.ones(nv), density=density)
+    wt = numpy.asarray(wt).astype(v.real.dtype)
+    tw = numpy.asarray(x, dtype=wt.dtype)[:, None] ** numpy.arange(2 * nterms - 1)
+    tw *= wt[:, None]
+    vs = v.reshape(nv, -1)
+    npol = vs.shape[1]
+    vals = numpy.empty((nv, nterms * npol + 2 * nterms - 1), dtype=v.dtype)
+    vals[:, :nterms * npol] = (tw[:, :nterms, None] * vs[:, None, :]).reshape(nv, -1)
+    vals[:, nterms * npol:] = tw
+    c = imgfn(theta, lam, p, vals, **kwargs)
+    img = hermitian_image(imgfn, c)
+    drt = img[:nterms * npol].reshape((nterms,) + v.shape[1:] + img.shape[1:])
+    psf = img[nterms * npol:]
+    # Normalise by the PSF of the zeroth term
+    pmax = psf[0].max()
+    assert pmax > 0.0
+    return drt / pmax, psf / pmax, pmax
+
+
+def do_predict(theta, lam, p, modelimage, predfn, scale=1.0, **kwargs):
     """Predict visibilities for a model Image at the phase centre using the
     specified degridding function.
 
@@ -607,7 +1982,30 @@ def do_predict(theta, lam, p, modelimage, predfn, **kwargs):
     :param modelimage: model image as numpy.array (phase center at Nx/2,Ny/2)
     :param predfn: prediction function e.g. `simple_predict`,
       `w_slice_predict` or `w_cache_predict`.
+    :param scale: Factor to apply to `p` first, see `do_imaging`
     :returns: predicted visibilities
     """
-    ximage = fft(modelimage.astype(complex))
-    return predfn(theta, lam, p, ximage, **kwargs)
+    ximage = fft(modelimage.astype(grid_dtype(modelimage)))
+    return predfn(theta, lam, p, ximage, scale=scale, **kwargs)
+
+
+def do_mfs_predict(theta, lam, p, x, modelimages, predfn, **kwargs):
+    """Predict visibilities of all channels from Taylor term images
+
+    The model at fractional frequency offset `x` is `sum_t x**t I_t`, so
+    every term image only gets transformed and degridded once for all
+    channels.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities of all channels (wavelengths)
+    :param x: Fractional frequency offset `(f - f0) / f0` of every visibility
+    :param modelimages: Taylor term images `[nterms, N, N]`
+    :param predfn: prediction function, see `do_predict`
+    :returns: predicted visibilities
+    """
+    x = numpy.asarray(x)
+    v = do_predict(theta, lam, p, modelimages[0], predfn, **kwargs)
+    for t in range(1, len(modelimages)):
+        v += x ** t * do_predict(theta, lam, p, modelimages[t], predfn, **kwargs)
+    return v
@@ -1,14 +1,17 @@
 # Tim Cornwell <realtimcornwell@gmail.com>
 #
-# Visibility data structure: a Table with columns ['uvw', 'time', 'antenna1', 'antenna2', 'vis', 'weight']
+# Visibility data structure: numpy arrays ['uvw', 'time', 'antenna1', 'antenna2', 'vis', 'weight']
 # and an attached attribute which is the frequency of each channel
 
 import profile
 import copy
+import io
+import json
+import os
 
 from astropy import constants as const
-from astropy.coordinates import SkyCoord, CartesianRepresentation
-from astropy.table import Table, vstack
+from astropy.coordinates import SkyCoord, CartesianRepresentation, EarthLocation
+from astropy.table import Table
 
 from crocodile.simulate import *
 
@@ -102,24 +105,24 @@ def combine_visibility(vis1: Visibility, vis2: Visibility, w1: float = 1.0, w2:
     log_parameters(params)
     assert len(vis1.frequency) == len(vis2.frequency), "Visibility: frequencies should be the same"
     assert numpy.max(numpy.abs(vis1.frequency - vis2.frequency)) < 1.0, "Visibility: frequencies should be the same"
-    assert len(vis1.data['vis']) == len(vis2.data['vis']), 'Length of output data table wrong'
+    assert len(vis1) == len(vis2), 'Length of output data table wrong'
     
-    log.debug("visibility.combine: combining tables with %d rows" % (len(vis1.data)))
+    log.debug("visibility.combine: combining tables with %d rows" % (len(vis1)))
     log.debug("visibility.combine: weights %f, %f" % (w1, w2))
-    vis = Visibility(vis=w1 * vis1.data['weight'] * vis1.data['vis'] + w2 * vis1.data['weight'] * vis2.data['vis'],
-                     weight=numpy.sqrt((w1 * vis1.data['weight']) ** 2 + (w2 * vis2.data['weight']) ** 2),
+    vis = Visibility(vis=w1 * vis1.weight * vis1.vis + w2 * vis1.weight * vis2.vis,
+                     weight=numpy.sqrt((w1 * vis1.weight) ** 2 + (w2 * vis2.weight) ** 2),
                      uvw=vis1.uvw,
                      time=vis1.time,
                      antenna1=vis1.antenna1,
                      antenna2=vis1.antenna2,
                      phasecentre=vis1.phasecentre,
                      frequency=vis1.frequency,
-                     configuration=vis1.configuration)
-    vis.data['vis'][vis.data['weight'] > 0.0] = vis.data['vis'][vis.data['weight'] > 0.0] / \
-                                                vis.data['weight'][vis.data['weight'] > 0.0]
-    vis.data['vis'][vis.data['weight'] <= 0.0] = 0.0
-    log.debug(u"combine_visibility: Created table with {0:d} rows".format(len(vis.data)))
-    assert len(vis.data['vis']) == len(vis1.data['vis']), 'Length of output data table wrong'
+                     configuration=vis1.configuration,
+                     imaging_weight=vis1.imaging_weight)
+    vis.vis[vis.weight > 0.0] = vis.vis[vis.weight > 0.0] / vis.weight[vis.weight > 0.0]
+    vis.vis[vis.weight <= 0.0] = 0.0
+    log.debug(u"combine_visibility: Created table with {0:d} rows".format(len(vis)))
+    assert len(vis) == len(vis1), 'Length of output data table wrong'
     return vis
 
 
@@ -138,14 +141,13 @@ def concatenate_visibility(vis1: Visibility, vis2: Visibility, params={}) -> \
     assert len(vis1.frequency) == len(vis2.frequency), "Visibility: frequencies should be the same"
     assert numpy.max(numpy.abs(vis1.frequency - vis2.frequency)) < 1.0, "Visibility: frequencies should be the same"
     log.debug(
-        "visibility.concatenate: combining two tables with %d rows and %d rows" % (len(vis1.data), len(vis2.data)))
+        "visibility.concatenate: combining two tables with %d rows and %d rows" % (len(vis1), len(vis2)))
     fvis2rot = phaserotate_visibility(vis2, vis1.phasecentre)
-    vis = Visibility()
-    vis.data = vstack([vis1.data, fvis2rot.data], join_type='exact')
-    vis.phasecentre = vis1.phasecentre
-    vis.frequency = vis1.frequency
-    log.debug(u"concatenate_visibility: Created table with {0:d} rows".format(len(vis.data)))
-    assert (len(vis.data) == (len(vis1.data) + len(vis2.data))), 'Length of output data table wrong'
+    vis = Visibility(phasecentre=vis1.phasecentre, frequency=vis1.frequency, meta=vis1.meta)
+    for name in Visibility.columns:
+        setattr(vis, name, numpy.concatenate([getattr(vis1, name), getattr(fvis2rot, name)]))
+    log.debug(u"concatenate_visibility: Created table with {0:d} rows".format(len(vis)))
+    assert (len(vis) == (len(vis1) + len(vis2))), 'Length of output data table wrong'
     return vis
 
 
@@ -223,12 +225,8 @@ def create_visibility(config: Configuration, times: numpy.array, freq: numpy.arr
                 row += 1
     ruvw = xyz_to_baselines(ants_xyz, times, phasecentre.dec)
     log.debug(u"create_visibility: Created {0:d} rows".format(nrows))
-    vis = Visibility()
-    vis.data = Table(data=[ruvw, rtimes, rantenna1, rantenna2, rvis, rweight],
-                     names=['uvw', 'time', 'antenna1', 'antenna2', 'vis', 'weight'], meta=meta)
-    vis.frequency = freq
-    vis.phasecentre = phasecentre
-    vis.configuration = config
+    vis = Visibility(uvw=ruvw, time=rtimes, antenna1=rantenna1, antenna2=rantenna2, vis=rvis, weight=rweight,
+                     frequency=freq, phasecentre=phasecentre, configuration=config, meta=meta)
     return vis
 
 
@@ -245,27 +243,25 @@ def phaserotate_visibility(vis: Visibility, newphasecentre: SkyCoord, params={})
     log.debug('phaserotate_visibility: Relative cartesian representation of direction = (%f, %f, '
               '%f)' % (l, m, n))
     
-    # Copy object and make a new table
+    # Copy object, sharing the columns until they get replaced
     vis = copy.copy(vis)
-    vis.data = vis.data.copy()
     
     # No significant change?
     if numpy.abs(l) > 1e-15 or numpy.abs(m) > 1e-15:
         log.debug('phaserotate: Phase rotation from %s to %s' % (vis.phasecentre, newphasecentre))
         
         # We are going to update in-place, so make a copy
-        vis.data.replace_column('vis', vis.vis.copy())
+        vis.vis = vis.vis.copy()
         for channel in range(vis.nchan):
-            uvw = vis.uvw_lambda(channel)
-            phasor = simulate_point(uvw, l, m)
+            phasor = simulate_point(vis.uvw, l, m, vis.frequency[channel] / const.c.value)
             for pol in range(vis.npol):
                 log.debug('phaserotate: Phaserotating visibility for channel %d, polarisation %d' %
                           (channel, pol))
                 vis.vis[:, channel, pol] /= phasor
         
         # To rotate UVW, rotate into the global XYZ coordinate system and back
-        xyz = uvw_to_xyz(vis.data['uvw'], ha=-vis.phasecentre.ra, dec=vis.phasecentre.dec)
-        vis.data.replace_column('uvw', xyz_to_uvw(xyz, ha=-newphasecentre.ra, dec=newphasecentre.dec))
+        xyz = uvw_to_xyz(vis.uvw, ha=-vis.phasecentre.ra, dec=vis.phasecentre.dec)
+        vis.uvw = xyz_to_uvw(xyz, ha=-newphasecentre.ra, dec=newphasecentre.dec)
     
     vis.phasecentre = newphasecentre
     return vis
@@ -287,8 +283,7 @@ def sum_visibility(vis: Visibility, direction: SkyCoord, params={}) -> numpy.arr
     flux = numpy.zeros([vis.nchan, vis.npol])
     weight = numpy.zeros([vis.nchan, vis.npol])
     for channel in range(vis.nchan):
-        uvw = vis.uvw_lambda(channel)
-        phasor = numpy.conj(simulate_point(uvw, l,m))
+        phasor = numpy.conj(simulate_point(vis.uvw, l, m, vis.frequency[channel] / const.c.value))
         for pol in range(vis.npol):
             log.debug('sum_visibility: Summing visibility for channel %d, polarisation %d' % (
                 channel, pol))
@@ -301,39 +296,282 @@ def sum_visibility(vis: Visibility, direction: SkyCoord, params={}) -> numpy.arr
     return flux, weight
 
 
+def _visibility_store_header(vis: Visibility):
+    """ JSON header of a Visibility column store """
+    config = vis.configuration
+    if config is not None:
+        location = None
+        if config.location is not None:
+            location = [float(x.to('m').value) for x in config.location.geocentric]
+        config = {'name': config.name,
+                  'names': [str(name) for name in config.names],
+                  'xyz': numpy.asarray(config.xyz).tolist(),
+                  'mount': [str(mount) for mount in config.mount],
+                  'location': location}
+    phasecentre = vis.phasecentre
+    if phasecentre is not None:
+        phasecentre = {'ra': phasecentre.ra.deg, 'dec': phasecentre.dec.deg, 'frame': phasecentre.frame.name}
+    return {'version': 1,
+            'frequency': [float(f) for f in vis.frequency],
+            'phasecentre': phasecentre,
+            'configuration': config,
+            'meta': dict(vis.meta) if vis.meta else {}}
+
+
+def _append_npy(filename: str, a: numpy.array):
+    """ Append rows to a `.npy` file in place
+
+    The header written by `numpy.save` leaves room for the number of rows
+    to grow, so only the header and the new rows get written.
+    """
+    fmt = numpy.lib.format
+    with open(filename, 'r+b') as f:
+        version = fmt.read_magic(f)
+        read_header, write_header = {(1, 0): (fmt.read_array_header_1_0, fmt.write_array_header_1_0),
+                                     (2, 0): (fmt.read_array_header_2_0, fmt.write_array_header_2_0)}[version]
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        assert not fortran_order and shape[1:] == a.shape[1:], \
+            "Cannot append %s to column of shape %s in %s" % (str(a.shape), str(shape), filename)
+        header = io.BytesIO()
+        write_header(header, {'descr': fmt.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (shape[0] + a.shape[0],) + shape[1:]})
+        assert header.tell() == offset, "No room to grow the header of %s" % filename
+        f.seek(0, os.SEEK_END)
+        f.write(numpy.ascontiguousarray(a.astype(dtype, casting='same_kind', copy=False)).tobytes())
+        f.seek(0)
+        f.write(header.getvalue())
+
+
+def export_visibility_to_npy(vis: Visibility, path: str):
+    """ Write a Visibility to an on-disk column store
+
+    The store is a directory holding one `.npy` file per column and
+    `header.json` holding frequency, phase centre and configuration. It can
+    be grown using `append_visibility_to_npy` and opened without loading
+    the data using `import_visibility_from_npy`.
+
+    :param vis: Visibility
+    :type Visibility:
+    :param path: Name of store directory, replaced if it exists
+    :type str:
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'header.json'), 'w') as f:
+        json.dump(_visibility_store_header(vis), f, indent=1, default=str)
+    for name in Visibility.columns:
+        numpy.save(os.path.join(path, name + '.npy'), numpy.ascontiguousarray(getattr(vis, name)))
+    log.debug("export_visibility_to_npy: Wrote %d rows to %s" % (len(vis), path))
+
+
+def append_visibility_to_npy(vis: Visibility, path: str):
+    """ Append the rows of a Visibility to an on-disk column store
+
+    Creates the store if it does not exist yet, so that streaming
+    writers can call this for every chunk.
+
+    :param vis: Visibility with the same frequencies as the store
+    :type Visibility:
+    :param path: Name of store directory
+    :type str:
+    """
+    if not os.path.exists(os.path.join(path, 'header.json')):
+        return export_visibility_to_npy(vis, path)
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+    assert len(header['frequency']) == len(vis.frequency) and \
+        numpy.max(numpy.abs(numpy.array(header['frequency']) - vis.frequency)) < 1.0, \
+        "Visibility: frequencies should be the same"
+    for name in Visibility.columns:
+        _append_npy(os.path.join(path, name + '.npy'), getattr(vis, name))
+    log.debug("append_visibility_to_npy: Appended %d rows to %s" % (len(vis), path))
+
+
+def import_visibility_from_npy(path: str, mmap_mode='r') -> Visibility:
+    """ Open an on-disk column store as Visibility
+
+    With a `mmap_mode` the columns are memory-mapped, so data only gets
+    read from disk when it is accessed.
+
+    :param path: Name of store directory
+    :type str:
+    :param mmap_mode: `numpy.memmap` mode: 'r' (read-only), 'r+' (write
+      through), 'c' (copy on write), or None to load into memory
+    :returns: Visibility
+    """
+    with open(os.path.join(path, 'header.json')) as f:
+        header = json.load(f)
+    columns = {name: numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+               for name in Visibility.columns}
+    nrows = set(len(column) for column in columns.values())
+    assert len(nrows) == 1, "Columns of %s have different lengths" % path
+
+    config = header['configuration']
+    if config is not None:
+        location = config['location']
+        if location is not None:
+            location = EarthLocation.from_geocentric(*location, unit='m')
+        config = Configuration(name=config['name'], location=location, names=config['names'],
+                               xyz=numpy.array(config['xyz']), mount=config['mount'])
+    phasecentre = header['phasecentre']
+    if phasecentre is not None:
+        phasecentre = SkyCoord(ra=phasecentre['ra'], dec=phasecentre['dec'], unit='deg',
+                               frame=phasecentre['frame'])
+    log.debug("import_visibility_from_npy: Opened %d rows from %s" % (nrows.pop(), path))
+    return Visibility(frequency=numpy.array(header['frequency']), phasecentre=phasecentre,
+                      configuration=config, meta=header['meta'], **columns)
+
+
+def visibility_chunks(vis: Visibility, nrows=10000):
+    """ Split a Visibility into chunks of rows
+
+    The chunks are views, so splitting a Visibility opened with
+    `import_visibility_from_npy` does not read any data.
+
+    :param vis: Visibility
+    :type Visibility:
+    :param nrows: Number of rows per chunk
+    :returns: list of Visibility
+    """
+    return [vis.select(slice(row, row + nrows)) for row in range(0, len(vis), nrows)]
+
+
+def coalesce_groups(vis: Visibility, params={}):
+    """ Averaging groups for baseline-dependent coalescing
+
+    Every baseline gets averaged over as many consecutive integrations
+    as the decorrelation tolerance allows. Averaging a phase gradient of
+    `x` turns across the averaging interval reduces the amplitude by
+    `1-sinc(x)`, which is kept below 'coalesce_tolerance' for a source
+    at the corner of the field of view (set by 'npixel' and
+    'cellsize') at the highest frequency. The phase gradient follows
+    from the largest uv change between consecutive integrations of the
+    baseline, so short baselines get averaged much more.
+
+    Channels are averaged by the same factor for all baselines, as
+    allowed by the longest baseline.
+
+    :param vis: Visibility to be coalesced
+    :type Visibility:
+    :param params: 'coalesce_tolerance' (default 0.01), 'max_coalescence'
+      (maximum number of integrations or channels to average, default 100)
+    :returns: group index of every row, number of groups, channel averaging factor
+    """
+    tol = get_parameter(params, 'coalesce_tolerance', 0.01)
+    max_coal = get_parameter(params, 'max_coalescence', 100)
+    npixel = get_parameter(params, 'npixel', 512)
+    cellsize = get_parameter(params, 'cellsize', 0.0002)
+    lmax = npixel * cellsize / numpy.sqrt(2.0)
+    # Largest averaged phase gradient (turns) within tolerance: 1-sinc(x) ~ (pi x)**2/6
+    xmax = numpy.sqrt(6.0 * tol) / numpy.pi
+
+    frequency = numpy.asarray(vis.frequency, dtype=float)
+    uvw = vis.uvw * numpy.max(frequency) / const.c.value
+    times, itime = numpy.unique(vis.time, return_inverse=True)
+    bls, ibl = numpy.unique(numpy.transpose([vis.antenna1, vis.antenna2]), axis=0, return_inverse=True)
+    itime, ibl = itime.ravel(), ibl.ravel()
+    nbl = len(bls)
+
+    # Fastest uv change per integration of every baseline
+    order = numpy.lexsort((itime, ibl))
+    same = ibl[order][1:] == ibl[order][:-1]
+    duv = numpy.hypot(*numpy.diff(uvw[order, :2], axis=0).T) / numpy.maximum(numpy.diff(itime[order]), 1)
+    speed = numpy.zeros(nbl)
+    numpy.maximum.at(speed, ibl[order][1:][same], duv[same])
+    with numpy.errstate(divide='ignore'):
+        ntime = numpy.floor(xmax / (speed * lmax))
+    ntime = numpy.clip(ntime, 1, max_coal).astype(int)
+
+    # Channel averaging factor allowed by the longest baseline
+    nfreq = 1
+    if len(frequency) > 1:
+        dfrac = numpy.max(numpy.abs(numpy.diff(frequency))) / numpy.max(frequency)
+        uvmax = numpy.max(numpy.hypot(uvw[:, 0], uvw[:, 1]))
+        if uvmax * dfrac * lmax > 0:
+            nfreq = int(numpy.clip(numpy.floor(xmax / (uvmax * dfrac * lmax)), 1, max_coal))
+        else:
+            nfreq = max_coal
+        nfreq = min(nfreq, len(frequency))
+
+    # Group by (start of averaging interval, baseline), in time order
+    k = ntime[ibl]
+    key = (itime - itime % k) * nbl + ibl
+    keys, groups = numpy.unique(key, return_inverse=True)
+    log.debug("coalesce_groups: Averaging %d rows into %d, %d channels into %d" %
+              (len(key), len(keys), len(frequency), (len(frequency) + nfreq - 1) // nfreq))
+    return groups.ravel(), len(keys), nfreq
+
+
 def coalesce_visibility(vis: Visibility, params={}) -> Visibility:
     """ Coalesce visibilities in time and frequency according to baseline length
     
-    Creates new Visibility by averaging in time and frequency
+    Creates new Visibility by averaging in time and frequency, see
+    `coalesce_groups`. Visibilities are averaged using their weights,
+    the weights of averaged visibilities are summed. `uvw` and time are
+    averaged over the rows of a group.
     
     :param vis: Visibility to be coalesced
     :type Visibility:
+    :param params: See `coalesce_groups`
     :returns: Visibility after coalescing
     """
-    # TODO: implement
-
     log_parameters(params)
-    log.error("coalesce_visibility: not yet implemented")
-    return vis
+    groups, ngroups, nfreq = coalesce_groups(vis, params)
+    nrows, nchan, npol = vis.vis.shape
+    cchan = (nchan + nfreq - 1) // nfreq
+    ichan = numpy.arange(nchan) // nfreq
+
+    # Flat indices of (group, averaged channel, polarisation) for all samples
+    idx = ((groups[:, None, None] * cchan + ichan[None, :, None]) * npol +
+           numpy.arange(npol)[None, None, :]).ravel()
+    n = ngroups * cchan * npol
+    weight = vis.weight.astype(float).ravel()
+    wvis = weight * vis.vis.ravel()
+    cweight = numpy.bincount(idx, weight, n)
+    cvis = numpy.bincount(idx, wvis.real, n) + 1j * numpy.bincount(idx, wvis.imag, n)
+    cvis[cweight > 0.0] /= cweight[cweight > 0.0]
+    cvis[cweight <= 0.0] = 0.0
+
+    count = numpy.bincount(groups, minlength=ngroups)
+    cuvw = numpy.transpose([numpy.bincount(groups, vis.uvw[:, i], ngroups)
+                            for i in range(3)]) / count[:, None]
+    ctime = numpy.bincount(groups, vis.time, ngroups) / count
+    cantenna1 = numpy.zeros(ngroups, dtype='int')
+    cantenna2 = numpy.zeros(ngroups, dtype='int')
+    cantenna1[groups] = vis.antenna1
+    cantenna2[groups] = vis.antenna2
+    frequency = numpy.bincount(ichan, numpy.asarray(vis.frequency, dtype=float)) / numpy.bincount(ichan)
+
+    log.debug("coalesce_visibility: Created table with %d rows from %d rows" % (ngroups, nrows))
+    return Visibility(uvw=cuvw, time=ctime, antenna1=cantenna1, antenna2=cantenna2,
+                      vis=cvis.reshape(ngroups, cchan, npol), weight=cweight.reshape(ngroups, cchan, npol),
+                      frequency=frequency, phasecentre=vis.phasecentre, configuration=vis.configuration)
 
 
 def de_coalesce_visibility(vis: Visibility, vistemplate: Visibility, params={}) -> Visibility:
     """ De-coalesce visibility in time and frequency i.e. replicate to template Visibility
     
     This is the opposite of coalescing - the Visibility is expanded into sampling independent
-    of baseline length.
+    of baseline length. Every row and channel of the template gets the
+    value of the averaged sample it was coalesced into, using the
+    same parameters as `coalesce_visibility`.
     
     :param vis: Visibility to be de-coalesced
     :type Visibility: Visibility
     :param vistemplate: template Visibility
     :type Visibility: Visibility
+    :param params: Parameters passed to `coalesce_visibility`
     :returns: Visibility after de-coalescing
     """
-    # TODO: implement
-
     log_parameters(params)
-    log.error("de_coalesce_visibility: not yet implemented")
-    return vis
+    groups, ngroups, nfreq = coalesce_groups(vistemplate, params)
+    ichan = numpy.arange(vistemplate.nchan) // nfreq
+    assert vis.vis.shape == (ngroups, ichan[-1] + 1, vistemplate.npol), \
+        "Visibility was not coalesced from template"
+    dvis = vistemplate.copy()
+    dvis.vis = vis.vis[groups[:, None], ichan[None, :], :]
+    log.debug("de_coalesce_visibility: Created table with %d rows from %d rows" % (len(groups), ngroups))
+    return dvis
 
 
 def aq_visibility(vis, params={}):
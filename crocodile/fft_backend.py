@@ -0,0 +1,253 @@
+# FFT backend
+"""FFT backend used by all imaging and deconvolution code
+
+Two-dimensional transforms always act on the last two axes, so stacks
+of grids or images get transformed in one call. Three backends are
+available:
+
+- `scipy`: `scipy.fft`, multithreaded using `workers` (default, one
+  per CPU)
+- `pyfftw`: FFTW through pyFFTW, only if installed. Plans get created
+  once per shape and type and then reused.
+- `numpy`: `numpy.fft`, single threaded
+
+The default can be set with the environment variables
+`CROCODILE_FFT_BACKEND` and `CROCODILE_FFT_WORKERS`, or at run time
+using `set_fft_backend`.
+
+Grids and images are centred on `N//2` (see `crocodile.synthesis`).
+For even sizes the `fftshift`/`ifftshift` around a transform are the
+same as multiplying input and output by a checkerboard of signs, which
+`centred_fft2` and `centred_ifft2` apply in place instead of making
+shifted copies.
+"""
+
+import functools
+import os
+import threading
+
+import numpy
+import scipy.fft
+
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+BACKENDS = ['scipy', 'pyfftw', 'numpy']
+
+_state = {'backend': os.getenv('CROCODILE_FFT_BACKEND', 'scipy'),
+          'workers': int(os.getenv('CROCODILE_FFT_WORKERS', os.cpu_count() or 1))}
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def set_fft_backend(backend=None, workers=None):
+    """Select the FFT backend
+
+    :param backend: One of `BACKENDS`. Default: keep current
+    :param workers: Number of threads per transform. Default: keep current
+    """
+    if backend is not None:
+        if backend not in BACKENDS:
+            raise ValueError("Unknown FFT backend %s" % backend)
+        if backend == 'pyfftw' and pyfftw is None:
+            raise ImportError("FFT backend pyfftw requires pyFFTW to be installed")
+        _state['backend'] = backend
+    if workers is not None:
+        assert workers >= 1
+        _state['workers'] = workers
+    with _plans_lock:
+        _plans.clear()
+
+
+def get_fft_backend():
+    """Currently selected FFT backend
+
+    :returns: Pair of backend name and number of worker threads
+    """
+    return _state['backend'], _state['workers']
+
+
+def _pyfftw_plan(kind, shape, dtype, s, workers):
+    """Create pyFFTW plan for `_plan`"""
+    a = pyfftw.empty_aligned(shape, dtype=dtype)
+    builder = getattr(pyfftw.builders, kind)
+    kwargs = dict(axes=(-2, -1), threads=workers, planner_effort='FFTW_ESTIMATE',
+                  auto_align_input=True, avoid_copy=False)
+    if kind in ['fft2', 'ifft2']:
+        kwargs['overwrite_input'] = True
+    if s is not None:
+        kwargs['s'] = s
+    fftw = builder(a, **kwargs)
+    lock = threading.Lock()
+
+    def fn(x):
+        out = pyfftw.empty_aligned(fftw.output_shape, dtype=fftw.output_dtype)
+        # FFTW objects hold on to their arrays while executing
+        with lock:
+            return fftw(x, out)
+    return fn
+
+
+def _plan(kind, shape, dtype, s=None):
+    """Transform function for arrays of the given shape and type
+
+    Functions are cached per backend, shape and type. Input arrays
+    may get overwritten.
+
+    :param kind: `fft2`, `ifft2`, `rfft2` or `irfft2`
+    :param shape: Shape of input arrays
+    :param dtype: Type of input arrays
+    :param s: Output size of the transformed axes (`irfft2` only)
+    :returns: Function transforming an array
+    """
+    backend, workers = get_fft_backend()
+    key = (kind, shape, numpy.dtype(dtype).str, s, backend, workers)
+    with _plans_lock:
+        fn = _plans.get(key)
+        if fn is not None:
+            return fn
+    if backend == 'pyfftw':
+        fn = _pyfftw_plan(kind, shape, dtype, s, workers)
+    elif backend == 'scipy':
+        fn = functools.partial(getattr(scipy.fft, kind), s=s, axes=(-2, -1), workers=workers)
+        if kind in ['fft2', 'ifft2']:
+            fn = functools.partial(fn, overwrite_x=True)
+    else:
+        fn = functools.partial(getattr(numpy.fft, kind), s=s, axes=(-2, -1))
+    with _plans_lock:
+        return _plans.setdefault(key, fn)
+
+
+def fft2(a, overwrite=False):
+    """Forward FFT of the last two axes
+
+    :param a: Array to transform
+    :param overwrite: Allow destroying the input
+    """
+    a = a if overwrite else a.copy()
+    return _plan('fft2', a.shape, a.dtype)(a)
+
+
+def ifft2(a, overwrite=False):
+    """Inverse FFT of the last two axes
+
+    :param a: Array to transform
+    :param overwrite: Allow destroying the input
+    """
+    a = a if overwrite else a.copy()
+    return _plan('ifft2', a.shape, a.dtype)(a)
+
+
+def rfft2(a):
+    """Forward FFT of a real array over the last two axes
+
+    :param a: Real array to transform
+    :returns: Half of the transform, last axis of size `N//2+1`
+    """
+    return _plan('rfft2', a.shape, a.dtype)(a)
+
+
+def irfft2(a, s):
+    """Inverse of `rfft2`
+
+    :param a: Half of a Hermitian array, last axis of size `s[1]//2+1`
+    :param s: Size `(Ny, Nx)` of the real output
+    """
+    return _plan('irfft2', a.shape, a.dtype, tuple(s))(a)
+
+
+@functools.lru_cache(maxsize=32)
+def checkerboard(shape, dtype=numpy.float64):
+    """Signs `(-1)**(y+x)` for shifting the transform of an even-sized grid
+
+    :param shape: Shape `(Ny, Nx)`, both even
+    :param dtype: Type of the array
+    :returns: Read-only array
+    """
+    Ny, Nx = shape
+    signs = numpy.ones(shape, dtype=dtype)
+    signs[1::2, ::2] = -1
+    signs[::2, 1::2] = -1
+    signs.flags.writeable = False
+    return signs
+
+
+def shift_signs(shape, dtype):
+    """Sign patterns folding the centring shifts into a transform
+
+    For even `Ny, Nx`, `fftshift(fft2(ifftshift(a)))` equals
+    `fft2(a * before) * after`, and likewise for `ifft2`.
+
+    :param shape: Grid shape `(Ny, Nx)`
+    :param dtype: Type of the grid
+    :returns: Pair of sign arrays, or `None` for odd sizes
+    """
+    Ny, Nx = shape
+    if Ny % 2 or Nx % 2:
+        return None
+    rdtype = numpy.finfo(numpy.result_type(dtype, numpy.float32)).dtype
+    signs = checkerboard((Ny, Nx), rdtype)
+    if (Ny // 2 + Nx // 2) % 2:
+        return signs, -signs
+    return signs, signs
+
+
+@functools.lru_cache(maxsize=32)
+def rfft_shift_phases(shape, dtype=numpy.float64):
+    """Phases folding the centring shift of a real image into its half-plane transform
+
+    `irfft2(h * phases, shape)` equals `fftshift(irfft2(h, shape))`, and
+    `rfft2(a) * conj(phases)` equals `rfft2(ifftshift(a))`. For even
+    sizes these are the signs of `checkerboard`.
+
+    :param shape: Image shape `(Ny, Nx)`
+    :param dtype: Real type of the phases
+    :returns: Read-only array of shape `(Ny, Nx//2+1)`, real for even sizes
+    """
+    Ny, Nx = shape
+    if Ny % 2 == 0 and Nx % 2 == 0:
+        return checkerboard(shape, dtype)[:, :Nx // 2 + 1]
+    ky = numpy.arange(Ny) * (Ny // 2) % Ny / Ny
+    kx = numpy.arange(Nx // 2 + 1) * (Nx // 2) % Nx / Nx
+    phases = numpy.exp(-2j * numpy.pi * (ky[:, None] + kx)).astype(numpy.result_type(dtype, 1j))
+    phases.flags.writeable = False
+    return phases
+
+
+def _centred(kind, a, overwrite):
+    signs = shift_signs(a.shape[-2:], a.dtype)
+    if signs is None:
+        a = numpy.fft.ifftshift(a, axes=(-2, -1))
+        return numpy.fft.fftshift(_plan(kind, a.shape, a.dtype)(a), axes=(-2, -1))
+    if overwrite and numpy.iscomplexobj(a):
+        a *= signs[0]
+    else:
+        a = a * signs[0]
+    b = _plan(kind, a.shape, a.dtype)(a)
+    b *= signs[1]
+    return b
+
+
+def centred_fft2(a, overwrite=False):
+    """Forward FFT of grids centred on `N//2`
+
+    Same as `fftshift(fft2(ifftshift(a)))` over the last two axes.
+
+    :param a: Image(s) to transform
+    :param overwrite: Allow destroying the input
+    """
+    return _centred('fft2', a, overwrite)
+
+
+def centred_ifft2(a, overwrite=False):
+    """Inverse FFT of grids centred on `N//2`
+
+    Same as `fftshift(ifft2(ifftshift(a)))` over the last two axes.
+
+    :param a: Grid(s) to transform
+    :param overwrite: Allow destroying the input
+    """
+    return _centred('ifft2', a, overwrite)
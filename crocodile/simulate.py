@@ -189,7 +189,7 @@ def skycoord_to_lmn(pos: SkyCoord, phasecentre: SkyCoord):
 
 # ---------------------------------------------------------------------------------
 
-def simulate_point(dist_uvw, l, m):
+def simulate_point(dist_uvw, l, m, scale=1.0):
     """
     Simulate visibilities for unit amplitude point source at
     direction cosines (l,m) relative to the phase centre.
@@ -204,12 +204,14 @@ def simulate_point(dist_uvw, l, m):
     :param dist_uvw: :math:`(u,v,w)` distribution of projected baselines (in wavelengths)
     :param l: horizontal direction cosine relative to phase tracking centre
     :param m: orthogonal directon cosine relative to phase tracking centre
+    :param scale: Factor to convert `dist_uvw` to wavelengths, e.g.
+      frequency over speed of light for baselines in metres
     """
 
     # vector direction to source
     s = numpy.array([l, m, numpy.sqrt(1 - l ** 2 - m ** 2) - 1.0])
     # complex valued Visibility data
-    return numpy.exp(-2j * numpy.pi * numpy.dot(dist_uvw, s))
+    return numpy.exp(-2j * numpy.pi * numpy.dot(dist_uvw, s * scale))
 
 # ---------------------------------------------------------------------------------
 
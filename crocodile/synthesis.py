@@ -29,10 +29,20 @@ This is implemented for reference in
 
 from __future__ import division
 
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy
 import pylru
 import scipy.special
 
+from crocodile.fft_backend import centred_fft2, centred_ifft2
+from crocodile.simulate import visibility_shift
+
+# Memory budget (in bytes) for the temporary arrays of a single batch of
+# visibilities in the vectorised (de)gridding functions
+GRID_BATCH_BYTES = 64 * 1024 * 1024
+
 
 def ceil2(x):
     """Find next greater power of 2
@@ -83,7 +93,7 @@ def fft(a):
     :param a: image in `lm` coordinate space
     :returns: `uv` grid
     """
-    return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a)))
+    return centred_fft2(a)
 
 
 def ifft(a):
@@ -92,7 +102,7 @@ def ifft(a):
     :param a: `uv` grid to transform
     :returns: an image in `lm` coordinate space
     """
-    return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a)))
+    return centred_ifft2(a)
 
 
 def pad_mid(ff, N):
@@ -103,16 +113,17 @@ def pad_mid(ff, N):
     original field's size, which is equivalent to a convolution with a
     sinc pattern in the uv-grid.
 
-    :param ff: The input far field. Should be smaller than NxN.
+    :param ff: The input far field. Should be smaller than NxN. Leading
+      dimensions are treated as a stack of far fields.
     :param N:  The desired far field size
 
     """
 
-    N0, N0w = ff.shape
+    N0, N0w = ff.shape[-2:]
     if N == N0: return ff
     assert N > N0 and N0 == N0w
     return numpy.pad(ff,
-                     pad_width=2*[(N//2-N0//2, (N+1)//2-(N0+1)//2)],
+                     pad_width=(ff.ndim-2)*[(0, 0)] + 2*[(N//2-N0//2, (N+1)//2-(N0+1)//2)],
                      mode='constant',
                      constant_values=0.0)
 
@@ -211,13 +222,14 @@ def w_kernel_function(l, m, w):
     :param l: Horizontal image coordinates
     :param m: Vertical image coordinates
     :param N: Size of the grid in pixels
-    :param w: Baseline distance to the projection plane
+    :param w: Baseline distance to the projection plane. If an array
+      is passed, one far field is returned per w value.
     :returns: N x N array with the far field
     """
 
     r2 = l**2 + m**2
     assert numpy.all(r2 < 1.0), "Error in image coordinate system: l %s, m %s" % (l, m)
-    ph = w * (1 - numpy.sqrt(1.0 - r2))
+    ph = numpy.multiply.outer(w, 1 - numpy.sqrt(1.0 - r2))
     cp = numpy.exp(2j * numpy.pi * ph)
     return cp
 
@@ -230,11 +242,12 @@ def kernel_oversample(ff, N, Qpx, s):
     If the far field size is smaller than N*Qpx, we will pad it. This
     essentially means we apply a sinc anti-aliasing kernel by default.
 
-    :param ff: Far field pattern
+    :param ff: Far field pattern. Leading dimensions are treated as a
+      stack of far fields, transformed together.
     :param N:  Image size without oversampling
     :param Qpx: Factor to oversample by -- there will be Qpx x Qpx convolution arl
     :param s: Size of convolution function to extract
-    :returns: Numpy array of shape [ov, ou, v, u], e.g. with sub-pixel
+    :returns: Numpy array of shape [..., ov, ou, v, u], e.g. with sub-pixel
       offsets as the outer coordinates.
     """
 
@@ -244,9 +257,17 @@ def kernel_oversample(ff, N, Qpx, s):
     # Obtain oversampled uv-grid
     af = ifft(padff)
 
-    # Extract kernels
-    res = [[extract_oversampled(af, x, y, Qpx, s) for x in range(Qpx)] for y in range(Qpx)]
-    return numpy.array(res)
+    # Extract kernels. This does the same as extract_oversampled
+    # for all offsets at once: Pixel (Qpx*i + Qpx-1-yf) of the block
+    # below belongs to kernel row i at offset yf.
+    Na = af.shape[-1]
+    m0 = Na//2 - Qpx*(s//2) - (Qpx-1)
+    assert m0 >= 0
+    mid = af[..., m0:m0+Qpx*s, m0:m0+Qpx*s]
+    mid = mid.reshape(af.shape[:-2] + (s, Qpx, s, Qpx))[..., ::-1, :, ::-1]
+    nd = af.ndim - 2
+    axes = tuple(range(nd)) + (nd+1, nd+3, nd, nd+2)
+    return Qpx * Qpx * numpy.transpose(mid, axes)
 
 
 def w_kernel(theta, w, NpixFF, NpixKern, Qpx, **kwargs):
@@ -269,6 +290,33 @@ def w_kernel(theta, w, NpixFF, NpixKern, Qpx, **kwargs):
     return kernel_oversample(kern, NpixFF, Qpx, NpixKern)
 
 
+def w_kernels(theta, ws, NpixFF, NpixKern, Qpx, max_batch_bytes=GRID_BATCH_BYTES, **kwargs):
+    """W convolution kernels for many w values at once
+
+    Same as calling `w_kernel` for every w, but the far fields of a
+    batch of w values get transformed using one FFT call.
+
+    :param theta: Field of view (directional cosines)
+    :param ws: Baseline distances to the projection plane
+    :param NpixFF: Far field size. Must be at least NpixKern+1 if Qpx > 1, otherwise NpixKern.
+    :param NpixKern: Size of convolution function to extract
+    :param Qpx: Oversampling, pixels will be Qpx smaller in aperture
+      plane than required to minimially sample theta.
+    :param max_batch_bytes: Memory budget for the padded far fields of a batch
+    :returns: [len(ws),Qpx,Qpx,s,s] shaped oversampled convolution kernels
+    """
+    assert NpixFF > NpixKern or (NpixFF == NpixKern and Qpx == 1)
+
+    l,m = kernel_coordinates(NpixFF, theta, **kwargs)
+    ws = numpy.asarray(ws, dtype=float)
+    nbatch = max(1, max_batch_bytes // (16 * (NpixFF * Qpx) ** 2))
+    kernels = numpy.empty((len(ws), Qpx, Qpx, NpixKern, NpixKern), dtype=complex)
+    for b in range(0, len(ws), nbatch):
+        kern = w_kernel_function(l, m, ws[b:b+nbatch])
+        kernels[b:b+nbatch] = kernel_oversample(kern, NpixFF, Qpx, NpixKern)
+    return kernels
+
+
 def invert_kernel(a):
     """
     Pseudo-Invert a kernel: element-wise inversion (see RauThesis2010:Eq4.6)
@@ -289,8 +337,7 @@ def grid(a, p, v):
 
     N = a.shape[0]
     xy = N//2 + numpy.floor(0.5 + N * p[:,0:2]).astype(int)
-    for (x, y), v in zip(xy, v):
-        a[y, x] += v
+    scatter_add(a, xy[:,1] * a.shape[1] + xy[:,0], numpy.asarray(v))
 
 
 def degrid(a, p):
@@ -304,8 +351,7 @@ def degrid(a, p):
 
     N = a.shape[0]
     xy = N//2 + numpy.floor(0.5 + p[:,0:2] * N).astype(int)
-    v = [ a[y,x] for x,y in xy ]
-    return numpy.array(v)
+    return a[xy[:,1], xy[:,0]]
 
 
 def frac_coord(N, Qpx, p):
@@ -342,44 +388,149 @@ def frac_coords(shape, Qpx, p):
     return x,xf, y,yf
 
 
-def convgrid(gcf, a, p, v):
+def footprint_indices(shape, gh, gw, x, y):
+    """Flat grid indices of convolution kernel footprints
+
+    The footprint of a (gh, gw) kernel centred at (x, y) covers the
+    grid cells `[y-gh//2 : y+(gh+1)//2, x-gw//2 : x+(gw+1)//2]`, the
+    same cells `convgrid` updated using slices.
+
+    :param shape: (height,width) grid shape
+    :param gh: Kernel height
+    :param gw: Kernel width
+    :param x: Horizontal grid coordinates of kernel centres
+    :param y: Vertical grid coordinates of kernel centres
+    :returns: [len(x), gh, gw] array of indices into the flattened grid
+    """
+    h, w = shape
+    assert len(x) == 0 or (numpy.min(x) >= gw//2 and numpy.max(x) + (gw+1)//2 <= w and
+                           numpy.min(y) >= gh//2 and numpy.max(y) + (gh+1)//2 <= h), \
+        "Kernel footprint outside of grid"
+    dy = numpy.arange(gh) - gh//2
+    dx = numpy.arange(gw) - gw//2
+    return (y[:, None, None] + dy[None, :, None]) * w + (x[:, None, None] + dx[None, None, :])
+
+
+def offset_groups(Qpx, xf, yf):
+    """Group visibilities by oversampling offset
+
+    :param Qpx: Oversampling factor
+    :param xf: Horizontal fractional offsets (see `frac_coords`)
+    :param yf: Vertical fractional offsets (see `frac_coords`)
+    :returns: List of (xf, yf, indices) triples, one per offset in use
+    """
+    key = yf * Qpx + xf
+    order = numpy.argsort(key, kind='stable')
+    skey = key[order]
+    bounds = numpy.hstack([[0], numpy.flatnonzero(numpy.diff(skey)) + 1, [len(skey)]])
+    return [ (skey[i0] % Qpx, skey[i0] // Qpx, order[i0:i1])
+             for i0, i1 in zip(bounds[:-1], bounds[1:]) if i1 > i0 ]
+
+
+def batch_size(gh, gw, max_batch_bytes, itemsize=32):
+    """Number of visibilities that can be processed in one batch
+
+    :param gh: Kernel height
+    :param gw: Kernel width
+    :param max_batch_bytes: Memory budget for temporary arrays
+    :param itemsize: Bytes of temporaries needed per footprint pixel
+    """
+    return max(1, int(max_batch_bytes // (gh * gw * itemsize)))
+
+
+def scatter_add(a, idx, vals):
+    """Accumulate values at flat grid indices
+
+    Duplicate indices are summed. Uses `bincount` over the range of
+    grid cells actually touched, separately for real and imaginary
+    parts.
+
+    :param a: Grid to add to (updated in-place!)
+    :param idx: Indices into the flattened grid
+    :param vals: Values to add, same shape as `idx`
+    """
+    idx = idx.ravel()
+    vals = vals.ravel()
+    if len(idx) == 0:
+        return
+    if not a.flags.c_contiguous:
+        numpy.add.at(a, numpy.unravel_index(idx, a.shape), vals)
+        return
+    lo = numpy.min(idx)
+    n = numpy.max(idx) + 1 - lo
+    flat = a.reshape(-1)[lo:lo+n]
+    idx = idx - lo
+    if numpy.iscomplexobj(flat):
+        flat.real += numpy.bincount(idx, numpy.real(vals), n)
+        flat.imag += numpy.bincount(idx, numpy.imag(vals), n)
+    else:
+        flat += numpy.bincount(idx, vals, n)
+
+
+def convgrid(gcf, a, p, v, max_batch_bytes=GRID_BATCH_BYTES):
     """Grid after convolving with gcf
 
     Takes into account fractional `uv` coordinate values where the GCF
-    is oversampled
+    is oversampled. Visibilities are grouped by oversampling offset,
+    so all visibilities of a group share the same kernel, and whole
+    groups are added to the grid at once using `scatter_add`.
 
     :param a: Grid to add to
     :param p: UVW positions
     :param v: Visibility values
     :param gcf: Oversampled convolution kernel
+    :param max_batch_bytes: Memory budget for the temporary arrays of
+      one batch of visibilities
     """
 
     Qpx, _, gh, gw = gcf.shape
-    coords = frac_coords(a.shape, Qpx, p)
-    for v, x,xf, y,yf in zip(v, *coords):
-        a[y-gh//2 : y+(gh+1)//2,
-          x-gw//2 : x+(gw+1)//2] += gcf[yf,xf] * v
+    x, xf, y, yf = frac_coords(a.shape, Qpx, p)
+    v = numpy.asarray(v)
+    step = batch_size(gh, gw, max_batch_bytes)
+    for gxf, gyf, ixs in offset_groups(Qpx, xf, yf):
+        kern = gcf[gyf, gxf]
+        for i in range(0, len(ixs), step):
+            bixs = ixs[i:i+step]
+            idx = footprint_indices(a.shape, gh, gw, x[bixs], y[bixs])
+            scatter_add(a, idx, v[bixs, None, None] * kern[None, :, :])
+
+
+def gather(a, idx):
+    """Read grid values at flat grid indices
+
+    :param a: Grid to read from
+    :param idx: Indices into the flattened grid
+    :returns: Array of grid values, same shape as `idx`
+    """
+    if a.flags.c_contiguous:
+        return a.reshape(-1)[idx]
+    return a[numpy.unravel_index(idx, a.shape)]
 
 
-def convdegrid(gcf, a, p):
+def convdegrid(gcf, a, p, max_batch_bytes=GRID_BATCH_BYTES):
     """Convolutional degridding
 
     Takes into account fractional `uv` coordinate values where the GCF
-    is oversampled
+    is oversampled. Visibilities are processed in blocks: the kernel
+    footprints of a block are gathered from the grid in one indexing
+    operation and reduced against the matching kernels using `einsum`.
 
     :param gcf: Oversampled convolution kernel
     :param a:   The uv plane to de-grid from
     :param p:   The coordinates to degrid at.
+    :param max_batch_bytes: Memory budget for the temporary arrays of
+      one block of visibilities
     :returns: Array of visibilities.
     """
     Qpx, _, gh, gw = gcf.shape
-    coords = frac_coords(a.shape, Qpx, p)
-    vis = [
-        numpy.sum(a[y-gh//2 : y+(gh+1)//2,
-                    x-gw//2 : x+(gw+1)//2] * gcf[yf,xf])
-        for x,xf, y,yf in zip(*coords)
-    ]
-    return numpy.array(vis)
+    x, xf, y, yf = frac_coords(a.shape, Qpx, p)
+    vis = numpy.empty(len(x), dtype=numpy.result_type(a, gcf))
+    step = batch_size(gh, gw, max_batch_bytes, itemsize=40)
+    for i in range(0, len(x), step):
+        b = slice(i, i+step)
+        idx = footprint_indices(a.shape, gh, gw, x[b], y[b])
+        vis[b] = numpy.einsum('ijk,ijk->i', gather(a, idx), gcf[yf[b], xf[b]])
+    return vis
 
 
 def sort_vis_w(p, v=None):
@@ -410,20 +561,61 @@ def slice_vis(step, p, v=None):
         return [ (p[i:i+step], v[i:i+step]) for i in ii ]
 
 
-def doweight(theta, lam, p, v):
+def bin_vis_w(wstep, p, v=None):
+    """ Bin visibilities by w value.
+
+    Visibilities are sorted by w and split into bins of width `wstep`
+    centred on multiples of `wstep`, so that every visibility of a bin
+    is (de)gridded with the same w-kernel.
+
+    :param wstep: Size of w-bins
+    :param p: uvw coordinates
+    :param v: Visibility values (optional)
+    :returns: List of (w-bin centre, uvw) or (w-bin centre, uvw, visibility) triples
+    """
+    zs = numpy.argsort(p[:, 2], kind='stable')
+    wbins = numpy.round(p[zs, 2] / wstep)
+    bounds = numpy.hstack([[0], numpy.flatnonzero(numpy.diff(wbins)) + 1, [len(zs)]])
+    res = []
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        if i1 == i0:
+            continue
+        ixs = zs[i0:i1]
+        if v is None:
+            res.append((wstep * wbins[i0], p[ixs]))
+        else:
+            res.append((wstep * wbins[i0], p[ixs], v[ixs]))
+    return res
+
+
+def doweight(theta, lam, p, v, density=None, return_density=False):
     """Re-weight visibilities
 
+    Divides every visibility by the number of visibilities falling
+    into the same grid cell (uniform weighting).
+
     Note that as is usual, convolution kernels are not taken into account
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param v: Visibility values
+    :param density: Gridded visibility density from an earlier call
+      with the same `p`. Computed if not passed.
+    :param return_density: Also return the density grid?
+    :returns: Re-weighted visibilities, or pair of visibilities and
+      density grid if `return_density` is set
     """
     N = int(round(theta * lam))
     assert N > 1
-    gw = numpy.zeros([N, N])
-    x, xf, y, yf = frac_coords(gw.shape, 1, p / lam)
-    for i in range(len(x)):
-        gw[x[i], y[i]] += 1
-    v = v.copy()
-    for i in range(len(x)):
-        v[i] /= gw[x[i], y[i]]
+    x, xf, y, yf = frac_coords((N, N), 1, p / lam)
+    idx = y * N + x
+    if density is None:
+        density = numpy.bincount(idx, minlength=N*N).reshape(N, N).astype(float)
+    assert density.shape == (N, N)
+    v = v / density.reshape(-1)[idx]
+    if return_density:
+        return v, density
     return v
 
 
@@ -588,11 +780,14 @@ def w_cache_imaging(theta, lam, p, v,
     # traversed in w-order it only needs to hold the last w-kernel.
     if kernel_cache is None:
         kernel_cache = pylru.FunctionCacheManager(kernel_fn, 1)
-    # Bin w values, then run slice imager with slice size of 1
-    def kernel_binner(theta, w, **kw):
-        wbin = wstep * numpy.round(w / wstep)
-        return kernel_cache(theta, wbin, **kw)
-    return w_slice_imaging(theta, lam, p, v, 1, kernel_binner, **kwargs)
+    # Bin w values, then grid every bin in one go with its kernel
+    N = int(round(theta * lam))
+    assert N > 1
+    guv = numpy.zeros([N, N], dtype=complex)
+    for wbin, ps, vs in bin_vis_w(wstep, p, v):
+        wg = numpy.conj(kernel_cache(theta, wbin, **kwargs))
+        convgrid(wg, guv, ps / lam, vs)
+    return guv
 
 
 def w_cache_predict(theta, lam, p, guv,
@@ -616,10 +811,285 @@ def w_cache_predict(theta, lam, p, guv,
 
     if kernel_cache is None:
         kernel_cache = pylru.FunctionCacheManager(kernel_fn, 1)
-    def kernel_binner(theta, w, **kw):
-        wbin = wstep * numpy.round(w / wstep)
-        return kernel_cache(theta, wbin, **kw)
-    return w_slice_predict(theta, lam, p, guv, 1, kernel_binner, **kwargs)
+    # Bin w values, keeping visibility indices to undo the sort
+    nv = len(p)
+    v = numpy.ndarray(nv, dtype=complex)
+    for wbin, ps, ixs in bin_vis_w(wstep, p, numpy.arange(nv)):
+        wg = kernel_cache(theta, wbin, **kwargs)
+        v[ixs] = convdegrid(wg, guv, ps / lam)
+    return v
+
+
+def prolate_taper(N, support):
+    """Prolate spheroidal taper for gridding
+
+    Multiplying the far field of a kernel with this taper concentrates
+    the uv-footprint of every visibility to about `support` grid cells,
+    so the kernel can be truncated with little error. It is evaluated
+    slightly beyond the field of view (95%) so that it does not reach
+    zero at the image edges, where it must be divided out again.
+
+    :param N: Image size in pixels
+    :param support: Width of the visibility footprint in the uv grid (cells)
+    :returns: N x N taper
+    """
+    c = numpy.pi * support / 2
+    t = scipy.special.pro_ang1(0, 0, c, 2 * 0.95 * coordinates(N))[0]
+    t /= t[N // 2]
+    return numpy.outer(t, t)
+
+
+def w_facet_kernel(theta, w, NpixFF, NpixKern, Qpx, dl=0, dm=0, support=None, dtype=complex):
+    """W convolution kernel for a facet centred at `(dl, dm)`
+
+    Only the curvature of the w-term across the facet is left in the
+    kernel: the constant and linear parts of the w-term at the facet
+    centre are removed from the visibilities by `facet_transform`
+    instead. This keeps the kernel small even for facets far away
+    from the phase centre.
+
+    With `support` the far field gets multiplied with `prolate_taper`,
+    which then has to be divided out of the facet image again.
+
+    :param theta: Field of view of the facet (directional cosines)
+    :param w: Baseline distance to the projection plane
+    :param NpixFF: Far field size. Must be at least NpixKern+1 if Qpx > 1, otherwise NpixKern.
+    :param NpixKern: Size of convolution function to extract
+    :param Qpx: Oversampling, pixels will be Qpx smaller in aperture
+      plane than required to minimially sample theta.
+    :param dl: Horizontal facet centre (directional cosine)
+    :param dm: Vertical facet centre (directional cosine)
+    :param support: Support of the taper (cells). Default: no taper
+    :param dtype: Type of the returned kernels, e.g. `numpy.complex64`
+    :returns: [Qpx,Qpx,s,s] shaped oversampled convolution kernels
+    """
+    assert NpixFF > NpixKern or (NpixFF == NpixKern and Qpx == 1)
+
+    m, l = kernel_coordinates(NpixFF, theta, dl=dl, dm=dm)
+    r2 = l**2 + m**2
+    assert numpy.all(r2 < 1.0), "Error in image coordinate system: l %s, m %s" % (l, m)
+    nc = numpy.sqrt(1.0 - dl**2 - dm**2)
+    ph = nc - numpy.sqrt(1.0 - r2) - dl / nc * (l - dl) - dm / nc * (m - dm)
+    ff = numpy.exp(2j * numpy.pi * w * ph)
+    if support is not None:
+        ff *= prolate_taper(NpixFF, support)
+    return kernel_oversample(ff, NpixFF, Qpx, NpixKern).astype(dtype, copy=False)
+
+
+def facet_phasor(p, dl, dm):
+    """Phase factors moving the facet at `(dl, dm)` to the phase centre
+
+    Shifts the facet centre to the phase centre using
+    `visibility_shift`, and removes the constant part of the w-term
+    at the facet centre.
+
+    :param p: UVWs of visibilities (wavelengths)
+    :param dl: Horizontal facet centre (directional cosine)
+    :param dm: Vertical facet centre (directional cosine)
+    :returns: Phase factor for every visibility
+    """
+
+    nc = numpy.sqrt(1.0 - dl**2 - dm**2)
+    return visibility_shift(p, numpy.exp(2j * numpy.pi * p[:, 2] * (nc - 1)), -dl, -dm)
+
+
+def facet_transform(p, v, dl, dm, scale=1.0):
+    """Re-centre visibilities on the facet at `(dl, dm)`
+
+    Applies `facet_phasor`, then removes the gradient of the w-term at
+    the facet centre by shearing the uv-coordinates with w. Use
+    `w_facet_kernel` to grid the result.
+
+    :param p: UVWs of visibilities
+    :param v: Visibilities, `[nvis]` or `[nvis, nrhs]`. If None, only
+      the UVWs get transformed.
+    :param dl: Horizontal facet centre (directional cosine)
+    :param dm: Vertical facet centre (directional cosine)
+    :param scale: Factor to apply to `p` first, e.g. to convert UVWs
+      in metres to wavelengths
+    :returns: Transformed UVWs (wavelengths) and visibilities
+    """
+
+    nc = numpy.sqrt(1.0 - dl**2 - dm**2)
+    pt = numpy.array(p, dtype=float) * scale
+    ph = None if v is None else facet_phasor(pt, dl, dm)
+    pt[:, 0] -= pt[:, 2] * dl / nc
+    pt[:, 1] -= pt[:, 2] * dm / nc
+    if v is None:
+        return pt, None
+    v = numpy.asarray(v)
+    ph = ph.astype(numpy.result_type(v, numpy.complex64))
+    return pt, v * ph.reshape((-1,) + (1,) * (v.ndim - 1))
+
+
+def facet_untransform(p, v, dl, dm, scale=1.0):
+    """Undo `facet_transform` on visibilities predicted for a facet
+
+    :param p: Original UVWs of visibilities
+    :param v: Visibilities predicted using transformed UVWs
+    :param dl: Horizontal facet centre (directional cosine)
+    :param dm: Vertical facet centre (directional cosine)
+    :param scale: Factor to apply to `p` first
+    :returns: Visibilities relative to the original phase centre
+    """
+
+    return v * numpy.conj(facet_phasor(p * scale, dl, dm)).astype(v.dtype)
+
+
+def facet_centres(N, theta, facets):
+    """Pixel ranges and centres of a `facets` x `facets` facet layout
+
+    :param N: Image size in pixels, must be divisible by `facets`
+    :param theta: Field of view (directional cosines)
+    :param facets: Number of facets along each axis
+    :returns: List of `(y0, x0, dl, dm)`, with `y0, x0` the first
+      pixel of the facet and `(dl, dm)` the facet centre
+    """
+
+    assert N % facets == 0, "Image size %d not divisible by %d facets" % (N, facets)
+    Nf = N // facets
+    res = []
+    for y0 in range(0, N, Nf):
+        for x0 in range(0, N, Nf):
+            res.append((y0, x0,
+                        (x0 + Nf // 2 - N // 2) * theta / N,
+                        (y0 + Nf // 2 - N // 2) * theta / N))
+    return res
+
+
+def facet_imaging(theta, lam, p, v,
+                  facets=3,
+                  overlap=0,
+                  support=None,
+                  imgfn=w_cache_imaging,
+                  kernel_fn=w_facet_kernel,
+                  nworkers=1,
+                  scale=1.0,
+                  **kwargs):
+    """Faceted imaging
+
+    Splits the field into `facets` x `facets` facets, images every
+    facet separately with `imgfn` and stitches the facet images
+    together. Facets only cover a fraction of the field of view, so
+    their w-kernels can be much smaller.
+
+    Every facet gets imaged `overlap` pixels larger on each side and
+    only its inner part is used, as errors are largest at the facet
+    edges, where the taper of `w_facet_kernel` is divided out.
+
+    Unlike the other imaging functions this returns the image, as the
+    facets are stitched together in image space (see `returns_image`).
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param v: Visibilities to be imaged, `[nvis]`, or `[nvis, nrhs]`
+      if `imgfn` supports stacks of visibilities
+    :param facets: Number of facets along each axis
+    :param overlap: Pixels to image beyond the facet edges
+    :param support: Support of the kernel taper (cells), see `w_facet_kernel`
+    :param imgfn: Imaging function to use per facet, must accept `kernel_fn`
+    :param kernel_fn: Kernel function, must accept `dl`, `dm` and `support`
+    :param nworkers: Number of threads imaging facets in parallel
+    :param scale: Factor to apply to `p` first
+    :returns: Complex image
+    """
+
+    N = int(round(theta * lam))
+    Nf = N // facets
+    Np = Nf + 2 * overlap
+    v = numpy.asarray(v)
+    img = numpy.zeros(v.shape[1:] + (N, N), dtype=numpy.result_type(v, numpy.complex64))
+    # Facet grids are smaller, correct the FFT normalisation
+    correction = (Np / N)**2 / (1.0 if support is None else prolate_taper(Np, support))
+
+    def image_facet(facet):
+        y0, x0, dl, dm = facet
+        pt, vt = facet_transform(p, v, dl, dm, scale)
+        guv = imgfn(theta * Np / N, lam, pt, vt,
+                    kernel_fn=kernel_fn, dl=dl, dm=dm, support=support, **kwargs)
+        fimg = ifft(guv) * correction
+        img[..., y0:y0+Nf, x0:x0+Nf] = fimg[..., overlap:overlap+Nf, overlap:overlap+Nf]
+
+    fcs = facet_centres(N, theta, facets)
+    if nworkers > 1:
+        with ThreadPoolExecutor(nworkers) as executor:
+            list(executor.map(image_facet, fcs))
+    else:
+        for facet in fcs:
+            image_facet(facet)
+    return img
+
+
+facet_imaging.image_plane = True
+
+
+def facet_predict(theta, lam, p, guv,
+                  facets=3,
+                  overlap=0,
+                  support=None,
+                  predfn=w_cache_predict,
+                  kernel_fn=w_facet_kernel,
+                  nworkers=1,
+                  scale=1.0,
+                  **kwargs):
+    """Faceted prediction, the reverse of `facet_imaging`
+
+    Every facet of the model gets padded by `overlap` pixels of zeros,
+    so that the taper only gets divided out where it is large.
+
+    :param theta: Field of view (directional cosines)
+    :param lam: UV grid range (wavelenghts)
+    :param p: UVWs of visibilities (wavelengths)
+    :param guv: Input uv grid to de-grid from
+    :param facets: Number of facets along each axis
+    :param overlap: Pixels to pad facets by
+    :param support: Support of the kernel taper (cells), see `w_facet_kernel`
+    :param predfn: Prediction function to use per facet, must accept `kernel_fn`
+    :param kernel_fn: Kernel function, must accept `dl`, `dm` and `support`
+    :param nworkers: Number of threads predicting facets in parallel
+    :param scale: Factor to apply to `p` first
+    :returns: predicted visibilities
+    """
+
+    N = guv.shape[0]
+    Nf = N // facets
+    Np = Nf + 2 * overlap
+    img = ifft(guv)
+    taper = 1.0 if support is None else prolate_taper(Np, support)
+
+    def predict_facet(facet):
+        y0, x0, dl, dm = facet
+        fimg = numpy.zeros([Np, Np], dtype=img.dtype)
+        fimg[overlap:overlap+Nf, overlap:overlap+Nf] = img[y0:y0+Nf, x0:x0+Nf]
+        pt, _ = facet_transform(p, None, dl, dm, scale)
+        vt = predfn(theta * Np / N, lam, pt, fft((fimg / taper).astype(img.dtype)),
+                    kernel_fn=kernel_fn, dl=dl, dm=dm, support=support, **kwargs)
+        return facet_untransform(p, vt, dl, dm, scale)
+
+    fcs = facet_centres(N, theta, facets)
+    if nworkers > 1:
+        with ThreadPoolExecutor(nworkers) as executor:
+            return sum(executor.map(predict_facet, fcs))
+    return sum(map(predict_facet, fcs))
+
+
+def returns_image(imgfn):
+    """Whether the imaging function `imgfn` returns an image
+
+    Imaging functions working in image space, such as `facet_imaging`,
+    set the attribute `image_plane` to return their image instead of a
+    uv grid. Partial applications get looked through, as do wrappers
+    that get passed an `imgfn`.
+
+    :param imgfn: Imaging function
+    :returns: True if `imgfn` returns images, False for uv grids
+    """
+    while isinstance(imgfn, functools.partial):
+        if getattr(imgfn.func, 'image_plane', False):
+            return True
+        imgfn = imgfn.keywords.get('imgfn', imgfn.func)
+    return getattr(imgfn, 'image_plane', False)
 
 
 def do_imaging(theta, lam, p, v, imgfn, **kwargs):
@@ -639,12 +1109,13 @@ def do_imaging(theta, lam, p, v, imgfn, **kwargs):
     v = numpy.hstack([v, numpy.conj(v)])
     # Determine weights
     wt = doweight(theta, lam, p, numpy.ones(len(p)))
-    # Make image
+    # Make image and point spread function
     cdrt = imgfn(theta, lam, p, wt * v, **kwargs)
-    drt = numpy.real(ifft(cdrt))
-    # Make point spread function
     c = imgfn(theta, lam, p, wt, **kwargs)
-    psf = numpy.real(ifft(c))
+    if not returns_image(imgfn):
+        cdrt, c = ifft(cdrt), ifft(c)
+    drt = numpy.real(cdrt)
+    psf = numpy.real(c)
     # Normalise
     pmax = psf.max()
     assert pmax > 0.0
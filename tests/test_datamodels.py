@@ -70,6 +70,32 @@ class TestDataModels(unittest.TestCase):
         log.debug(vis.frequency)
         self.assertEqual(len(numpy.unique(vis.data['time'])), len(times))
 
+    def test_visibility_columns(self):
+        config = create_named_configuration('VLAA')
+        times = numpy.arange(-3.0, +3.0, 3.0 / 60.0) * numpy.pi / 12.0
+        freq = numpy.arange(5e6, 150.0e6, 1e7)
+        direction = SkyCoord('00h42m30s', '-41d12m00s', frame='icrs')
+        vis = create_visibility(config, times, freq, weight=1.0, phasecentre=direction)
+        self.assertIsInstance(vis.vis, numpy.ndarray)
+        # Table view and row slices share memory with the Visibility
+        vis.data['vis'][0] = 1.0
+        vis.select(slice(0, 10)).vis[1] = 2.0
+        assert_allclose(vis.vis[:2, 0, 0], [1.0, 2.0])
+        # Copies and conversion from a Table do not
+        vcopy = vis.copy()
+        vcopy.vis[0] = 3.0
+        assert_allclose(vis.vis[0], 1.0)
+        vtable = Visibility(data=vis.data.copy(), frequency=freq, phasecentre=direction)
+        self.assertEqual(len(vtable), len(vis))
+        assert_allclose(vtable.uvw, vis.uvw)
+        # Coordinates in wavelengths are kept until uvw gets replaced
+        uvw = vis.uvw_lambdas
+        self.assertEqual(uvw.shape, (len(freq), len(vis), 3))
+        assert_allclose(uvw[3], vis.uvw_lambda(3))
+        self.assertIs(vis.uvw_lambdas, uvw)
+        vis.uvw = 2.0 * vis.uvw
+        assert_allclose(vis.uvw_lambdas, 2.0 * uvw)
+
     def test_visibility_from_oskar(self):
         for oskar_file in ["data/vis/vla_1src_6h/test_vla.vis",
                            "data/vis/vla_grid_6h/test_vla.vis"]:
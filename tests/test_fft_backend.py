@@ -0,0 +1,49 @@
+from crocodile.fft_backend import *
+
+import itertools
+import os
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+
+class TestFFTBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.default = get_fft_backend()
+
+    def tearDown(self):
+        set_fft_backend(*self.default)
+
+    def test_centred_fft(self):
+        # Must match the transforms with explicit shifts, for all
+        # backends, odd and even sizes, and stacks
+        np.random.seed(0)
+        backends = ['numpy', 'scipy'] + (['pyfftw'] if pyfftw is not None else [])
+        for backend, shape in itertools.product(backends, [(8, 8), (6, 10), (7, 7), (3, 4, 6)]):
+            set_fft_backend(backend, 2)
+            a = np.random.randn(*shape) + 1j * np.random.randn(*shape)
+            a0 = a.copy()
+            axes = (-2, -1)
+            assert_allclose(centred_fft2(a),
+                            np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(a0, axes)), axes), atol=1e-12)
+            assert_allclose(centred_ifft2(a),
+                            np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(a0, axes)), axes), atol=1e-12)
+            assert_allclose(a, a0)
+            # Single precision is kept
+            self.assertEqual(centred_fft2(a.astype(np.complex64), overwrite=True).dtype, np.complex64)
+            x = np.random.randn(*shape)
+            assert_allclose(irfft2(rfft2(x), shape[-2:]), x, atol=1e-12)
+            # Centring shifts of real images folded into the half-plane transform
+            phases = rfft_shift_phases(shape[-2:])
+            assert_allclose(irfft2(rfft2(x) * phases, shape[-2:]), np.fft.fftshift(x, axes), atol=1e-12)
+            assert_allclose(rfft2(x) * np.conj(phases), rfft2(np.fft.ifftshift(x, axes)), atol=1e-12)
+
+    def test_set_backend(self):
+        self.assertRaises(ValueError, set_fft_backend, 'fftpack')
+        set_fft_backend('numpy', 3)
+        self.assertEqual(get_fft_backend(), ('numpy', 3))
+        # By default every CPU is used
+        self.assertEqual(self.default[1], int(os.getenv('CROCODILE_FFT_WORKERS', os.cpu_count() or 1)))
+
+if __name__ == '__main__':
+    unittest.main()
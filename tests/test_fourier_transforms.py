@@ -12,10 +12,13 @@ from astropy import units as u
 
 from arl.skymodel_operations import create_skycomponent
 from arl.testing_support import create_named_configuration, filter_configuration
-from arl.image_operations import export_image_to_fits
+from arl.image_operations import export_image_to_fits, create_image_from_array
+from arl.data_models import SkyModel
 from arl.skymodel_operations import create_skymodel_from_component, find_skycomponent, fit_skycomponent
-from arl.visibility_operations import create_visibility, sum_visibility
-from arl.fourier_transforms import predict_visibility, invert_visibility
+from arl.visibility_operations import create_visibility, sum_visibility, visibility_chunks
+from arl.fourier_transforms import predict_visibility, invert_visibility, invert_visibility_stream, \
+    weight_visibility
+from crocodile.simulate import simulate_point, skycoord_to_lmn
 
 import logging
 log = logging.getLogger( "tests.test_fourier_transforms" )
@@ -78,6 +81,136 @@ class TestFourierTransforms(unittest.TestCase):
         assert_allclose(self.compabsdirection.dec.value, newcomp.direction.dec.value, atol=1e-2)
         assert_allclose(self.flux, newcomp.flux, rtol=0.05)
 
+class TestInvertVisibilityStream(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'wstep': 10.0, 'npixel': 256, 'cellsize': 0.0004}
+        vlaa = create_named_configuration('VLAA')
+        vlaa.data['xyz'] *= 1.0 / 30.0
+        times = numpy.arange(-3.0, +3.0, 6.0 / 30.0) * numpy.pi / 12.0
+        frequency = numpy.arange(1.0e8, 1.50e8, 2.0e7)
+        phasecentre = SkyCoord(ra=+15.0 * u.deg, dec=+35.0 * u.deg, frame='icrs')
+        self.compdirection = SkyCoord(ra=17.0 * u.deg, dec=+36.5 * u.deg, frame='icrs')
+        self.vis = create_visibility(vlaa, times, frequency, weight=1.0, phasecentre=phasecentre)
+        l, m, n = skycoord_to_lmn(self.compdirection, phasecentre)
+        for channel in range(len(frequency)):
+            for pol in range(self.vis.npol):
+                self.vis.vis[:, channel, pol] = (pol + 1) * simulate_point(self.vis.uvw_lambda(channel), l, m)
+
+    def test_stream(self):
+        dirty, psf, sumwt = invert_visibility(self.vis, self.params)
+        chunks = visibility_chunks(self.vis, 1000)
+        self.assertGreater(len(chunks), 1)
+        sdirty, spsf, ssumwt = invert_visibility_stream(chunks, self.params)
+        assert_allclose(sdirty.data, dirty.data, atol=1e-12)
+        assert_allclose(spsf.data, psf.data, atol=1e-12)
+        assert_allclose(ssumwt, sumwt)
+        # Uniform weighting reads the chunks twice
+        self.assertRaises(ValueError, invert_visibility_stream, iter(chunks), self.params)
+
+    def test_stream_natural(self):
+        params = dict(self.params, weighting='natural')
+        dirty, psf, sumwt = invert_visibility_stream(iter(visibility_chunks(self.vis, 1000)), params)
+        newcomp = find_skycomponent(dirty)
+        assert_allclose(newcomp.flux, [[1.0, 2.0, 3.0, 4.0]] * 3, rtol=0.05)
+        assert_allclose(self.compdirection.ra.value, newcomp.direction.ra.value, atol=1e-2)
+
+    def test_stream_robust(self):
+        params = dict(self.params, weighting='robust', robustness=0.5)
+        sdirty, spsf, ssumwt = invert_visibility_stream(visibility_chunks(self.vis, 1000), params)
+        vis = weight_visibility(self.vis.copy(), None, params)
+        dirty, psf, sumwt = invert_visibility(vis, self.params)
+        assert_allclose(sdirty.data, dirty.data, atol=1e-12)
+        assert_allclose(spsf.data, psf.data, atol=1e-12)
+
+
+class TestWeightVisibility(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'wstep': 10.0, 'npixel': 256, 'cellsize': 0.0004}
+        vlaa = create_named_configuration('VLAA')
+        vlaa.data['xyz'] *= 1.0 / 30.0
+        times = numpy.arange(-3.0, +3.0, 6.0 / 30.0) * numpy.pi / 12.0
+        frequency = numpy.arange(1.0e8, 1.50e8, 2.0e7)
+        phasecentre = SkyCoord(ra=+15.0 * u.deg, dec=+35.0 * u.deg, frame='icrs')
+        self.vis = create_visibility(vlaa, times, frequency, weight=1.0, phasecentre=phasecentre)
+        self.vis.vis[...] = 1.0
+
+    def test_weighting(self):
+        vis = weight_visibility(self.vis, None, dict(self.params, weighting='natural'))
+        assert_allclose(vis.imaging_weight, 1.0)
+        uniform = weight_visibility(self.vis, None, self.params).imaging_weight
+        self.assertEqual(uniform.shape, (len(self.vis), self.vis.nchan))
+        self.assertLess(uniform.min(), uniform.max())
+        # Robust weighting goes from uniform to natural weighting
+        for robustness, wt in [(-5.0, uniform), (5.0, numpy.ones_like(uniform))]:
+            params = dict(self.params, weighting='robust', robustness=robustness)
+            robust = weight_visibility(self.vis, None, params).imaging_weight
+            assert_allclose(robust / robust.max(axis=0), wt / wt.max(axis=0), rtol=1e-3)
+        self.assertRaises(ValueError, weight_visibility, self.vis, None, dict(self.params, weighting='briggs'))
+
+    def test_invert_imaging_weight(self):
+        # Stored weights get used instead of weighting again, and are
+        # kept by row selections but not by new uvw
+        dirty, psf, sumwt = invert_visibility(self.vis, self.params)
+        self.assertIsNone(self.vis.imaging_weight)
+        weight_visibility(self.vis, dirty, self.params)
+        wdirty, wpsf, wsumwt = invert_visibility(self.vis, dict(self.params, weighting='natural'))
+        assert_allclose(wdirty.data, dirty.data, atol=1e-12)
+        assert_allclose(wpsf.data, psf.data, atol=1e-12)
+        self.assertEqual(len(self.vis.select(slice(10, 20)).imaging_weight), 10)
+        self.vis.uvw = self.vis.uvw.copy()
+        self.assertIsNone(self.vis.imaging_weight)
+
+
+class TestMFS(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'wstep': 10.0, 'npixel': 256, 'cellsize': 0.0004, 'reffrequency': 1.0e8,
+                       'spectral_mode': 'mfs'}
+        vlaa = create_named_configuration('VLAA')
+        vlaa.data['xyz'] *= 1.0 / 30.0
+        times = numpy.arange(-3.0, +3.0, 6.0 / 30.0) * numpy.pi / 12.0
+        self.frequency = numpy.linspace(0.8e8, 1.2e8, 4)
+        phasecentre = SkyCoord(ra=+15.0 * u.deg, dec=+35.0 * u.deg, frame='icrs')
+        self.compdirection = SkyCoord(ra=17.0 * u.deg, dec=+36.5 * u.deg, frame='icrs')
+        self.vis = create_visibility(vlaa, times, self.frequency, weight=1.0, phasecentre=phasecentre)
+        l, m, n = skycoord_to_lmn(self.compdirection, phasecentre)
+        for channel in range(len(self.frequency)):
+            for pol in range(self.vis.npol):
+                self.vis.vis[:, channel, pol] = (pol + 1) * simulate_point(self.vis.uvw_lambda(channel), l, m)
+
+    def test_invert(self):
+        dirty, psf, sumwt = invert_visibility(self.vis, self.params)
+        self.assertEqual(dirty.data.shape, (1, 4, 256, 256))
+        self.assertEqual(psf.data.shape, (1, 4, 256, 256))
+        newcomp = find_skycomponent(dirty)
+        assert_allclose(newcomp.flux, [[1.0, 2.0, 3.0, 4.0]], rtol=0.05)
+        assert_allclose(self.compdirection.ra.value, newcomp.direction.ra.value, atol=1e-2)
+        # Taylor terms need 2*nterms-1 PSFs, the flat spectrum has no slope
+        dirty, psf, sumwt = invert_visibility(self.vis, dict(self.params, mfs_nterms=2))
+        self.assertEqual(dirty.data.shape, (2, 4, 256, 256))
+        self.assertEqual(psf.data.shape, (3, 4, 256, 256))
+        # The spectral axis has one plane per Taylor term, at the reference frequency
+        self.assertEqual(dirty.wcs.pixel_shape, (256, 256, 4, 2))
+        self.assertEqual(psf.wcs.pixel_shape, (256, 256, 4, 3))
+        self.assertEqual(dirty.wcs.wcs.crval[3], 1.0e8)
+        self.assertEqual(psf.wcs.wcs.crval[3], 1.0e8)
+        self.assertLess(numpy.abs(dirty.data[1]).max(), 0.1 * numpy.abs(dirty.data[0]).max())
+
+    def test_predict(self):
+        # Predicting Taylor terms is the same as predicting the cube they describe
+        dirty, psf, sumwt = invert_visibility(self.vis, dict(self.params, mfs_nterms=2))
+        sm = SkyModel()
+        sm.images = [dirty]
+        vis = predict_visibility(self.vis, sm, self.params)
+        x = (self.frequency - 1.0e8) / 1.0e8
+        cube = create_image_from_array(dirty.data[0] + x[:, None, None, None] * dirty.data[1], dirty.wcs)
+        sm.images = [cube]
+        viscube = predict_visibility(self.vis, sm, dict(self.params, spectral_mode='channel'))
+        assert_allclose(vis.vis, viscube.vis, atol=1e-12 * numpy.abs(viscube.vis).max())
+
+
 if __name__ == '__main__':
     import sys
     import logging
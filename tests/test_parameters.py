@@ -5,6 +5,10 @@ realtimcornwell@gmail.com
 
 import unittest
 import os
+import shutil
+import tempfile
+
+import numpy
 
 from arl.parameters import *
 
@@ -13,9 +17,13 @@ log = logging.getLogger("arl.test_parameters")
 
 class TestParameters(unittest.TestCase):
     def setUp(self):
-        self.paramsfile = crocodile_path("tests/TestParameters.txt")
+        self.directory = tempfile.mkdtemp()
+        self.paramsfile = os.path.join(self.directory, "TestParameters.txt")
         self.parameters = {'npixel': 256, 'cellsize':0.1, 'predict':{'cellsize':0.2}, 'invert':{'spectral_mode':'mfs'}}
 
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
     def test_exportimport(self):
         log_parameters(self.parameters)
         export_parameters(self.parameters, self.paramsfile)
@@ -33,5 +41,11 @@ class TestParameters(unittest.TestCase):
         assert get_parameter(self.parameters, 'foo', 'bar') == 'bar'
         assert get_parameter(self.parameters, 'foo') == None
 
+    def test_getprecision(self):
+
+        assert get_precision(self.parameters) == (numpy.complex128, numpy.float64)
+        assert get_precision({'precision': 'single'}) == (numpy.complex64, numpy.float32)
+        self.assertRaises(ValueError, get_precision, {'precision': 'half'})
+
 if __name__ == '__main__':
     unittest.main()
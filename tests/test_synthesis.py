@@ -95,6 +95,14 @@ class TestSynthesis(unittest.TestCase):
                 assert_allclose(numpy.sum(k), Qpx**2,
                                 rtol=0.07)
 
+    def test_w_kernels(self):
+        ws = [-300, -10, 0, 20, 1000]
+        for NpixFF, NpixKern, Qpx, kw in [(12, 5, 2, {}), (16, 7, 4, dict(dl=.01, dm=-.02))]:
+            kerns = w_kernels(0.2, ws, NpixFF, NpixKern, Qpx, max_batch_bytes=100000, **kw)
+            self.assertEqual(kerns.shape, (len(ws), Qpx, Qpx, NpixKern, NpixKern))
+            for w, kern in zip(ws, kerns):
+                assert_allclose(kern, w_kernel(0.2, w, NpixFF, NpixKern, Qpx, **kw), atol=1e-14)
+
     def _uvw(self, N, uw=0, vw=0):
         u,v = coordinates2(N)
         u=numpy.hstack(u)
@@ -235,6 +243,87 @@ class TestSynthesis(unittest.TestCase):
                 slices = slice_vis(step, cs)
                 assert_allclose(cs, numpy.vstack(slices))
 
+    def test_bin_vis_w(self):
+        uvw = self._uvw(5, .5, .3) * 100
+        bins = bin_vis_w(20, uvw)
+        assert_allclose(numpy.sort(uvw[:,2]), numpy.hstack([ps[:,2] for _, ps in bins]))
+        for wbin, ps in bins:
+            assert_allclose(20 * numpy.round(ps[:,2] / 20), wbin)
+
+    def test_convgrid_batched(self):
+        # Vectorised gridding must match adding kernels one visibility
+        # at a time, independent of batch size
+        numpy.random.seed(0)
+        N, Qpx = 32, 4
+        p = numpy.random.uniform(-.4, .4, (200, 3))
+        v = numpy.random.randn(200) + 1j * numpy.random.randn(200)
+        gcf = w_kernel(.1, 100, 12, 5, Qpx)
+        a_ref = numpy.zeros((N, N), dtype=complex)
+        for x, xf, y, yf, vis in zip(*frac_coords(a_ref.shape, Qpx, p), v):
+            a_ref[y-2:y+3, x-2:x+3] += gcf[yf, xf] * vis
+        for max_batch_bytes in [1, 5000, GRID_BATCH_BYTES]:
+            a = numpy.zeros((N, N), dtype=complex)
+            convgrid(gcf, a, p, v, max_batch_bytes=max_batch_bytes)
+            assert_allclose(a, a_ref, atol=1e-12)
+        # Should work on non-contiguous grids, too
+        a = numpy.zeros((N, N), dtype=complex, order='F')
+        convgrid(gcf, a, p, v)
+        assert_allclose(a, a_ref, atol=1e-12)
+
+    def test_w_cache_imaging(self):
+        # Binning in w must give the same result as gridding each
+        # visibility with the kernel for its w-bin
+        numpy.random.seed(1)
+        lam, theta, wstep = 100, .2, 20
+        p = numpy.random.uniform(-.3, .3, (100, 3)) * lam
+        v = numpy.random.randn(100) + 1j * numpy.random.randn(100)
+        kw = dict(NpixFF=12, NpixKern=5, Qpx=2)
+        def kernel_binner(theta, w, **kw):
+            return w_kernel(theta, wstep * numpy.round(w / wstep), **kw)
+        guv_ref = w_slice_imaging(theta, lam, p, v, 1, kernel_binner, **kw)
+        guv = w_cache_imaging(theta, lam, p, v, wstep, **kw)
+        assert_allclose(guv, guv_ref, atol=1e-12)
+
+    def test_convdegrid_batched(self):
+        # Vectorised degridding must match summing over kernel
+        # footprints one visibility at a time
+        numpy.random.seed(2)
+        N, Qpx = 32, 4
+        p = numpy.random.uniform(-.4, .4, (200, 3))
+        a = numpy.random.randn(N, N) + 1j * numpy.random.randn(N, N)
+        gcf = w_kernel(.1, 100, 12, 5, Qpx)
+        v_ref = [ numpy.sum(a[y-2:y+3, x-2:x+3] * gcf[yf, xf])
+                  for x, xf, y, yf in zip(*frac_coords(a.shape, Qpx, p)) ]
+        for max_batch_bytes in [1, 5000, GRID_BATCH_BYTES]:
+            assert_allclose(convdegrid(gcf, a, p, max_batch_bytes), v_ref, atol=1e-12)
+        assert_allclose(convdegrid(gcf, numpy.asfortranarray(a), p), v_ref, atol=1e-12)
+
+    def test_w_cache_predict(self):
+        numpy.random.seed(3)
+        lam, theta, wstep = 100, .2, 20
+        p = numpy.random.uniform(-.3, .3, (100, 3)) * lam
+        guv = numpy.random.randn(20, 20) + 1j * numpy.random.randn(20, 20)
+        kw = dict(NpixFF=12, NpixKern=5, Qpx=2)
+        def kernel_binner(theta, w, **kw):
+            return w_kernel(theta, wstep * numpy.round(w / wstep), **kw)
+        v_ref = w_slice_predict(theta, lam, p, guv, 1, kernel_binner, **kw)
+        v = w_cache_predict(theta, lam, p, guv, wstep, **kw)
+        assert_allclose(v, v_ref, atol=1e-12)
+
+    def test_doweight(self):
+        numpy.random.seed(4)
+        lam, theta = 100, .1
+        p = numpy.random.uniform(-.4, .4, (500, 3)) * lam
+        v = numpy.random.randn(500) + 1j * numpy.random.randn(500)
+        # Every visibility gets divided by the count of its grid cell
+        a = numpy.zeros((10, 10))
+        grid(a, p / lam, numpy.ones(len(p)))
+        assert_allclose(doweight(theta, lam, p, v), v / degrid(a, p / lam))
+        # Density grid can be returned and reused
+        wt, density = doweight(theta, lam, p, v, return_density=True)
+        assert_allclose(density, a)
+        assert_allclose(doweight(theta, lam, p, v, density=density), wt)
+
     def test_grid_degrid_w(self):
         lam = 1000
         for uw, vw in [(.5,0),(0,.5),(-1,0),(0,-1)]:
@@ -0,0 +1,403 @@
+"""Unit tests for synthesis support
+
+"""
+import functools
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+from arl.synthesis_support import *
+from crocodile.simulate import simulate_point
+import crocodile.synthesis
+
+import logging
+log = logging.getLogger("arl.test_synthesis_support")
+
+
+class TestSynthesisSupport(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.lam = 100
+        self.theta = 0.2
+        self.p = numpy.random.uniform(-.3, .3, (500, 3)) * self.lam
+        self.v = numpy.random.randn(500) + 1j * numpy.random.randn(500)
+        self.kwargs = dict(NpixFF=12, NpixKern=5, Qpx=2)
+
+    def test_split_chunks(self):
+        items = list(range(10))
+        for nchunks in range(1, 12):
+            chunks = split_chunks(items, nchunks, numpy.ones(10))
+            self.assertLessEqual(len(chunks), nchunks)
+            self.assertEqual(sum(chunks, []), items)
+
+    def test_tree_reduce(self):
+        for n in range(1, 8):
+            grids = [ numpy.full((3, 3), i, dtype=complex) for i in range(n) ]
+            assert_allclose(tree_reduce(grids), n * (n - 1) / 2)
+
+    def test_parallel_imaging(self):
+        # Thread-parallel gridding must give the same grid as serial gridding
+        guv = w_cache_imaging(self.theta, self.lam, self.p, self.v, 10, **self.kwargs)
+        for nworkers in [2, 3, 8]:
+            guv_par = w_cache_imaging(self.theta, self.lam, self.p, self.v, 10,
+                                      nworkers=nworkers, **self.kwargs)
+            assert_allclose(guv_par, guv, atol=1e-12)
+        guv = w_slice_imaging(self.theta, self.lam, self.p, self.v, 50, **self.kwargs)
+        guv_par = w_slice_imaging(self.theta, self.lam, self.p, self.v, 50,
+                                  nworkers=4, **self.kwargs)
+        assert_allclose(guv_par, guv, atol=1e-12)
+
+    def test_hermitian_imaging(self):
+        # Making the grid Hermitian is the same as gridding the conjugate points
+        guv = simple_imaging(self.theta, self.lam, self.p, self.v)
+        guv2 = simple_imaging(self.theta, self.lam, numpy.vstack([self.p, -self.p]),
+                              numpy.hstack([self.v, numpy.conj(self.v)]))
+        assert_allclose(hermitian_ifft(guv), numpy.real(ifft(guv2)), atol=1e-12)
+        # Stacks of grids get transformed separately
+        assert_allclose(hermitian_ifft(numpy.array([guv, guv2])),
+                        numpy.real(ifft(numpy.array([guv2, 2 * guv2]))), atol=1e-12)
+        # Odd sizes as well, where -u is at the mirrored index
+        godd = guv[1:, 1:]
+        assert_allclose(hermitian_ifft(godd), numpy.real(ifft(godd + numpy.conj(godd[::-1, ::-1]))), atol=1e-12)
+        drt, psf, pmax = do_imaging(self.theta, self.lam, self.p, self.v, simple_imaging)
+        self.assertEqual(numpy.argmax(psf), psf.size // 2 + psf.shape[1] // 2)
+        self.assertAlmostEqual(psf.max(), 1.0)
+
+    def test_multi_rhs_imaging(self):
+        # Gridding a stack of value vectors gives a stack of grids
+        vs = numpy.transpose([self.v, numpy.ones(500), 1j * self.v])
+        for imgfn, kw in [(simple_imaging, {}),
+                          (w_slice_imaging, dict(wstep=50, **self.kwargs)),
+                          (w_cache_imaging, dict(wstep=10, nworkers=2, **self.kwargs)),
+                          (w_stack_imaging, dict(wstep=10, **self.kwargs)),
+                          (idg_imaging, dict(Nsub=16, support=6))]:
+            guvs = imgfn(self.theta, self.lam, self.p, vs, **kw)
+            self.assertEqual(guvs.shape, (3, 20, 20))
+            for guv, v in zip(guvs, vs.T):
+                assert_allclose(guv, imgfn(self.theta, self.lam, self.p, v, **kw), atol=1e-12)
+        guvs = process_imaging(self.theta, self.lam, self.p, vs, w_cache_imaging, nprocs=2,
+                               wstep=10, **self.kwargs)
+        assert_allclose(guvs, w_cache_imaging(self.theta, self.lam, self.p, vs, 10, **self.kwargs), atol=1e-12)
+
+    def test_polarisation_imaging(self):
+        # Imaging all polarisations at once gives the same images and PSF
+        vs = numpy.transpose([self.v, 2 * self.v, 1j * self.v, numpy.conj(self.v)])
+        kw = dict(wstep=10, **self.kwargs)
+        drts, psf, pmax = do_imaging(self.theta, self.lam, self.p, vs, w_cache_imaging, **kw)
+        self.assertEqual(drts.shape, (4, 20, 20))
+        for drt, v in zip(drts, vs.T):
+            drt1, psf1, pmax1 = do_imaging(self.theta, self.lam, self.p, v, w_cache_imaging, **kw)
+            assert_allclose(drt, drt1, atol=1e-12)
+            assert_allclose(psf, psf1, atol=1e-12)
+            self.assertAlmostEqual(pmax, pmax1)
+
+    def test_scaled_coordinates(self):
+        # Coordinates in other units plus a scale give the same result
+        # as coordinates in wavelengths
+        scale = 1.0 / 3.0
+        pm = self.p / scale
+        for imgfn, predfn, kw in [(w_cache_imaging, w_cache_predict, dict(wstep=10, **self.kwargs)),
+                                  (w_stack_imaging, w_stack_predict, dict(wstep=10, **self.kwargs)),
+                                  (idg_imaging, idg_predict, dict(Nsub=16, support=6))]:
+            drt, psf, pmax = do_imaging(self.theta, self.lam, self.p, self.v, imgfn, **kw)
+            drts, psfs, pmaxs = do_imaging(self.theta, self.lam, pm, self.v, imgfn, scale=scale, **kw)
+            assert_allclose(drts, drt, atol=1e-10)
+            assert_allclose(psfs, psf, atol=1e-10)
+            v = do_predict(self.theta, self.lam, self.p, drt, predfn, **kw)
+            assert_allclose(do_predict(self.theta, self.lam, pm, drt, predfn, scale=scale, **kw), v, atol=1e-10)
+        assert_allclose(simulate_point(pm, 0.01, -0.02, scale), simulate_point(self.p, 0.01, -0.02), atol=1e-12)
+
+    def test_tile_order(self):
+        order = tile_order(self.theta, self.lam, self.p, 10, Qpx=2, tile=4)
+        self.assertEqual(sorted(order), list(range(500)))
+        wbins = numpy.round(self.p[order, 2] / 10)
+        self.assertTrue((numpy.diff(wbins) >= 0).all())
+        # Gridding and degridding do not depend on the order
+        guv = w_cache_imaging(self.theta, self.lam, self.p, self.v, 10, **self.kwargs)
+        assert_allclose(w_cache_imaging(self.theta, self.lam, self.p[order], self.v[order], 10, **self.kwargs),
+                        guv, atol=1e-12)
+        v = numpy.empty(500, dtype=complex)
+        v[order] = w_cache_predict(self.theta, self.lam, self.p[order], guv, 10, **self.kwargs)
+        assert_allclose(v, w_cache_predict(self.theta, self.lam, self.p, guv, 10, **self.kwargs), atol=1e-12)
+        # Orders get cached per observation
+        self.assertIs(cached_tile_order(self.p, self.theta, self.lam, self.p, 10, 2, 4),
+                      cached_tile_order(self.p, self.theta, self.lam, self.p, 10, 2, 4))
+
+    def test_process_imaging(self):
+        # Gridding and degridding on a process pool must match serial results
+        guv = w_cache_imaging(self.theta, self.lam, self.p, self.v, 10,
+                              kernel_cache=w_conj_kernel_fn(w_kernel), **self.kwargs)
+        guv_proc = process_imaging(self.theta, self.lam, self.p, self.v, w_cache_imaging, nprocs=3,
+                                   wstep=10, kernel_cache=ProcessKernelCache(w_kernel), **self.kwargs)
+        assert_allclose(guv_proc, guv, atol=1e-12)
+        v = w_cache_predict(self.theta, self.lam, self.p, guv, 10, **self.kwargs)
+        v_proc = process_predict(self.theta, self.lam, self.p, guv, w_cache_predict, nprocs=3,
+                                 wstep=10, **self.kwargs)
+        assert_allclose(v_proc, v, atol=1e-12)
+        # The shared pool is created once per number of processes
+        self.assertIs(process_pool(3), process_pool(3))
+        self.assertIsNot(process_pool(2), process_pool(3))
+        v_proc = process_predict(self.theta, self.lam, self.p, guv, w_cache_predict, nprocs=3,
+                                 executor=process_pool(3), wstep=10, **self.kwargs)
+        assert_allclose(v_proc, v, atol=1e-12)
+        # Kernel functions arriving in workers are identified by their pickled form
+        cache = ProcessKernelCache(functools.partial(w_kernel, dtype=numpy.complex64))
+        cache_copy = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(cache_copy.key, cache.key)
+        self.assertNotEqual(ProcessKernelCache(w_kernel).key, cache.key)
+        self.assertIs(cache_copy(self.theta, 20, **self.kwargs), cache(self.theta, 20, **self.kwargs))
+
+    def test_w_stack(self):
+        # W-stacking should agree with w-projection up to kernel truncation
+        lam, N = 400.0, 64
+        theta = N / lam
+        p = numpy.random.uniform(-.35, .35, (2000, 3)) * lam
+        p[:, 2] *= .6
+        kwargs = dict(NpixFF=32, NpixKern=9, Qpx=4)
+        vis = simulate_point(p, 5 * theta / N, -8 * theta / N)
+        img = numpy.real(ifft(w_cache_imaging(theta, lam, p, vis, 10, **kwargs)))
+        img_stack = numpy.real(w_stack_imaging(theta, lam, p, vis, 10, **kwargs))
+        self.assertEqual(numpy.argmax(img_stack), (N//2 - 8) * N + N//2 + 5)
+        assert_allclose(img_stack, img, atol=1e-2)
+        # Callers take the image as it is, not as a uv grid
+        imgfn = functools.partial(w_stack_imaging, wstep=10, **kwargs)
+        self.assertTrue(returns_image(imgfn))
+        self.assertFalse(returns_image(functools.partial(w_cache_imaging, wstep=10)))
+        drt, psf, pmax = do_imaging(theta, lam, p, vis, imgfn)
+        drt_cache, psf_cache, pmax_cache = do_imaging(theta, lam, p, vis, w_cache_imaging, wstep=10, **kwargs)
+        assert_allclose(drt, drt_cache, atol=1e-2)
+        assert_allclose(psf, psf_cache, atol=1e-2)
+        model = numpy.zeros((N, N))
+        model[N//2 - 8, N//2 + 5] = 1
+        guv = fft(model.astype(complex))
+        assert_allclose(w_stack_predict(theta, lam, p, guv, 10, **kwargs),
+                        w_cache_predict(theta, lam, p, guv, 10, **kwargs), atol=.1)
+
+    def test_facet_imaging(self):
+        from crocodile.synthesis import facet_imaging, facet_predict
+        numpy.random.seed(5)
+        lam, theta, facets = 400, .3, 3
+        N, Nf = 120, 40
+        p = numpy.random.uniform(-.25, .25, (2000, 3)) * lam
+        p[:, 2] *= 2
+        # Sources close to the centres of the facets
+        xys = [(0, 0), (Nf + 3, -2), (-Nf - 1, Nf + 2)]
+        v = sum(simulate_point(p, x * theta / N, y * theta / N) for x, y in xys)
+        # Compare with the non-faceted image made by direct Fourier
+        # transform, including the facet edges
+        kw = dict(wstep=10, NpixFF=24, NpixKern=9, Qpx=16, overlap=8, support=6,
+                  imgfn=w_cache_imaging)
+        img = numpy.real(facet_imaging(theta, lam, p, v, facets, **kw))
+        l = (numpy.arange(N) - N // 2) * theta / N
+        m, l = numpy.meshgrid(l, l, indexing='ij')
+        n = numpy.sqrt(1 - l**2 - m**2)
+        ref = numpy.zeros((N, N))
+        for i in range(0, len(p), 200):
+            ps = p[i:i+200, :, numpy.newaxis, numpy.newaxis]
+            ref += numpy.real(numpy.tensordot(v[i:i+200], numpy.exp(
+                2j * numpy.pi * (ps[:, 0] * l + ps[:, 1] * m + ps[:, 2] * (n - 1))), 1))
+        ref /= N * N
+        self.assertLess(numpy.abs(img - ref).max() / ref.max(), 1e-2)
+        model = numpy.zeros((N, N))
+        for x, y in xys:
+            model[N // 2 + y, N // 2 + x] = 1
+        del kw['imgfn']
+        vp = facet_predict(theta, lam, p, fft(model.astype(complex)), facets, predfn=w_cache_predict, **kw)
+        assert_allclose(vp, v, atol=3e-2)
+        # The crocodile imaging functions give the same result
+        kw = dict(wstep=10, NpixFF=14, NpixKern=7, Qpx=4, overlap=4, support=4)
+        img = facet_imaging(theta, lam, p, v, facets, **kw)
+        assert_allclose(facet_imaging(theta, lam, p, v, facets, imgfn=w_cache_imaging, **kw), img, atol=1e-12)
+        guv = fft(img)
+        vp = facet_predict(theta, lam, p, guv, facets, **kw)
+        assert_allclose(facet_predict(theta, lam, p, guv, facets, predfn=w_cache_predict, **kw), vp, atol=1e-10)
+        # Facets can be imaged in parallel, with stacked visibilities
+        # and with scaled coordinates
+        kw['imgfn'] = w_cache_imaging
+        vs = numpy.transpose([v, 2 * v])
+        assert_allclose(facet_imaging(theta, lam, p, vs, facets, nworkers=2, **kw), [img, 2 * img], atol=1e-12)
+        assert_allclose(facet_imaging(theta, lam, 2 * p, v, facets, scale=.5, **kw), img, atol=1e-12)
+        del kw['imgfn']
+        assert_allclose(facet_predict(theta, lam, 2 * p, guv, facets, scale=.5, nworkers=2,
+                                      predfn=w_cache_predict, **kw), vp, atol=1e-10)
+        # Images get used as they are
+        imgfn = functools.partial(facet_imaging, facets=facets, imgfn=w_cache_imaging, **kw)
+        self.assertTrue(returns_image(imgfn))
+        self.assertTrue(returns_image(functools.partial(process_imaging, imgfn=imgfn)))
+        drt, psf, pmax = do_imaging(theta, lam, p, v, imgfn, wt=numpy.ones(len(p)))
+        assert_allclose(drt * pmax, 2 * numpy.real(img), atol=1e-10)
+
+    def test_w_kernels(self):
+        ws = numpy.linspace(-100, 100, 7)
+        kerns = w_kernels(self.theta, ws, max_batch_bytes=10000, **self.kwargs)
+        for w, kern in zip(ws, kerns):
+            assert_allclose(kern, w_kernel(self.theta, w, **self.kwargs), atol=1e-14)
+
+    def test_kernel_cache(self):
+        kw = dict(self.kwargs, dtype=complex)
+        kern = w_kernel(self.theta, 0, **kw)
+        cache = KernelCache(3 * kern.nbytes)
+        for w in [0, 10, 20, 0, 30, 10]:
+            assert_allclose(cache.get(w_kernel, self.theta, w, **kw), w_kernel(self.theta, w, **kw))
+        # Least recently used kernels get evicted to stay within budget
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 5, 2))
+        self.assertEqual((stats['nkernels'], stats['nbytes']), (3, 3 * kern.nbytes))
+        self.assertGreater(stats['generation_time'], 0.0)
+        # Kernels are keyed on all parameters and cannot be modified
+        self.assertIs(cache.get(w_kernel, self.theta, 30, **kw), cache.get(w_kernel, self.theta, 30, **kw))
+        self.assertEqual(cache.get(w_kernel, self.theta, 30, **dict(kw, dtype=numpy.complex64)).dtype,
+                         numpy.complex64)
+        self.assertFalse(cache.get(w_kernel, self.theta, 30, **kw).flags.writeable)
+        cache.resize(kern.nbytes)
+        self.assertEqual(cache.stats()['nkernels'], 1)
+        # Short-lived kernel functions never get kernels of an earlier one,
+        # while equal partials share them
+        for scale in [2.0, 3.0]:
+            assert_allclose(cache.get(lambda theta, w: numpy.full(4, scale * w), self.theta, 1.0), scale)
+        cache.get(functools.partial(w_kernel, dtype=complex), self.theta, 40, **self.kwargs)
+        cache.get(functools.partial(w_kernel, dtype=complex), self.theta, 40, **self.kwargs)
+        self.assertEqual(cache.stats()['hits'], 5)
+        # Threads gridding with the shared cache get the same result
+        guv = w_cache_imaging(self.theta, self.lam, self.p, self.v, 10, kernel_cache=w_kernel, **self.kwargs)
+        for i in range(2):
+            shared_kernel_cache.reset_stats()
+            guv_shared = w_cache_imaging(self.theta, self.lam, self.p, self.v, 10, nworkers=3, **self.kwargs)
+            assert_allclose(guv_shared, guv, atol=1e-12)
+        # The second call finds all kernels in the cache
+        self.assertEqual(shared_kernel_cache.stats()['misses'], 0)
+        self.assertGreater(shared_kernel_cache.stats()['hits'], 0)
+
+    def test_kernel_bank(self):
+        calls = []
+        def kernel_fn(theta, w, *args, **kw):
+            calls.append(w)
+            return w_kernel(theta, w, *args, **kw)
+        with tempfile.TemporaryDirectory() as directory:
+            bank = KernelBank(directory, self.theta, 10, nbins=2, kernel_fn=kernel_fn, **self.kwargs)
+            assert_allclose(bank(self.theta, -20, **self.kwargs), w_kernel(self.theta, -20, **self.kwargs))
+            self.assertEqual(sorted(calls), [-20, -10, 0, 10, 20])
+            # Requesting w outside of the bank only generates the new kernels
+            assert_allclose(bank(self.theta, 31, **self.kwargs), w_kernel(self.theta, 30, **self.kwargs))
+            self.assertEqual(len(calls), 7)
+            # The bank gets found on disk by new instances
+            KernelBank.banks.clear()
+            bank = KernelBank(directory, self.theta, 10, kernel_fn=kernel_fn, **self.kwargs)
+            guv = w_cache_imaging(self.theta, self.lam, self.p, self.v, 10, kernel_cache=bank, **self.kwargs)
+            self.assertEqual(len(calls), 7)
+            assert_allclose(guv, w_cache_imaging(self.theta, self.lam, self.p, self.v, 10, **self.kwargs))
+            # A theta recomputed with rounding errors finds the same bank
+            theta = self.theta * (1 + 1e-15)
+            self.assertNotEqual(theta, self.theta)
+            self.assertEqual(KernelBank(directory, theta, 10, kernel_fn=kernel_fn, **self.kwargs).path, bank.path)
+            assert_allclose(bank(theta, 20, **self.kwargs), w_kernel(self.theta, 20, **self.kwargs))
+            self.assertEqual(len(calls), 7)
+            # Different parameters give a different bank
+            other = KernelBank(directory, self.theta, 20, **self.kwargs)
+            self.assertNotEqual(other.path, bank.path)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            # By default, kernels get generated in batches
+            assert_allclose(other(self.theta, -40, **self.kwargs), w_kernel(self.theta, -40, **self.kwargs))
+            assert_allclose(other.kernels(), w_kernels(self.theta, [-40, -20, 0, 20, 40], **self.kwargs))
+            # Shifted and transformed kernels need a kernel function supporting them
+            transform = dict(dl=0.02, dm=-0.01, T=numpy.array([[1.0, 0.1], [0.0, 0.9]]))
+            self.assertRaises(ValueError, KernelBank, directory, self.theta, 10, **dict(self.kwargs, dl=0.02))
+            shifted = KernelBank(directory, self.theta, 10, kernel_fn=crocodile.synthesis.w_kernel,
+                                 **dict(self.kwargs, **transform))
+            self.assertNotEqual(shifted.path, bank.path)
+            assert_allclose(shifted(self.theta, -20, **self.kwargs),
+                            crocodile.synthesis.w_kernel(self.theta, -20, **dict(self.kwargs, **transform)))
+            self.assertGreater(numpy.abs(shifted(self.theta, 20, **self.kwargs) -
+                                         bank(self.theta, 20, **self.kwargs)).max(), 1e-3)
+        KernelBank.banks.clear()
+
+    def test_truncated_kernels(self):
+        lam, theta = 1280, .1
+        kwargs = dict(NpixFF=64, NpixKern=31, Qpx=4)
+        ws = [0, 300, 1000, 3000]
+        kerns = w_kernels(theta, ws, **kwargs)
+        support = kernel_support(kerns, 1e-2)
+        self.assertEqual(list(support), sorted(support))
+        self.assertLess(support[0], 31)
+        for w, kern, s in zip(ws, kerns, support):
+            tkern = truncated_w_kernel(theta, w, tolerance=1e-2, **kwargs)
+            self.assertEqual(tkern.shape, (4, 4, s, s))
+            assert_allclose(tkern, kern[:, :, 15-s//2:16+s//2, 15-s//2:16+s//2])
+        # Image error stays within square root of the energy tolerance
+        p = numpy.random.uniform(-.35, .35, (2000, 3)) * lam
+        guv = w_cache_imaging(theta, lam, p, self.v.repeat(4), 20, **kwargs)
+        for tol in [1e-1, 1e-2, 1e-3]:
+            tguv = w_cache_imaging(theta, lam, p, self.v.repeat(4), 20,
+                                   kernel_fn=functools.partial(truncated_w_kernel, tolerance=tol), **kwargs)
+            self.assertLess(numpy.linalg.norm(tguv - guv) / numpy.linalg.norm(guv), numpy.sqrt(tol))
+        # Kernel banks truncate kernels the same way
+        with tempfile.TemporaryDirectory() as directory:
+            bank = KernelBank(directory, theta, 1000, tolerance=1e-2, **kwargs)
+            assert_allclose(bank(theta, -3000, **kwargs), truncated_w_kernel(theta, -3000, tolerance=1e-2, **kwargs))
+            assert_allclose(bank(theta, 0, **kwargs), truncated_w_kernel(theta, 0, tolerance=1e-2, **kwargs))
+        KernelBank.banks.clear()
+
+    def test_idg(self):
+        # Image domain gridding should match a direct Fourier transform
+        # away from the image edges, where the taper gets divided out
+        lam, N = 400.0, 64
+        theta = N / lam
+        p = numpy.random.uniform(-.4, .4, (1000, 3)) * lam
+        v = numpy.random.randn(1000) + 1j * numpy.random.randn(1000)
+        m, l = coordinates2(N) * theta
+        n = numpy.sqrt(1 - l**2 - m**2)
+        ph = (numpy.multiply.outer(p[:, 0], l) + numpy.multiply.outer(p[:, 1], m) +
+              numpy.multiply.outer(p[:, 2], n - 1))
+        dft = numpy.einsum('i,ijk->jk', v, numpy.exp(2j * numpy.pi * ph)) / N**2
+        img = ifft(idg_imaging(theta, lam, p, v, Nsub=24, support=8, max_batch_bytes=1000000))
+        mid = slice(N//4, 3*N//4)
+        assert_allclose(img[mid, mid], dft[mid, mid], atol=1e-3 * numpy.abs(dft).max())
+        # Degridding a point source
+        model = numpy.zeros((N, N))
+        model[N//2 - 8, N//2 + 5] = 1
+        vp = idg_predict(theta, lam, p, fft(model.astype(complex)), Nsub=24, support=8)
+        assert_allclose(vp, simulate_point(p, 5 * theta / N, -8 * theta / N), atol=1e-2)
+
+    def test_single_precision(self):
+        # Single precision visibilities and kernels give single precision
+        # grids, with errors close to the float32 rounding error
+        kern = w_kernel(self.theta, 30, dtype=numpy.complex64, **self.kwargs)
+        self.assertEqual(kern.dtype, numpy.complex64)
+        v32 = self.v.astype(numpy.complex64)
+        kernel_fn = functools.partial(w_kernel, dtype=numpy.complex64)
+        # Dividing out the IDG taper amplifies rounding errors at the image edges
+        for imgfn, kw, tol in [(w_cache_imaging, dict(wstep=10, **self.kwargs), 1e-6),
+                               (w_stack_imaging, dict(wstep=10, **self.kwargs), 1e-6),
+                               (idg_imaging, dict(Nsub=16, support=6), 1e-3)]:
+            guv = imgfn(self.theta, self.lam, self.p, self.v, **kw)
+            if imgfn is w_cache_imaging:
+                kw['kernel_fn'] = kernel_fn
+            guv32 = imgfn(self.theta, self.lam, self.p, v32, **kw)
+            self.assertEqual(guv32.dtype, numpy.complex64)
+            err = numpy.linalg.norm(guv32 - guv) / numpy.linalg.norm(guv)
+            log.info("test_single_precision: %s relative grid error %g" % (imgfn.__name__, err))
+            self.assertLess(err, tol)
+        for predfn, kw, tol in [(w_cache_predict, dict(wstep=10, **self.kwargs), 1e-6),
+                                (idg_predict, dict(Nsub=16, support=6), 1e-3)]:
+            v = predfn(self.theta, self.lam, self.p, guv, **kw)
+            if predfn is w_cache_predict:
+                kw['kernel_fn'] = kernel_fn
+            vs32 = predfn(self.theta, self.lam, self.p, guv.astype(numpy.complex64), **kw)
+            self.assertEqual(vs32.dtype, numpy.complex64)
+            err = numpy.linalg.norm(vs32 - v) / numpy.linalg.norm(v)
+            log.info("test_single_precision: %s relative visibility error %g" % (predfn.__name__, err))
+            self.assertLess(err, tol)
+        # Kernel banks store kernels in the requested precision
+        with tempfile.TemporaryDirectory() as directory:
+            bank = KernelBank(directory, self.theta, 10, dtype=numpy.complex64, **self.kwargs)
+            self.assertEqual(bank(self.theta, 20, **self.kwargs).dtype, numpy.complex64)
+            self.assertNotEqual(bank.path, KernelBank(directory, self.theta, 10, **self.kwargs).path)
+        KernelBank.banks.clear()
+
+if __name__ == '__main__':
+    unittest.main()
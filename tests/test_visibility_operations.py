@@ -3,6 +3,9 @@
 realtimcornwell@gmail.com
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import numpy
@@ -83,6 +86,78 @@ class TestVisibilityOperations(unittest.TestCase):
         assert_allclose(rotatedvis.uvw, vismodel2.uvw, rtol=1e-10)
         assert_allclose(rotatedvis.vis, vismodel2.vis, rtol=1e-10)
 
+
+class TestCoalesceVisibility(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {'npixel': 256, 'cellsize': 0.0004, 'npol': 1}
+        self.vlaa = create_named_configuration('VLAA')
+        self.vlaa.data['xyz'] *= 1.0 / 30.0
+        self.times = numpy.arange(-3.0, +3.0, 6.0 / 300.0) * numpy.pi / 12.0
+        self.frequency = numpy.arange(1.0e8, 1.50e8, 2.0e7)
+        self.phasecentre = SkyCoord(ra=+15.0 * u.deg, dec=+35.0 * u.deg, frame='icrs')
+        self.compdirection = SkyCoord(ra=+16.0 * u.deg, dec=+35.5 * u.deg, frame='icrs')
+        self.vis = create_visibility(self.vlaa, self.times, self.frequency, weight=1.0,
+                                     phasecentre=self.phasecentre, params=self.params)
+        l, m, n = skycoord_to_lmn(self.compdirection, self.phasecentre)
+        for channel in range(len(self.frequency)):
+            self.vis.vis[:, channel, 0] = simulate_point(self.vis.uvw_lambda(channel), l, m)
+
+    def test_coalesce(self):
+        cvis = coalesce_visibility(self.vis, self.params)
+        self.assertLess(len(cvis.vis), len(self.vis.vis))
+        self.assertEqual(numpy.sum(cvis.weight), numpy.sum(self.vis.weight))
+        # Decorrelation of a source inside the field is within tolerance
+        flux, weight = sum_visibility(cvis, self.compdirection)
+        assert_allclose(flux.ravel(), 1.0, rtol=1e-2)
+        # Averaging more loses more flux, averaging nothing loses nothing
+        params = dict(self.params, coalesce_tolerance=0.1)
+        self.assertLess(len(coalesce_visibility(self.vis, params).vis), len(cvis.vis))
+        params = dict(self.params, max_coalescence=1)
+        assert_allclose(coalesce_visibility(self.vis, params).vis, self.vis.vis)
+
+    def test_de_coalesce(self):
+        cvis = coalesce_visibility(self.vis, self.params)
+        dvis = de_coalesce_visibility(cvis, self.vis, self.params)
+        assert_allclose(dvis.uvw, self.vis.uvw)
+        assert_allclose(dvis.vis, self.vis.vis, atol=0.1)
+        # Coalescing again gives back the same values
+        assert_allclose(coalesce_visibility(dvis, self.params).vis, cvis.vis, atol=1e-12)
+
+class TestVisibilityStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.vlaa = create_named_configuration('VLAA')
+        times = numpy.arange(-3.0, +3.0, 6.0 / 60.0) * numpy.pi / 12.0
+        frequency = numpy.arange(1.0e8, 1.50e8, 2.0e7)
+        phasecentre = SkyCoord(ra=+15.0 * u.deg, dec=+35.0 * u.deg, frame='icrs')
+        self.vis = create_visibility(self.vlaa, times, frequency, weight=1.0, phasecentre=phasecentre)
+        self.vis.vis[...] = numpy.arange(self.vis.vis.size).reshape(self.vis.vis.shape)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_append(self):
+        path = os.path.join(self.dir, 'vis')
+        nrows = len(self.vis)
+        for row in range(0, nrows, 1000):
+            append_visibility_to_npy(self.vis.select(slice(row, row + 1000)), path)
+        vis = import_visibility_from_npy(path)
+        self.assertIsInstance(vis.vis.base, numpy.memmap)
+        self.assertEqual(len(vis), nrows)
+        for name in Visibility.columns:
+            assert_allclose(getattr(vis, name), getattr(self.vis, name))
+        assert_allclose(vis.frequency, self.vis.frequency)
+        self.assertEqual(vis.phasecentre.separation(self.vis.phasecentre).deg, 0.0)
+        assert_allclose(vis.configuration.xyz, self.vlaa.xyz)
+        # Read-only unless asked otherwise
+        with self.assertRaises(ValueError):
+            vis.vis[0] = 0.0
+        import_visibility_from_npy(path, mmap_mode='r+').vis[0] = 0.0
+        assert_allclose(import_visibility_from_npy(path, mmap_mode=None).vis[0], 0.0)
+
+
 if __name__ == '__main__':
     import sys
     import logging